@@ -5,37 +5,344 @@ Author: D. William Campman
 Version: 2022-10-05
 """
 
+import asyncio
+import math
+import threading
+import time
+
 
 class PathQueue:
-    def __init__(self, agv):
+    def __init__(self,
+                 agv,
+                 poll_interval: float = 0.1,
+                 max_poll_interval: float = 1.0,
+                 backoff: float = 1.5,
+                 stall_timeout: float = 10.0,
+                 timeout: float = None,
+                 min_progress: float = 1.0,
+                 lookahead: float = 0.0,
+                 lookahead_time: float = 0.0,
+                 use_horizon: bool = False):
         """
         Contains a queue of nodes for the AGV to travel to
         :param agv: The AGV object representing the AGV being controlled
+        :param poll_interval: The number of seconds between arrival checks
+            while the AGV is making progress (Default: 0.1)
+        :param max_poll_interval: The longest the interval can grow to while the
+            AGV is not making progress (Default: 1.0)
+        :param backoff: The factor the interval grows by after each check without
+            progress (Default: 1.5)
+        :param stall_timeout: The number of seconds without progress after which
+            the AGV is considered stalled. `None` disables stall detection (Default: 10)
+        :param timeout: The maximum number of seconds to wait for any one waypoint.
+            When exceeded, the path is aborted. `None` waits forever (Default: None)
+        :param min_progress: The distance the AGV must move between checks to
+            count as making progress (Default: 1.0)
+        :param lookahead: Pipelining. The next waypoint is sent once the AGV is
+            within this distance of its current one, so it does not slow down
+            at every waypoint. Only waypoints adjacent to the current one are
+            sent early. `0` waits for arrival (Default: 0)
+        :param lookahead_time: Pipelining. The next waypoint is sent once the AGV
+            is expected to reach its current one within this many seconds at its
+            current speed. `0` disables the time-based check (Default: 0)
+        :param use_horizon: Pipelining. If `True`, the next waypoint is also sent
+            once the AGV's reported `nodeStates` show its current one as the last
+            node left to drive (Default: False)
         """
         self.node_queue = list()
+        self.route = None       # Every node of the route being driven, see `queue_route()`
+        self.current = None     # The waypoint in flight, when driven with `advance()`
         self.agv = agv
 
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.stall_timeout = stall_timeout
+        self.timeout = timeout
+        self.min_progress = min_progress
+        self.lookahead = lookahead
+        self.lookahead_time = lookahead_time
+        self.use_horizon = use_horizon
+
+        # Events, so other threads can wait on the queue without polling
+        self.arrived = threading.Event()        # Set when a waypoint is reached or passed
+        self.stalled = threading.Event()        # Set while the AGV is stalled
+        self.aborted = threading.Event()        # Set when the path is aborted
+        self.completed = threading.Event()      # Set when the whole path is driven
+        self.rerouted = threading.Event()       # Set when `replan()` replaces the waypoints
+
+        # Optional callbacks, called with the waypoint node
+        self.on_arrival = None
+        self.on_stall = None
+
+        self._wakeup = None     # (loop, `asyncio.Event`) while `start_async()` waits for arrival
+        self._stop_task = None  # The Stop command `abort()` sent to an `AsyncAGV`
+
     def abort(self):
         """
         Immediately clears the command queue and tells the robot to stop
         """
         self.node_queue = []
-        self.agv.set_driving(False)
+        self.route = None
+        self.current = None
+        self.aborted.set()
+        self._interrupt_wait()
+        stopping = self.agv.set_driving(False)
+        if asyncio.iscoroutine(stopping):   # An `AsyncAGV`, e.g. in a fleet
+            # Keep the task, so it is not garbage-collected before it is sent
+            self._stop_task = asyncio.ensure_future(stopping)
+
+    async def wait_stopped(self) -> None:
+        """
+        Waits for the Stop command that `abort()` sent to an `AsyncAGV`, if any
+        :raise Exception: Whatever the command raised, e.g. `AGV.ConnectionException`
+        """
+        task, self._stop_task = self._stop_task, None
+        if task is not None:
+            await task
 
-    def start(self) -> None:
+    def start(self) -> bool:
         """
-        Begins processing the queue. This will not return until the path completes
+        Begins processing the queue. This will not return until the path
+        completes, is aborted, or a waypoint times out
+        :return: `True` if every waypoint was reached
         """
+        self._begin()
         self.agv.set_driving(True)
         print("It's driving")
         while self.node_queue and not self.agv.stopped:
-            next_node = self.node_queue.pop(0)
-            print(next_node)
-            self.agv.go_to_node(next_node.id)
-            # Infinite loop until I get what I want
-            while self.agv.get_last_node() != next_node.id:
-                pass
-            print("Next!")
+            next_node = self._next_waypoint()
+            self.agv.go_to_node(next_node.id, navigate=False)
+            # Only pipeline when there is another waypoint to send
+            arrived = self._wait_for_arrival(next_node, pipeline=bool(self.node_queue))
+            if not self._passed(next_node, arrived):
+                return False
+        return self._finish()
+
+    async def start_async(self) -> bool:
+        """
+        Begins processing the queue for an `AsyncAGV`. The same as `start()`,
+        but yields to the event loop while waiting for each waypoint
+        :return: `True` if every waypoint was reached
+        """
+        self._begin()
+        await self.agv.set_driving(True)
+        print("It's driving")
+        try:
+            while self.node_queue and not self.agv.stopped:
+                next_node = self._next_waypoint()
+                await self.agv.go_to_node(next_node.id, navigate=False)
+                arrived = await self._wait_for_arrival_async(next_node, pipeline=bool(self.node_queue))
+                if not self._passed(next_node, arrived):
+                    return False
+            return self._finish()
+        finally:
+            await self.wait_stopped()
+
+    def _begin(self) -> None:
+        self.aborted.clear()
+        self.completed.clear()
+        self.rerouted.clear()
+
+    def _next_waypoint(self):
+        next_node = self.node_queue.pop(0)
+        print(next_node)
+        self.arrived.clear()
+        return next_node
+
+    def _passed(self, node, arrived: bool) -> bool:
+        """
+        Handles the end of the wait for a waypoint
+        :return: `False` if the path should not go on
+        """
+        if self.rerouted.is_set():
+            # The waypoints were replaced mid-drive; send the first new one
+            self.rerouted.clear()
+            print("Rerouted")
+            return True
+        if not arrived:
+            return False
+        self.arrived.set()
+        if self.on_arrival is not None:
+            self.on_arrival(node)
+        print("Next!")
+        return True
+
+    def _finish(self) -> bool:
+        if self.node_queue or self.aborted.is_set():
+            return False
+        self.completed.set()
+        return True
+
+    def advance(self, snapshot):
+        """
+        Steps the queue without blocking, for callers that poll the telemetry
+        themselves (e.g. `fleet.Fleet`, which drives many queues per tick)
+        :param snapshot: The AGV's latest telemetry
+        :return: The next waypoint to send the AGV to, or `None` if the current
+            one has not been reached yet or the queue is empty
+        """
+        current = self.current
+        if self.rerouted.is_set():
+            # The waypoints were replaced mid-drive; send the first new one
+            self.rerouted.clear()
+            current = self.current = None
+        if current is not None:
+            if not (snapshot.last_node_id == current.id
+                    or (self.node_queue and self._should_advance(snapshot, current))):
+                return None
+            self.current = None
+            self.arrived.set()
+            if self.on_arrival is not None:
+                self.on_arrival(current)
+
+        if not self.node_queue:
+            if self.route and not self.completed.is_set() and not self.aborted.is_set():
+                self.completed.set()
+            return None
+        self.current = self.node_queue.pop(0)
+        self.arrived.clear()
+        return self.current
+
+    def _should_advance(self, snapshot, node) -> bool:
+        """
+        Decides whether the next waypoint can be sent before the AGV reaches
+        its current one. Only a next waypoint adjacent to the current one is
+        sent early, since the AGV's own routing might take a different path
+        to one further away than the route that was queued
+        :param snapshot: The latest telemetry
+        :param node: The waypoint the AGV is driving to
+        :return: `True` if the next waypoint should be sent now
+        """
+        if not self.node_queue:
+            return False
+        next_id = self.node_queue[0].id
+        if not any(neighbor.id == next_id for neighbor in node.neighbors):
+            return False
+
+        if self.use_horizon and snapshot.node_states:
+            remaining = [state.get("nodeId") for state in snapshot.node_states]
+            if remaining == [node.id]:
+                return True
+
+        if snapshot.x is None or snapshot.y is None:
+            return False
+        threshold = max(self.lookahead, snapshot.speed * self.lookahead_time)
+        return threshold > 0 and math.dist((snapshot.x, snapshot.y), (node.x, node.y)) <= threshold
+
+    def _wait_for_arrival(self, node, pipeline: bool = False) -> bool:
+        """
+        Sleeps until the telemetry reports that the AGV reached a node. When the
+        AGV has a running poller, this wakes on each published snapshot;
+        otherwise it polls, backing off while the AGV makes no progress
+        :param node: The node the AGV was sent to
+        :param pipeline: If `True`, also return once the next waypoint can be
+            sent early (see `lookahead`)
+        :return: `True` if the AGV arrived, `False` if the path was aborted or
+            rerouted, the AGV was stopped, or the waypoint timed out
+        """
+        checks = self._arrival_checks(node, pipeline)
+        next(checks)
+        while not self._interrupted() and not self.agv.stopped:
+            try:
+                interval = checks.send(self.agv.get_telemetry())
+            except StopIteration as done:
+                return done.value
+
+            # Sleep until the next check. Aborting wakes either wait early, and
+            # rerouting also wakes the poller-based one
+            poller = self.agv.poller
+            if poller is not None and poller.running:
+                poller.wait_for_update(interval, self._interrupted)
+            else:
+                self.aborted.wait(interval)
+        return False
+
+    async def _wait_for_arrival_async(self, node, pipeline: bool = False) -> bool:
+        """
+        The `AsyncAGV` counterpart of `_wait_for_arrival()`. Aborting or
+        rerouting wakes the wait early
+        """
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        self._wakeup = (loop, wakeup)
+        checks = self._arrival_checks(node, pipeline)
+        next(checks)
+        try:
+            while not self._interrupted() and not self.agv.stopped:
+                try:
+                    interval = checks.send(await self.agv.get_telemetry())
+                except StopIteration as done:
+                    return done.value
+                try:
+                    await asyncio.wait_for(wakeup.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
+            return False
+        finally:
+            self._wakeup = None
+
+    def _arrival_checks(self, node, pipeline: bool):
+        """
+        The arrival, progress, stall and timeout checks shared by both waits.
+        A generator: each snapshot sent to it is checked, and it yields the
+        number of seconds to wait before sending the next one
+        :return: `True` once the AGV arrives, `False` if the waypoint timed out
+        """
+        started = last_progress = time.monotonic()
+        interval = self.poll_interval
+        last_position = None
+        last_node_id = None
+        self.stalled.clear()
+
+        snapshot = yield
+        while True:
+            if snapshot.last_node_id == node.id or (pipeline and self._should_advance(snapshot, node)):
+                self.stalled.clear()
+                return True
+
+            now = time.monotonic()
+            position = (snapshot.x, snapshot.y)
+            moved = (last_position is None or None in position
+                     or math.dist(position, last_position) >= self.min_progress)
+            if moved or snapshot.last_node_id != last_node_id:
+                last_progress = now
+                interval = self.poll_interval
+                self.stalled.clear()
+            else:
+                interval = min(interval * self.backoff, self.max_poll_interval)
+            last_position = position
+            last_node_id = snapshot.last_node_id
+
+            if (self.stall_timeout is not None and not self.stalled.is_set()
+                    and now - last_progress > self.stall_timeout):
+                print(f"Stalled on the way to {node}")
+                self.stalled.set()
+                if self.on_stall is not None:
+                    self.on_stall(node)
+
+            if self.timeout is not None and now - started > self.timeout:
+                print(f"Timed out on the way to {node}")
+                self.abort()
+                return False
+
+            snapshot = yield interval
+
+    def _interrupted(self) -> bool:
+        return self.aborted.is_set() or self.rerouted.is_set()
+
+    def _interrupt_wait(self) -> None:
+        """
+        Wakes `_wait_for_arrival()` if it is waiting on the AGV's poller, or
+        `_wait_for_arrival_async()`. Safe to call from any thread
+        """
+        poller = getattr(self.agv, "poller", None)     # `AsyncAGV` has none
+        if poller is not None:
+            poller.interrupt()
+        wakeup = self._wakeup
+        if wakeup is not None:
+            loop, event = wakeup
+            loop.call_soon_threadsafe(event.set)
 
     def queue_nodes(self, nodes):
         """
@@ -44,3 +351,53 @@ class PathQueue:
         """
         for node in nodes:
             self.node_queue.append(node)
+
+    def queue_route(self, route, waypoints):
+        """
+        Queues a planned route, keeping the full route so it can be repaired
+        by `replan()` if obstacles appear while it is being driven
+        :param route: Every node along the route, including the source
+        :param waypoints: The collapsed waypoints for the AGV to visit
+        """
+        self.route = list(route)
+        self.queue_nodes(waypoints)
+
+    def replan(self, reroute: bool = False, last_node: str = None) -> bool:
+        """
+        Updates the route being driven after the network's obstacles changed.
+        Only the blocked stretches of the remaining route are replaced, so the
+        AGV keeps driving towards waypoints that are still valid
+        :param reroute: If `True`, search the whole remaining route again instead,
+            e.g. to take a shortcut after an obstacle was removed (Default: False)
+        :param last_node: The ID of the last node the AGV passed. `None` reads it
+            from the AGV (Default: None)
+        :return: `False` if the target can no longer be reached, in which case
+            the path is aborted
+        """
+        route = self.route
+        if not route or self.completed.is_set():
+            return True
+        network = self.agv.network
+
+        # Only the part of the route ahead of the AGV matters
+        if last_node is None:
+            last_node = self.agv.get_last_node()
+        start = next((index for index, node in enumerate(route) if node.id == last_node), 0)
+        if reroute:
+            ahead = network.find_route(route[start].id, route[-1].id)
+            repaired = None if ahead is None else route[:start] + ahead
+        else:
+            repaired = network.repair_route(route, start)
+
+        if repaired is None:
+            print(f"No route left to {route[-1]}")
+            self.abort()
+            return False
+        if [node.id for node in repaired] == [node.id for node in route]:
+            return True
+
+        self.route = repaired
+        self.node_queue = network.waypoints(repaired[start:])
+        self.rerouted.set()
+        self._interrupt_wait()
+        return True
@@ -5,11 +5,216 @@ Author: D. William Campman
 Date: 2022-10-04
 """
 
-from datetime import datetime
+import asyncio
+import itertools
+import json
+import threading
+import time
+from typing import Optional
+import uuid
+
 import requests
+from requests.adapters import HTTPAdapter
+
+import aiohttp
 
+import broadcast
+import compact_network
+import map_cache
+import map_stream
+import metrics as metrics_module
 import PathQueue
 import node_network
+import routing_table
+import telemetry
+import tracing
+import travel_time
+
+
+# Unique action IDs: a per-process prefix plus a counter
+_ACTION_ID_PREFIX = uuid.uuid4().hex[:8]
+_action_counter = itertools.count()
+
+
+def _next_action_id(name: str) -> str:
+    """
+    Generates an action ID that is unique across this process and unlikely
+    to collide with IDs issued by previous runs
+    :param name: The name of the action
+    """
+    return f"{name}_{_ACTION_ID_PREFIX}_{next(_action_counter)}"
+
+
+def _build_action(name, action_parameters=None, action_id: str = None) -> dict:
+    """
+    Builds the JSON description of a single instant action
+    :param name: The name of the action
+    :param action_parameters: Any action parameters (if applicable)
+    :param action_id: The ID of the action (Default: a newly generated ID)
+    :return: The action dictionary
+    """
+    if action_parameters is None:
+        action_parameters = []
+    elif isinstance(action_parameters, dict):
+        action_parameters = [action_parameters]
+    return {
+        "actionName": name,
+        "actionId": _next_action_id(name) if action_id is None else action_id,
+        "blockingType": "NONE",
+        "actionParameters": action_parameters
+    }
+
+
+def _start_dispatch(actions: list):
+    """
+    Starts the dispatch stage of the current command's trace, if these are the
+    first actions sent for it
+    :return: A tuple of the trace and its dispatch span, or `(None, None)`
+    """
+    trace = tracing.current()
+    if trace is None or trace.dispatched:
+        return None, None
+    trace.dispatched = True
+    return trace, trace.start_span("dispatch", actions=[action["actionName"] for action in actions])
+
+
+def _effect_check(actions: list):
+    """
+    Returns a check for the telemetry showing that a batch of actions took
+    effect: the AGV paused or resumed, or it reports the state of an action
+    """
+    names = {action["actionName"] for action in actions}
+    if "Stop" in names:
+        return lambda snapshot: snapshot.paused
+    if "Resume" in names:
+        return lambda snapshot: not snapshot.paused
+    action_ids = {action["actionId"] for action in actions}
+    return lambda snapshot: any(state.get("actionId") in action_ids for state in snapshot.action_states)
+
+
+class ActionHandle:
+    # Statuses after which an action will not change again
+    FINAL_STATUSES = ("FINISHED", "FAILED")
+
+    def __init__(self, action_id: str, name: str):
+        """
+        Refers to an action that was sent to the AGV, so its progress can be
+        found in the `actionStates` of the telemetry
+        :param action_id: The unique ID the action was sent with
+        :param name: The name of the action
+        """
+        self.id = action_id
+        self.name = name
+
+    def __repr__(self):
+        return f"ActionHandle({self.id!r})"
+
+    def status(self, action_states) -> Optional[str]:
+        """
+        Looks up this action's status
+        :param action_states: The `actionStates` list from the telemetry
+        :return: The upper-case status (e.g. "RUNNING", "FINISHED"), or `None`
+            if the AGV has not reported this action
+        """
+        for state in action_states:
+            if state["actionId"] == self.id:
+                return state["actionStatus"].upper()
+        return None
+
+    def is_done(self, action_states) -> bool:
+        """
+        Returns `True` if the AGV reports this action as finished or failed
+        :param action_states: The `actionStates` list from the telemetry
+        """
+        return self.status(action_states) in ActionHandle.FINAL_STATUSES
+
+
+class ActionBatch:
+    def __init__(self, agv):
+        """
+        Gathers several instant actions so they can be sent in one request.
+        Can be used as a context manager, which sends the batch on exit:
+
+            with agv.batch() as batch:
+                pin = batch.set_pin_up(True)
+                batch.set_driving(True)
+
+        With an `AsyncAGV`, use `async with` instead.
+        :param agv: The `AGV` or `AsyncAGV` the batch will be sent to
+        """
+        self.agv = agv
+        self.actions = []
+        self.handles = []
+        self.driving = None     # The driving state the batch leaves the AGV in, if any
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None and self.actions:
+            self.send()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None and self.actions:
+            await self.send()
+
+    def add(self, name, action_parameters=None) -> ActionHandle:
+        """
+        Adds an action to the batch
+        :param name: The name of the action
+        :param action_parameters: Any action parameters (if applicable)
+        :return: The handle for tracking the action once sent
+        """
+        action = _build_action(name, action_parameters)
+        handle = ActionHandle(action["actionId"], name)
+        self.actions.append(action)
+        self.handles.append(handle)
+        return handle
+
+    def send(self):
+        """
+        Sends every action in the batch in a single request. For an `AsyncAGV`
+        this returns a coroutine, which must be awaited
+        :return: The action handles, in the order the actions were added
+        """
+        return self.agv.send_batch(self)
+
+    def go_to_node(self, node_id: str) -> ActionHandle:
+        """
+        Adds a command to drive to a node using the AGV's built-in routing
+        """
+        return self.add("goto", action_parameters=[{"key": "end", "value": node_id}])
+
+    def set_pin_up(self, pin_up: bool) -> ActionHandle:
+        """
+        Adds a command to raise or lower the pin
+        """
+        return self.add("MovePinUp" if pin_up else "MovePinDown")
+
+    def set_driving(self, driving: bool) -> ActionHandle:
+        """
+        Adds a command to drive or pause
+        """
+        self.driving = driving
+        return self.add("Resume" if driving else "Stop")
+
+    def rotate_left(self) -> ActionHandle:
+        """
+        Adds a command to rotate to the left
+        """
+        return self.add("RotateLeft1")
+
+    def rotate_right(self) -> ActionHandle:
+        """
+        Adds a command to rotate to the right
+        """
+        return self.add("RotateRight1")
 
 
 class AGV:
@@ -24,15 +229,25 @@ class AGV:
 
     BS_MODE = False
 
+    # Connection settings
+    DEFAULT_TIMEOUT = (1.0, 2.0)    # (connect, read) in seconds
+    DEFAULT_POOL_SIZE = 4
+
+    # Where the network map is cached between runs
+    MAP_CACHE_PATH = "networkmap.cache"
+    MAP_CHUNK_SIZE = 64 * 1024      # Bytes of the map decoded at a time while downloading
+
     class ConnectionException(Exception):
-        def __init__(self, resp):
+        def __init__(self, resp, text=None):
             """
             A custom exception for when there is a connectivity error with the AGV
-            :param resp: The response from the API request
+            :param resp: The response from the API request (`requests` or `aiohttp`)
+            :param text: The body of the response, if it has already been read
+                (Default: `resp.text`)
             """
             self.url = resp.url
-            self.status_code = resp.status_code
-            self.text = resp.text
+            self.status_code = resp.status_code if hasattr(resp, "status_code") else resp.status
+            self.text = resp.text if text is None else text
 
         def __str__(self):
             return ("DataException: Could not connect to AGV"
@@ -46,61 +261,383 @@ class AGV:
                     f"\nStatus Code: {self.status_code}"
                     f"\nText: {self.text if self.text else ''}")
 
-    def __init__(self, navigate=False, ttl=0.1):
+    def __init__(self,
+                 navigate=False,
+                 ttl=0.1,
+                 base_url: str = None,
+                 timeout=DEFAULT_TIMEOUT,
+                 pool_size: int = DEFAULT_POOL_SIZE,
+                 stale_ttl: float = 0.0,
+                 history: int = 0,
+                 map_cache_path: Optional[str] = MAP_CACHE_PATH,
+                 offline: bool = False,
+                 compact: bool = False,
+                 route_targets=None,
+                 travel_model: travel_time.TravelModel = None,
+                 recorder=None,
+                 metrics: metrics_module.Metrics = None):
         """
-        A class for interfacing with a Safelog AGV
-        :param ttl: The number of seconds before the network cache expires (Default: 0.2)
+        A class for interfacing with a Safelog AGV. It is safe to share one instance
+        between threads.
+        :param ttl: The number of seconds before the network cache expires (Default: 0.1)
         :param navigate: Whether the AGV should use custom pathing to nodes
+        :param base_url: The base URL of the AGV's API (Default: `AGV.API_BASE_URL`)
+        :param timeout: The request timeout in seconds, either a single number or a
+            (connect, read) tuple (Default: `AGV.DEFAULT_TIMEOUT`)
+        :param pool_size: The number of keep-alive connections held open to the AGV
+            (Default: `AGV.DEFAULT_POOL_SIZE`)
+        :param stale_ttl: The number of seconds past `ttl` during which reads return
+            the expired data while it is refreshed in the background (Default: 0)
+        :param history: The number of past telemetry snapshots to keep in
+            `cache.history` (Default: 0)
+        :param map_cache_path: The file the network map is cached in. If a cached
+            map exists, it is used immediately and checked against the AGV's map
+            in the background. `None` disables the cache (Default: `AGV.MAP_CACHE_PATH`)
+        :param offline: If `True`, the network is built only from the cached map
+            and the AGV is never contacted during startup (Default: False)
+        :param compact: If `True`, the node network uses the array-backed
+            `CompactNetwork`, which suits very large maps (Default: False)
+        :param route_targets: The IDs of nodes (e.g. stations) to precompute routes
+            to, or "all" for every node. The table is stored next to the map cache
+            and updated when the map changes. `None` disables it (Default: None)
+        :param travel_model: If given, custom pathing picks the quickest route,
+            counting the time spent turning, instead of the shortest one (Default: None)
+        :param recorder: A `recorder.TelemetryRecorder` that every telemetry response
+            and sent action is appended to. Can also be set later (Default: None)
+        :param metrics: Collects request latencies, errors, transferred bytes and
+            cache hits. See `enable_metrics()` (Default: None, collection is off)
         """
         self.navigate = navigate
-        self.cache_tts = ttl
+        self.recorder = recorder
+        self.metrics = metrics
+        self.travel_model = travel_model
+        self.timeout = timeout
+
+        # Endpoints for this vehicle
+        if base_url is None:
+            base_url = AGV.API_BASE_URL
+        self.actions_endpoint = base_url + "instantActions"
+        self.variables_endpoint = base_url + "variables"
+        self.network_map_endpoint = base_url + "networkmap"
+
+        # One keep-alive session, so requests reuse pooled connections
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
-        self.cache_time = None      # The timestamp of when the cache was last updated
-        self.cache = None           # The cached data
         self.stopped = False        # Whether the robot has been commanded to stop
+        self.poller = None          # Background telemetry poller, if started
+        self._network_lock = threading.Lock()   # Held while obstacles change or the network is replaced
+        self.confirmations = tracing.Confirmations()    # Traced commands awaiting their effect
+        self.broadcast = None       # UDP telemetry receiver, if started
+
+        # Shared, single-flight telemetry cache
+        self.cache = telemetry.TelemetryCache(self._fetch_variables, ttl=ttl, stale_ttl=stale_ttl,
+                                              on_update=self._on_update, history=history)
+        self.cache.metrics = metrics
 
-        # Collect node network
-        target_url = AGV.NETWORK_MAP_ENDPOINT
+        # Collect node network, from the on-disk cache if possible
+        self.network_class = compact_network.CompactNetwork if compact else node_network.Network
+        self.map_cache = None if map_cache_path is None else map_cache.MapCache(map_cache_path)
+        cached = None if self.map_cache is None else self.map_cache.load_network(
+            network_class=self.network_class)
+        if cached is not None:
+            self.map_digest, self.network = cached
+            print("Network loaded from cache.")
+        elif offline:
+            raise FileNotFoundError(f"No cached network map at `{map_cache_path}`")
+        else:
+            self.map_digest, self.network = self._download_network()
+
+        # Precomputed routes, stored alongside the map
+        self.route_targets = route_targets
+        if route_targets is not None:
+            self._load_routes()
+
+        if cached is not None and not offline:
+            threading.Thread(target=self._revalidate_network, name="MapRevalidation",
+                             daemon=True).start()
+        self.queue = PathQueue.PathQueue(self)
+        print("AGV Ready.")
+        print("---------------")
+
+    def _download_network(self):
+        """
+        Downloads the network map and builds the node network, updating the
+        on-disk cache if one is used
+        :return: A tuple of the map's digest and the network
+        """
+        target_url = self.network_map_endpoint
         print(target_url)
         print("Fetching node list...")
 
-        resp = requests.get(target_url)
-        if resp.status_code != 200:
-            print(resp.url)
-            raise AGV.ConnectionException(resp)
+        digest, nodes, edges = self._stream_network_map()
         print("List aquired. Building network...")
-        self.network = node_network.Network(resp.json())
+        network = self.network_class.from_elements(nodes, edges)
         print("Network built.")
-        self.queue = PathQueue.PathQueue(self)
-        print("AGV Ready.")
-        print("---------------")
+        if self.map_cache is not None:
+            self.map_cache.save_elements(digest, nodes, edges)
+        return digest, network
+
+    def _stream_network_map(self):
+        """
+        Downloads the network map, decoding it as it arrives so the raw body and
+        the full JSON tree are never held in memory (see `map_stream`)
+        :return: A tuple of the map's digest, node list and edge list
+        """
+        metrics = self.metrics
+        started = time.perf_counter()
+        received = 0
+        parser = map_stream.MapStreamParser()
+        try:
+            with self.session.get(self.network_map_endpoint, timeout=self.timeout, stream=True) as resp:
+                if resp.status_code != 200:
+                    if metrics is not None:
+                        metrics.request("networkmap", time.perf_counter() - started, resp.status_code)
+                    print(resp.url)
+                    raise AGV.ConnectionException(resp)
+                for chunk in resp.iter_content(chunk_size=AGV.MAP_CHUNK_SIZE):
+                    received += len(chunk)
+                    parser.feed(chunk)
+        except requests.RequestException as e:
+            if metrics is not None:
+                metrics.request("networkmap", time.perf_counter() - started, type(e).__name__,
+                                received=received)
+            raise
+        if metrics is not None:
+            # The whole download, not just the time to the first byte
+            metrics.request("networkmap", time.perf_counter() - started, received=received)
+        return parser.close()
+
+    def _revalidate_network(self) -> None:
+        """
+        Compares the cached network map against the AGV's, replacing the
+        network and the cache if the map has changed
+        """
+        try:
+            digest, nodes, edges = self._stream_network_map()
+        except (requests.RequestException, AGV.ConnectionException, ValueError) as e:
+            print(f"Could not revalidate the cached network map: {e}")
+            return
+
+        if digest == self.map_digest:
+            return
+        print("Network map changed. Rebuilding network...")
+        network = self.network_class.from_elements(nodes, edges)
+        # The old table keeps serving the old network until both are replaced together
+        routes = self.network.routing_table
+        if routes is not None:
+            routes, rebuilt = routes.updated(network)
+            print(f"Routing table updated ({rebuilt} of {len(routes.rows)} rows rebuilt).")
+            network.routing_table = routes
+        with self._network_lock:
+            self._carry_over_obstacles(self.network, network)
+            self.network = network
+        self.map_digest = digest
+        self.map_cache.save_elements(digest, nodes, edges)
+        if routes is not None:
+            routes.save(self.map_cache.path + ".routes", digest)
+        print("Network rebuilt.")
+
+    @staticmethod
+    def _carry_over_obstacles(old, new) -> None:
+        """
+        Re-applies the runtime obstacles of a network to the one replacing it.
+        The route cache versions continue from the old network's, so a route
+        cached against the old network can never match the new one
+        """
+        new.map_version = old.map_version + 1
+        new.obstacle_version = old.obstacle_version
+        for obstacle in old.obstacles:
+            new.add_obstacle(obstacle)
+
+    def _load_routes(self) -> None:
+        """
+        Attaches a routing table to the network, reusing the one stored next to
+        the map cache when possible
+        """
+        targets = None if self.route_targets == "all" else list(self.route_targets)
+        path = None if self.map_cache is None else self.map_cache.path + ".routes"
+
+        loaded = None if path is None else routing_table.RoutingTable.load(path)
+        if loaded is not None and loaded[1].targets_match(targets):
+            digest, table = loaded
+            self.network.routing_table = table
+            print("Routing table loaded.")
+            if digest == self.map_digest:
+                return
+            table.update(self.network)  # Built for an older map
+        else:
+            print("Precomputing routes...")
+            table = self.network.precompute_routes(targets)
+        if path is not None:
+            table.save(path, self.map_digest)
 
-    def _check_cache(self, force: bool = False) -> bool:
+    def _check_cache(self, force: bool = False):
         """
-        Checks if the cache has expired and updates the data if so
+        Returns the current telemetry, refreshing it if the cache has expired
         :param force: If `true`, the cache will refresh regardless of age (Default: False)
-        :return: `True` if the cache was refreshed, `False` otherwise
+        :return: The `Telemetry` snapshot
         """
+        metrics = self.metrics
+        if metrics is None:
+            return self._read_cache(force)
+        started = time.perf_counter()
+        try:
+            return self._read_cache(force)
+        finally:
+            metrics.observe("check_cache", time.perf_counter() - started)
+
+    def _read_cache(self, force: bool):
+        # The poller or the broadcasts keep the data fresh, so reads never touch
+        # the network, unless the latest snapshot predates the last command
+        if not force and (self.poller is not None
+                          or (self.broadcast is not None and self.broadcast.alive)):
+            snapshot = self.cache.latest()
+            if snapshot is not None:
+                if self.metrics is not None:
+                    self.metrics.cache(True)
+                return snapshot
+        return self.cache.get(force)
+
+    def _request(self, endpoint: str, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Makes a request over the pooled session, recording it if metrics are enabled
+        :param endpoint: The endpoint's name in the metrics
+        :param method: The HTTP method
+        :param url: The url to request
+        :param kwargs: Keyword arguments passed to `requests.Session.request`
+        :return: The response
+        """
+        metrics = self.metrics
+        if metrics is None:
+            return self.session.request(method, url, timeout=self.timeout, **kwargs)
+        started = time.perf_counter()
+        try:
+            resp = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            metrics.request(endpoint, time.perf_counter() - started, type(e).__name__)
+            raise
+        metrics.request(endpoint, time.perf_counter() - started, resp.status_code,
+                        sent=len(resp.request.body or b""), received=len(resp.content))
+        return resp
 
-        # ======================= Validate Cache
+    def enable_metrics(self, metrics: metrics_module.Metrics = None) -> metrics_module.Metrics:
+        """
+        Starts collecting request latencies, errors, transferred bytes and cache hits
+        :param metrics: The collector to record into, e.g. one shared by several
+            vehicles (Default: the current one, or a new one)
+        :return: The collector, which exports with `to_prometheus()` or `to_json()`
+        """
+        if metrics is None:
+            metrics = self.metrics if self.metrics is not None else metrics_module.Metrics()
+        self.metrics = self.cache.metrics = metrics
+        return metrics
 
-        if self.cache is not None and not force:    # Check if cache is required to refresh
-            cache_age = (datetime.now() - self.cache_time).total_seconds()
-            if cache_age < self.cache_tts:  # Check if cache is stale
-                return False
+    def disable_metrics(self) -> None:
+        """
+        Stops collecting metrics
+        """
+        self.metrics = self.cache.metrics = None
 
-        url = AGV.VARIABLES_ENDPOINT
-        resp = requests.get(url)  # Make data request
+    def _fetch_variables(self) -> dict:
+        """
+        Requests the AGV's current variables
+        :return: The decoded JSON response
+        """
+        resp = self._request("variables", "GET", self.variables_endpoint)
 
         # Validate response
         if not resp.status_code == 200:
-            self.cache = None
             raise AGV.ConnectionException(resp)
+        data = resp.json()
+        if self.recorder is not None:
+            self.recorder.record_telemetry(data)
+        return data
 
-        self.cache = resp.json()   # Update cache variable
-        self.cache_time = datetime.now()
-        self.stopped = self.cache["paused"]
-        return True
+    def start_polling(self, interval: float = None) -> telemetry.TelemetryPoller:
+        """
+        Starts refreshing the telemetry on a background thread. While polling,
+        every getter reads the latest snapshot instead of making a request. The
+        first read after a command still waits for data requested after it
+        :param interval: The number of seconds between refreshes (Default: the cache TTL)
+        :return: The poller, which can be used to subscribe to field changes
+        """
+        if self.poller is None:
+            self.poller = telemetry.TelemetryPoller(self._poll,
+                                                    self.cache.ttl if interval is None else interval)
+        elif interval is not None:
+            self.poller.interval = interval
+        self.poller.start()
+        return self.poller
+
+    def stop_polling(self) -> None:
+        """
+        Stops the background poller. Getters go back to requesting on demand
+        """
+        if self.poller is not None:
+            self.poller.stop()
+            self.poller = None
+
+    def _poll(self):
+        """
+        Refreshes the telemetry for the poller, unless broadcasts are arriving
+        :return: The new `Telemetry` snapshot, or `None` to skip the tick
+        """
+        if self.broadcast is not None and self.broadcast.alive:
+            return None
+        return self.cache.refresh()
+
+    def start_broadcast(self,
+                        port: int = broadcast.BROADCAST_PORT,
+                        host: str = "0.0.0.0",
+                        serial: str = None,
+                        timeout: float = 1.0) -> broadcast.BroadcastReceiver:
+        """
+        Starts receiving the AGV's UDP telemetry broadcasts on a background thread.
+        While they arrive, getters read the latest broadcast instead of making a
+        request, and the poller skips its ticks. If no packet arrives for `timeout`
+        seconds, both fall back to requesting `/api/variables`
+        :param port: The port the AGV broadcasts to (Default: `broadcast.BROADCAST_PORT`)
+        :param host: The address to bind to (Default: every interface)
+        :param serial: Only accept packets with this `serialNumber` (Default: every packet)
+        :param timeout: The number of seconds without a packet before falling back
+            to HTTP (Default: 1)
+        :return: The receiver, which counts received and lost packets
+        """
+        if self.broadcast is None:
+            receiver = broadcast.BroadcastReceiver(self._on_broadcast, serial=serial, timeout=timeout)
+            receiver.listen_in_thread(host, port)
+            self.broadcast = receiver
+        return self.broadcast
+
+    def stop_broadcast(self) -> None:
+        """
+        Stops receiving broadcasts. Getters go back to requesting the telemetry
+        """
+        if self.broadcast is not None:
+            self.broadcast.close()
+            self.broadcast = None
+
+    def _on_broadcast(self, snapshot) -> None:
+        """
+        Stores a broadcast snapshot as if it had been requested
+        """
+        if self.recorder is not None:
+            self.recorder.record_telemetry(snapshot.raw)
+        self.cache.put(snapshot)
+        if self.poller is not None:
+            self.poller.publish(snapshot)
+
+    def _on_update(self, snapshot) -> None:
+        """
+        Keeps `stopped` in sync with the AGV and confirms traced commands. Only
+        called with data requested after the last command, so it cannot undo a
+        newer `set_driving()`
+        """
+        self.stopped = snapshot.paused
+        self.confirmations.update(snapshot)
 
     def _send_action(self, name, action_parameters=None) -> requests.Response:
         """
@@ -109,32 +646,66 @@ class AGV:
         :param action_parameters: Any action parameters (if applicable)
         :return: The response from the API
         """
-        # Build json payload
-        if action_parameters is None:
-            action_parameters = []
-        elif isinstance(action_parameters, dict):
-            action_parameters = [action_parameters]
-        data = {
-            "instantActions": [
-                {
-                    "actionName": name,
-                    "actionId": "0",
-                    "blockingType": "NONE",
-                    "actionParameters": action_parameters
-                }
-            ]
-        }
-
-        # Send action
-        resp = requests.post(AGV.ACTIONS_ENDPOINT, json=data)
+        return self._send_actions([_build_action(name, action_parameters)])
+
+    def _send_actions(self, actions: list) -> requests.Response:
+        """
+        Sends one or more actions to the AGV's API in a single request
+        :param actions: The action dictionaries, as built by `_build_action`
+        :return: The response from the API
+        """
+        trace, span = _start_dispatch(actions)
+        headers = None if span is None else {"traceparent": trace.traceparent(span)}
+        resp = self._request("instantActions", "POST", self.actions_endpoint,
+                             json={"instantActions": actions}, headers=headers)
         if resp.status_code != 200:
             raise AGV.ConnectionException(resp)
+        if self.recorder is not None:
+            self.recorder.record_actions(actions)
 
         # Invalidate cache
-        self.cache = None
+        self.cache.invalidate()
+
+        # The command is confirmed by the first telemetry that shows its effect
+        if trace is not None:
+            trace.end_span(span)
+            self.confirmations.expect(trace, _effect_check(actions))
 
         return resp
 
+    def batch(self) -> ActionBatch:
+        """
+        Starts a batch of actions to be sent in a single request
+        """
+        return ActionBatch(self)
+
+    def send_batch(self, batch: ActionBatch) -> [ActionHandle]:
+        """
+        Sends a batch of actions in a single request
+        :param batch: The batch of actions
+        :return: The action handles, in the order the actions were added
+        """
+        self._send_actions(batch.actions)
+        if batch.driving is not None:
+            self.stopped = not batch.driving
+        return list(batch.handles)
+
+    def get_action_status(self, handle: ActionHandle) -> Optional[str]:
+        """
+        Returns the status the AGV reports for a previously sent action
+        :param handle: The handle returned when the action was sent
+        :return: The upper-case status, or `None` if the AGV has not reported it
+        """
+        return handle.status(self._check_cache().action_states)
+
+    def close(self) -> None:
+        """
+        Stops polling and closes the pooled connections to the AGV
+        """
+        self.stop_polling()
+        self.stop_broadcast()
+        self.session.close()
+
     def find_closest_node(self):
         """
         Returns the closest node in the network to the AGV's current location
@@ -142,10 +713,54 @@ class AGV:
         x, y = self.get_location()
         return self.network.get_closest_node(x, y)
 
+    def plan_route(self, node_id: str):
+        """
+        Plans a route from the AGV's last node to another node. With a
+        `travel_model`, the route minimizes the expected travel time, starting
+        from the AGV's current heading
+        :param node_id: The node for the AGV to travel to
+        :return: A tuple of every node along the route, the waypoints to send,
+            and the estimated duration in seconds (`None` without a travel model)
+        """
+        if self.travel_model is None:
+            return (*self.network.plan(self.get_last_node(), node_id), None)
+        snapshot = self.get_telemetry()
+        return self.network.plan_fastest(snapshot.last_node_id, node_id, self.travel_model,
+                                         travel_time.heading_from_theta(snapshot.theta))
+
+    def add_obstacle(self, obstacle: node_network.Rectangle) -> bool:
+        """
+        Blocks a region of the network at runtime, repairing the route being
+        driven if it passes through the region
+        :param obstacle: The region the AGV should avoid
+        :return: `False` if the route's target can no longer be reached
+        """
+        with self._network_lock:
+            self.network.add_obstacle(obstacle)
+        return self.queue.replan()
+
+    def remove_obstacle(self, obstacle: node_network.Rectangle) -> bool:
+        """
+        Unblocks a region passed to `add_obstacle()`. The route being driven is
+        searched again, since the freed region may offer a shorter route
+        :param obstacle: The same rectangle object that was added
+        :return: `False` if the route's target cannot be reached
+        """
+        with self._network_lock:
+            self.network.remove_obstacle(obstacle)
+        return self.queue.replan(reroute=True)
+
     # ==================================================================
     # =================          READING DATA          =================
     # ==================================================================
 
+    def get_telemetry(self) -> telemetry.Telemetry:
+        """
+        Returns the current telemetry snapshot, refreshing it if it has expired.
+        Reading several fields from one snapshot guarantees they are consistent
+        """
+        return self._check_cache()
+
     def get_data(self, key: str):
         """
         Provides direct access to the variable dictionary. A full list of available
@@ -155,42 +770,59 @@ class AGV:
         :param key: The key in the dictionary
         :return: The value at that key
         """
-        self._check_cache()
-        return self.cache[key]
+        return self._check_cache()[key]
 
     def get_location(self) -> (float, float):
         """
         Returns the x and y location of the AGV at the current time
         :return: A tuple containing the x and y coordinates of the AGV
         """
-        pos = self.get_data("agvPosition")
-        return pos["x"], pos["y"]
+        snapshot = self._check_cache()
+        return snapshot.x, snapshot.y
 
     def get_last_node(self) -> str:
         """
-        Returns the x and y location of the AGV at the current time
-        :return: A tuple containing the x and y coordinates of the AGV
+        Returns the ID of the last node the AGV passed through
         """
-        return self.get_data("lastNodeId")
+        return self._check_cache().last_node_id
 
     def get_theta(self) -> float:
         """
         Returns the AGV's theta
         """
-        pos = self.get_data("agvPosition")
-        return pos["theta"]
+        return self._check_cache().theta
+
+    def get_velocity(self) -> (float, float, float):
+        """
+        Returns the AGV's velocity
+        :return: A tuple containing vx, vy and omega
+        """
+        snapshot = self._check_cache()
+        return snapshot.vx, snapshot.vy, snapshot.omega
+
+    def get_battery_charge(self) -> float:
+        """
+        Returns the AGV's battery charge in percent
+        """
+        return self._check_cache().battery_charge
 
     def is_pin_up(self) -> bool:
         """
         Returns `true` if the robot's pin is up
         """
-        return self.get_data("isPinUp")
+        return self._check_cache().pin_up
 
     def is_driving(self) -> bool:
         """
         Returns `true` if the robot is currently driving
         """
-        return self.get_data("driving")
+        return self._check_cache().driving
+
+    def is_paused(self) -> bool:
+        """
+        Returns `true` if the AGV reports that it is paused
+        """
+        return self._check_cache().paused
 
     # ==================================================================
     # ===============          SENDING COMMANDS          ===============
@@ -202,7 +834,7 @@ class AGV:
 
         :param node_id: The node for the AGV to travel to
         :param navigate: Specify whether the AGV should be given custom
-            routing to its target. `True` for BFS-based traversal of
+            routing to its target. `True` for A*-based traversal of
             the NodeNetwork. `False` for using the AGV's built in routing,
             and `None` to use the choice specified during initialization
             (Default: None)
@@ -210,15 +842,41 @@ class AGV:
         if navigate is None:
             navigate = self.navigate
 
-        if navigate:    # BFS traversal of NodeNetwork
-            source = self.network.get_node(self.get_last_node())
-            target = self.network.get_node(node_id)
-            path = node_network.navigate_between(source, target)
-            self.queue.queue_nodes(path)
+        if navigate:    # A* traversal of NodeNetwork
+            route, path, duration = self.plan_route(node_id)
+            if duration is not None:
+                print(f"Estimated duration: {duration:.1f}s")
+            self.queue.queue_route(route, path)
             self.queue.start()
         else:   # SafeLog's built-in pathfinding
             self._send_action("goto", action_parameters=[{"key": "end", "value": node_id}])
 
+    def go_to_nearest(self, node_ids, navigate=None) -> Optional[str]:
+        """
+        Sends the AGV to whichever of several nodes is closest along the network,
+        e.g. the nearest free charger
+        :param node_ids: The IDs of the candidate nodes
+        :param navigate: Specify whether the AGV should be given custom routing
+            to its target. See `go_to_node` (Default: None)
+        :return: The ID of the chosen node, or `None` if none can be reached
+        """
+        if navigate is None:
+            navigate = self.navigate
+
+        found = self.network.nearest_target(self.get_last_node(), node_ids)
+        if found is None:
+            print("No reachable target")
+            return None
+        target, route, cost = found
+        print(f"Nearest target: {target} ({cost:.0f} away)")
+
+        if navigate:    # Follow the route the search already found
+            self.queue.queue_route(route, self.network.waypoints(route))
+            self.queue.start()
+        else:
+            self._send_action("goto", action_parameters=[{"key": "end", "value": target.id}])
+        return target.id
+
     def go_forwards(self):
         """
         Makes the robot drive forwards indefinitely
@@ -292,3 +950,457 @@ class AGV:
         :return: The network response from the AGV
         """
         return self._send_action("RotateRight1")
+
+
+class AsyncAGV:
+
+    def __init__(self,
+                 navigate=False,
+                 ttl=0.1,
+                 base_url: str = None,
+                 timeout: float = 2.0,
+                 connect_timeout: float = 1.0,
+                 pool_size: int = AGV.DEFAULT_POOL_SIZE,
+                 keepalive: float = 30.0,
+                 session: aiohttp.ClientSession = None,
+                 network=None,
+                 metrics: metrics_module.Metrics = None):
+        """
+        An asyncio interface to a Safelog AGV. All requests share one long-lived
+        `aiohttp` session, so connections are pooled and kept alive between calls.
+        Use as an async context manager, or call `connect()` and `close()` manually.
+        :param navigate: Whether the AGV should use custom pathing to nodes
+        :param ttl: The number of seconds before the network cache expires (Default: 0.1)
+        :param base_url: The base URL of the AGV's API (Default: `AGV.API_BASE_URL`)
+        :param timeout: The total timeout of a request in seconds (Default: 2.0)
+        :param connect_timeout: The timeout for opening a connection in seconds (Default: 1.0)
+        :param pool_size: The maximum number of connections held open to the AGV
+            (Default: `AGV.DEFAULT_POOL_SIZE`)
+        :param keepalive: The number of seconds an idle connection is kept open (Default: 30)
+        :param session: An open session to share with other vehicles. It is not
+            closed by `close()`. `None` creates one in `connect()` (Default: None)
+        :param network: A node network to share with other vehicles on the same
+            map. `None` downloads the AGV's map in `connect()` (Default: None)
+        :param metrics: Collects request latencies, errors, transferred bytes and
+            cache hits, and can be shared between vehicles (Default: None, collection is off)
+        """
+        self.navigate = navigate
+        self.ttl = ttl
+
+        if base_url is None:
+            base_url = AGV.API_BASE_URL
+        self.actions_endpoint = base_url + "instantActions"
+        self.variables_endpoint = base_url + "variables"
+        self.network_map_endpoint = base_url + "networkmap"
+
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.session = session      # Created in `connect()` if not given, as it needs a running loop
+        self._owns_session = session is None
+
+        self.cache_time = None      # The `time.monotonic()` time the cache was requested
+        self.cache = None           # The cached `Telemetry` snapshot
+        self.cache_valid = False    # Cleared when a command is sent
+        self._generation = 0        # Incremented when a command is sent
+        self.stopped = False        # Whether the robot has been commanded to stop
+        self.network = network
+        self._refresh = None        # The in-flight refresh, shared by concurrent readers
+        self.broadcast = None       # UDP telemetry receiver, if started
+        self.metrics = metrics
+        self.confirmations = tracing.Confirmations()    # Traced commands awaiting their effect
+        self.queue = PathQueue.PathQueue(self)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def connect(self) -> None:
+        """
+        Opens the session and downloads the node network, unless they were given
+        """
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size,
+                                             keepalive_timeout=self.keepalive)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._owns_session = True
+
+        if self.network is not None:
+            return
+        print("Fetching node list...")
+        parser = map_stream.MapStreamParser()
+        started = time.perf_counter()
+        received = 0
+        try:
+            async with self.session.get(self.network_map_endpoint) as resp:
+                if resp.status != 200:
+                    self._observe("networkmap", started, resp.status)
+                    raise AGV.ConnectionException(resp, await resp.text())
+                async for chunk in resp.content.iter_chunked(AGV.MAP_CHUNK_SIZE):
+                    received += len(chunk)
+                    parser.feed(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._observe("networkmap", started, type(e).__name__, received=received)
+            raise
+        self._observe("networkmap", started, received=received)
+        _, nodes, edges = parser.close()
+        print("List aquired. Building network...")
+        self.network = node_network.Network.from_elements(nodes, edges)
+        print("Network built.")
+
+    async def close(self) -> None:
+        """
+        Closes the session and all pooled connections, if this AGV opened them
+        """
+        await self.stop_broadcast()
+        if self.session is not None and self._owns_session:
+            await self.session.close()
+        self.session = None
+
+    def _observe(self, endpoint: str, started: float, status=200, sent: int = 0, received: int = 0) -> None:
+        """
+        Records a request that began at `started` (a `time.perf_counter()` time), if metrics are enabled
+        """
+        if self.metrics is not None:
+            self.metrics.request(endpoint, time.perf_counter() - started, status, sent, received)
+
+    async def _get_json(self, endpoint: str, url: str):
+        """
+        Makes a GET request over the pooled session
+        :param endpoint: The endpoint's name in the metrics
+        :param url: The url to request from
+        :return: The decoded JSON body
+        """
+        started = time.perf_counter()
+        try:
+            async with self.session.get(url) as resp:
+                if resp.status != 200:
+                    self._observe(endpoint, started, resp.status)
+                    raise AGV.ConnectionException(resp, await resp.text())
+                data = await resp.json()
+                # The body is kept after decoding, so reading it again is free
+                self._observe(endpoint, started, received=len(await resp.read()))
+                return data
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._observe(endpoint, started, type(e).__name__)
+            raise
+
+    async def _check_cache(self, force: bool = False):
+        """
+        Returns the current telemetry, refreshing it if the cache has expired.
+        Coroutines that find the cache expired at the same time share one request
+        :param force: If `true`, the cache will refresh regardless of age (Default: False)
+        :return: The `Telemetry` snapshot
+        """
+        if self.cache_valid and not force:
+            # While broadcasts arrive, every snapshot since the last command is current
+            if ((self.broadcast is not None and self.broadcast.alive)
+                    or time.monotonic() - self.cache_time < self.ttl):
+                if self.metrics is not None:
+                    self.metrics.cache(True)
+                return self.cache
+        if self.metrics is not None:
+            self.metrics.cache(False)
+
+        if self._refresh is None:
+            self._refresh = asyncio.ensure_future(self._fetch_variables())
+        refresh = self._refresh
+        try:
+            return await asyncio.shield(refresh)
+        finally:
+            if self._refresh is refresh and refresh.done():
+                self._refresh = None
+
+    async def _fetch_variables(self):
+        """
+        Requests the AGV's current variables and stores them in the cache
+        :return: The `Telemetry` snapshot
+        """
+        requested = time.monotonic()
+        generation = self._generation
+        snapshot = telemetry.Telemetry(await self._get_json("variables", self.variables_endpoint), requested)
+        if self.cache_time is not None and requested < self.cache_time:
+            return snapshot     # A broadcast arrived while the request was in flight
+        self.cache = snapshot
+        self.cache_time = requested
+        # Data requested before the last command must not count as fresh
+        self.cache_valid = generation == self._generation
+        if self.cache_valid:
+            self.stopped = snapshot.paused
+            self.confirmations.update(snapshot)
+        return snapshot
+
+    async def start_broadcast(self,
+                              port: int = broadcast.BROADCAST_PORT,
+                              host: str = "0.0.0.0",
+                              serial: str = None,
+                              timeout: float = 1.0) -> broadcast.BroadcastReceiver:
+        """
+        Starts receiving the AGV's UDP telemetry broadcasts on the running event
+        loop. While they arrive, reads return the latest broadcast instead of
+        making a request. If no packet arrives for `timeout` seconds, reads fall
+        back to requesting `/api/variables`
+        :param port: The port the AGV broadcasts to (Default: `broadcast.BROADCAST_PORT`)
+        :param host: The address to bind to (Default: every interface)
+        :param serial: Only accept packets with this `serialNumber` (Default: every packet)
+        :param timeout: The number of seconds without a packet before falling back
+            to HTTP (Default: 1)
+        :return: The receiver, which counts received and lost packets
+        """
+        if self.broadcast is None:
+            receiver = broadcast.BroadcastReceiver(self._on_broadcast, serial=serial, timeout=timeout)
+            await receiver.listen(host, port)
+            self.broadcast = receiver
+        return self.broadcast
+
+    async def stop_broadcast(self) -> None:
+        """
+        Stops receiving broadcasts
+        """
+        if self.broadcast is not None:
+            self.broadcast.close()
+            self.broadcast = None
+
+    def _on_broadcast(self, snapshot) -> None:
+        """
+        Stores a broadcast snapshot. It was received after any command already
+        sent, so it counts as fresh
+        """
+        self.cache = snapshot
+        self.cache_time = snapshot.timestamp
+        self.cache_valid = True
+        self.stopped = snapshot.paused
+        self.confirmations.update(snapshot)
+
+    async def _send_action(self, name, action_parameters=None):
+        """
+        Sends an action command to the AGV's API
+        :param name: The name of the action
+        :param action_parameters: Any action parameters (if applicable)
+        :return: The decoded JSON response from the API
+        """
+        return await self._send_actions([_build_action(name, action_parameters)])
+
+    async def _send_actions(self, actions: list):
+        """
+        Sends one or more actions to the AGV's API in a single request
+        :param actions: The action dictionaries, as built by `_build_action`
+        :return: The body of the response from the API
+        """
+        # Encoded here rather than by aiohttp, so the size of the body is known
+        body = json.dumps({"instantActions": actions}).encode()
+        headers = {"Content-Type": "application/json"}
+        trace, span = _start_dispatch(actions)
+        if span is not None:
+            headers["traceparent"] = trace.traceparent(span)
+        started = time.perf_counter()
+        try:
+            async with self.session.post(self.actions_endpoint, data=body, headers=headers) as resp:
+                text = await resp.text()
+                received = len(await resp.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._observe("instantActions", started, type(e).__name__, sent=len(body))
+            raise
+        self._observe("instantActions", started, resp.status, sent=len(body), received=received)
+        if resp.status != 200:
+            raise AGV.ConnectionException(resp, text)
+
+        # Invalidate cache. Requests already in flight may predate the command
+        self._generation += 1
+        self.cache_valid = False
+        self._refresh = None
+
+        if trace is not None:
+            trace.end_span(span)
+            self.confirmations.expect(trace, _effect_check(actions))
+
+        return text
+
+    def batch(self) -> ActionBatch:
+        """
+        Starts a batch of actions to be sent in a single request
+        """
+        return ActionBatch(self)
+
+    async def send_batch(self, batch: ActionBatch) -> [ActionHandle]:
+        """
+        Sends a batch of actions in a single request
+        :param batch: The batch of actions
+        :return: The action handles, in the order the actions were added
+        """
+        await self._send_actions(batch.actions)
+        if batch.driving is not None:
+            self.stopped = not batch.driving
+        return list(batch.handles)
+
+    async def get_action_status(self, handle: ActionHandle) -> Optional[str]:
+        """
+        Returns the status the AGV reports for a previously sent action
+        :param handle: The handle returned when the action was sent
+        :return: The upper-case status, or `None` if the AGV has not reported it
+        """
+        return handle.status((await self._check_cache()).action_states)
+
+    async def find_closest_node(self):
+        """
+        Returns the closest node in the network to the AGV's current location
+        """
+        x, y = await self.get_location()
+        return self.network.get_closest_node(x, y)
+
+    # ==================================================================
+    # =================          READING DATA          =================
+    # ==================================================================
+
+    async def get_telemetry(self) -> telemetry.Telemetry:
+        """
+        Returns the current telemetry snapshot, refreshing it if it has expired
+        """
+        return await self._check_cache()
+
+    async def get_data(self, key: str):
+        """
+        Provides direct access to the variable dictionary. See `AGV.get_data`
+        :param key: The key in the dictionary
+        :return: The value at that key
+        """
+        return (await self._check_cache())[key]
+
+    async def get_location(self) -> (float, float):
+        """
+        Returns the x and y location of the AGV at the current time
+        :return: A tuple containing the x and y coordinates of the AGV
+        """
+        snapshot = await self._check_cache()
+        return snapshot.x, snapshot.y
+
+    async def get_last_node(self) -> str:
+        """
+        Returns the ID of the last node the AGV passed through
+        """
+        return (await self._check_cache()).last_node_id
+
+    async def get_theta(self) -> float:
+        """
+        Returns the AGV's theta
+        """
+        return (await self._check_cache()).theta
+
+    async def get_velocity(self) -> (float, float, float):
+        """
+        Returns the AGV's velocity
+        :return: A tuple containing vx, vy and omega
+        """
+        snapshot = await self._check_cache()
+        return snapshot.vx, snapshot.vy, snapshot.omega
+
+    async def get_battery_charge(self) -> float:
+        """
+        Returns the AGV's battery charge in percent
+        """
+        return (await self._check_cache()).battery_charge
+
+    async def is_pin_up(self) -> bool:
+        """
+        Returns `true` if the robot's pin is up
+        """
+        return (await self._check_cache()).pin_up
+
+    async def is_driving(self) -> bool:
+        """
+        Returns `true` if the robot is currently driving
+        """
+        return (await self._check_cache()).driving
+
+    async def is_paused(self) -> bool:
+        """
+        Returns `true` if the AGV reports that it is paused
+        """
+        return (await self._check_cache()).paused
+
+    # ==================================================================
+    # ===============          SENDING COMMANDS          ===============
+    # ==================================================================
+
+    async def go_to_node(self, node_id: str, navigate=None) -> None:
+        """
+        Sends the AGV to a given node. See `AGV.go_to_node`
+        :param node_id: The node for the AGV to travel to
+        :param navigate: Specify whether the AGV should be given custom
+            routing to its target (Default: None)
+        """
+        if navigate is None:
+            navigate = self.navigate
+
+        if navigate:    # A* traversal of NodeNetwork
+            route, path = self.network.plan(await self.get_last_node(), node_id)
+            self.queue.queue_route(route, path)
+            await self.queue.start_async()
+        else:   # SafeLog's built-in pathfinding
+            await self._send_action("goto", action_parameters=[{"key": "end", "value": node_id}])
+
+    async def go_forwards(self):
+        """
+        Makes the robot drive forwards indefinitely
+        """
+        return await self._send_action("DriveForwardsSpeed3")
+
+    async def go_to_coordinate(self, x: float, y: float) -> None:
+        """
+        Instructs the AGV to move from its current position to another position on the grid.
+        :param x: The x coordinate of the AGV's destination
+        :param y: The y coordinate of the AGV's destination
+        """
+        target = self.network.get_closest_node(x, y)
+        await self.go_to_node(target.id)
+
+    async def init_position(self,
+                            x: float,
+                            y: float,
+                            theta: float,
+                            map_id: str,
+                            last_node_id: str):
+        """
+        Initialize the AGV's position. See `AGV.init_position`
+        """
+        action_parameters = [
+            {"key": "x", "value": x},
+            {"key": "y", "value": y},
+            {"key": "theta", "value": theta},
+            {"key": "mapId", "value": map_id},
+            {"key": "lastNodeId", "value": last_node_id}
+        ]
+        return await self._send_action("initposition", action_parameters)
+
+    async def set_pin_up(self, pin_up: bool):
+        """
+        Set whether the pin is up or down
+        :param pin_up: `True` if the pin should be up, `False` if otherwise
+        """
+        command = "MovePinUp" if pin_up else "MovePinDown"
+        return await self._send_action(command)
+
+    async def set_driving(self, driving: bool):
+        """
+        Tells the AGV to either drive or pause
+        :param driving: `True` if the AGV should drive,
+                        `False` if the AGV should pause
+        """
+        command = "Resume" if driving else "Stop"
+        self.stopped = not driving
+        return await self._send_action(command)
+
+    async def rotate_left(self):
+        """
+        Rotates the robot to the left
+        """
+        return await self._send_action("RotateLeft1")
+
+    async def rotate_right(self):
+        """
+        Rotates the robot to the right
+        """
+        return await self._send_action("RotateRight1")
@@ -10,9 +10,11 @@ import asyncio
 import azure.cognitiveservices.speech as speechsdk
 import json
 
+import tracing
 import utils
 
 
+# Named places. A list of nodes means "whichever of these is nearest"
 locations = {
     "rack": "103"
 }
@@ -95,15 +97,18 @@ class LanguageEngine:
     # For example, "https://westus.api.cognitive.microsoft.com/"
     PREDICTION_ENDPOINT = 'https://predicitnlp.cognitiveservices.azure.com/'
 
-    def __init__(self, agv, confidence_threshold=0.5):
+    def __init__(self, agv, confidence_threshold=0.5, tracer=None):
         """
         The class for processing language and listening for a
         :param agv: The object representing the being controlled
         :param confidence_threshold: The threshold of confidence below which a command
             ignored. Goes from 0 to 1, with 1 being completely confident (Default: 0.5)
+        :param tracer: A `tracing.Tracer` that times each command from recognition
+            to its effect on the AGV (Default: None)
         """
         self.loop = asyncio.get_event_loop()
         self.agv = agv
+        self.tracer = tracer
         self.listening = True
         self.confidence_threshold = confidence_threshold
 
@@ -128,11 +133,16 @@ class LanguageEngine:
         Triggers Azure to begin speech recognition. The returned speech will then
         be sent to another thread for processing
         """
-        # Listens to mic input and prints transcription result on screen
-        speech_result = self.speech_recognizer.recognize_once_async().get()
-        print(speech_result.text)
-        # Runs natural language processing on transcription
-        asyncio.run(self.process_speech(speech_result.text))
+        trace = None if self.tracer is None else self.tracer.trace("voice")
+        with tracing.activate(trace):
+            # Listens to mic input and prints transcription result on screen
+            with tracing.span("recognition"):
+                speech_result = self.speech_recognizer.recognize_once_async().get()
+            print(speech_result.text)
+            if trace is not None:
+                trace.attributes["text"] = speech_result.text
+            # Runs natural language processing on transcription
+            await self.process_speech(speech_result.text)
 
     async def process_speech(self, text) -> None:
         """
@@ -151,10 +161,14 @@ class LanguageEngine:
         }
 
         # Make the REST call
-        response, status = await utils.async_get_json(
-            f'{LanguageEngine.PREDICTION_ENDPOINT}luis/prediction/v3.0/apps/{self.app_id}/slots/production/predict',
-            params=params)
-        command = find_prediction(response.json())
+        with tracing.span("prediction"):
+            response, status = await utils.async_get_json(
+                f'{LanguageEngine.PREDICTION_ENDPOINT}luis/prediction/v3.0/apps/{self.app_id}/slots/production/predict',
+                params=params)
+            if response is None:
+                print(f"Prediction failed with status {status}")
+                return
+            command = find_prediction(response)
 
         # Abort if the confidence is too low
         if command.confidence < self.confidence_threshold:
@@ -166,7 +180,12 @@ class LanguageEngine:
             # Move to location
             if command.location:
                 node_id = locations[command.location]
-                self.agv.go_to_node(node_id)
+                if isinstance(node_id, str):
+                    self.agv.go_to_node(node_id)
+                else:
+                    self.agv.go_to_nearest(node_id)
+        elif command.intent == "Stop":
+            self.agv.set_driving(False)
 
     async def start_microphone(self):
         """
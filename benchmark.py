@@ -0,0 +1,352 @@
+"""
+Benchmarks the node network on synthetic SafeLog-style network maps
+
+Usage:
+    python benchmark.py --sizes 1000 10000 --output results.json
+    python benchmark.py --compare results.json
+
+Author: D. William Campman
+Date: 2022-10-09
+"""
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import math
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import node_network
+from compact_network import CompactNetwork
+
+# The port on the far end of an edge leaving through each port
+OPPOSITE_PORTS = {"n": "s", "s": "n", "e": "w", "w": "e"}
+# Grid steps for each port
+PORT_STEPS = {"n": (0, 1), "s": (0, -1), "e": (1, 0), "w": (-1, 0)}
+
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+DEFAULT_KINDS = ("grid", "aisles", "random")
+SPACING = 1000.0    # Distance between neighboring nodes, in map units
+
+
+# ==================================================================
+# =================          MAP GENERATION        =================
+# ==================================================================
+
+def _map_node(node_id: str, x: float, y: float) -> dict:
+    return {"id": node_id, "nodeProperties": {"intelliAgentCore": {"position": {"x": x, "y": y}}}}
+
+
+def _map_edge(source_id: str, target_id: str, port: str) -> dict:
+    return {"source": {"node": source_id, "port": port},
+            "target": {"node": target_id, "port": OPPOSITE_PORTS[port]}}
+
+
+def grid_map(size: int, seed: int = 0) -> dict:
+    """
+    Generates a square grid with every neighbor connected both ways
+    :param size: The approximate number of nodes
+    :param seed: Unused; present so every generator has the same signature
+    :return: A network map in the `/api/networkmap` format
+    """
+    side = max(2, round(math.sqrt(size)))
+    nodes = [_map_node(f"{i}_{j}", i * SPACING, j * SPACING) for i in range(side) for j in range(side)]
+    edges = []
+    for i in range(side):
+        for j in range(side):
+            for port, (di, dj) in PORT_STEPS.items():
+                if 0 <= i + di < side and 0 <= j + dj < side:
+                    edges.append(_map_edge(f"{i}_{j}", f"{i + di}_{j + dj}", port))
+    return {"nodes": nodes, "edges": edges}
+
+
+def aisle_map(size: int, seed: int = 0, aisle_length: int = 50, cross_every: int = 10) -> dict:
+    """
+    Generates a warehouse layout: long one-way aisles of alternating direction,
+    joined by two-way cross aisles at both ends and at regular intervals
+    :param size: The approximate number of nodes
+    :param seed: Unused; present so every generator has the same signature
+    :param aisle_length: The number of nodes along each aisle (Default: 50)
+    :param cross_every: The number of nodes between cross aisles (Default: 10)
+    :return: A network map in the `/api/networkmap` format
+    """
+    aisles = max(2, round(size / aisle_length))
+    nodes = [_map_node(f"{i}_{j}", i * SPACING, j * SPACING)
+             for i in range(aisles) for j in range(aisle_length)]
+    edges = []
+    for i in range(aisles):
+        port = "n" if i % 2 == 0 else "s"
+        for j in range(aisle_length):
+            # Along the aisle, in its direction only
+            dj = PORT_STEPS[port][1]
+            if 0 <= j + dj < aisle_length:
+                edges.append(_map_edge(f"{i}_{j}", f"{i}_{j + dj}", port))
+            # Across the aisles, both ways
+            if j % cross_every == 0 or j == aisle_length - 1:
+                if i + 1 < aisles:
+                    edges.append(_map_edge(f"{i}_{j}", f"{i + 1}_{j}", "e"))
+                if i > 0:
+                    edges.append(_map_edge(f"{i}_{j}", f"{i - 1}_{j}", "w"))
+    return {"nodes": nodes, "edges": edges}
+
+
+def random_map(size: int, seed: int = 0, keep: float = 0.7, jitter: float = 0.3) -> dict:
+    """
+    Generates an irregular network: a grid with jittered positions and a random
+    share of its connections removed
+    :param size: The approximate number of nodes
+    :param seed: The random seed
+    :param keep: The probability each connection is kept (Default: 0.7)
+    :param jitter: How far nodes are moved from the grid, as a share of the spacing (Default: 0.3)
+    :return: A network map in the `/api/networkmap` format
+    """
+    rng = random.Random(seed)
+    side = max(2, round(math.sqrt(size)))
+    nodes = [_map_node(f"{i}_{j}",
+                       (i + rng.uniform(-jitter, jitter)) * SPACING,
+                       (j + rng.uniform(-jitter, jitter)) * SPACING)
+             for i in range(side) for j in range(side)]
+    edges = []
+    for i in range(side):
+        for j in range(side):
+            # Decide each connection once, from its west or south end
+            for port, (di, dj) in (("e", (1, 0)), ("n", (0, 1))):
+                if i + di < side and j + dj < side and rng.random() < keep:
+                    edges.append(_map_edge(f"{i}_{j}", f"{i + di}_{j + dj}", port))
+                    edges.append(_map_edge(f"{i + di}_{j + dj}", f"{i}_{j}", OPPOSITE_PORTS[port]))
+    return {"nodes": nodes, "edges": edges}
+
+
+GENERATORS = {"grid": grid_map, "aisles": aisle_map, "random": random_map}
+
+
+def random_obstacles(network_map: dict, count: int = 10, coverage: float = 0.1,
+                     seed: int = 0) -> [node_network.Rectangle]:
+    """
+    Places rectangular obstacles over a map
+    :param network_map: The map to place them on
+    :param count: The number of obstacles (Default: 10)
+    :param coverage: The share of the map's area the obstacles cover in total (Default: 0.1)
+    :param seed: The random seed
+    :return: The obstacles
+    """
+    rng = random.Random(seed)
+    positions = [node["nodeProperties"]["intelliAgentCore"]["position"] for node in network_map["nodes"]]
+    min_x, max_x = min(p["x"] for p in positions), max(p["x"] for p in positions)
+    min_y, max_y = min(p["y"] for p in positions), max(p["y"] for p in positions)
+    side = math.sqrt(coverage * (max_x - min_x) * (max_y - min_y) / count)
+    obstacles = []
+    for _ in range(count):
+        x = rng.uniform(min_x, max(min_x, max_x - side))
+        y = rng.uniform(min_y, max(min_y, max_y - side))
+        obstacles.append(node_network.Rectangle(x, y, x + side, y + side))
+    return obstacles
+
+
+# ==================================================================
+# =================           MEASUREMENT          =================
+# ==================================================================
+
+def _timed(function, *args):
+    """
+    Runs a function once
+    :return: A tuple of the result and the seconds taken
+    """
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def _build_peak(network_class, network_map, obstacles) -> (int, int):
+    """
+    Builds a network under `tracemalloc`
+    :return: A tuple of the peak bytes allocated during the build and the bytes
+        the finished network holds
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        network = network_class(network_map, obstacles)
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del network
+    return peak, retained
+
+
+def run_case(kind: str, size: int, obstacles: bool, network_class=node_network.Network,
+             queries: int = 1000, routes: int = 20, memory: bool = True, seed: int = 0) -> dict:
+    """
+    Benchmarks one synthetic map
+    :param kind: The map generator, one of `GENERATORS`
+    :param size: The approximate number of nodes
+    :param obstacles: Whether to place obstacles over the map
+    :param network_class: The network implementation to measure (Default: `Network`)
+    :param queries: The number of closest-node queries (Default: 1000)
+    :param routes: The number of routes to search for (Default: 20)
+    :param memory: Whether to measure memory, which needs a second build (Default: True)
+    :param seed: The random seed for the map and the queries (Default: 0)
+    :return: A dictionary of the measurements. Times are in seconds, memory in bytes
+    """
+    rng = random.Random(seed)
+    network_map = GENERATORS[kind](size, seed)
+    rectangles = random_obstacles(network_map, seed=seed) if obstacles else None
+
+    # The constructor reports its progress, which would swamp the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        network, build_time = _timed(network_class, network_map, rectangles)
+        node_ids = list(network.node_dict) if hasattr(network, "node_dict") else list(network.ids)
+
+        xs = [rng.uniform(-SPACING, math.sqrt(size) * SPACING) for _ in range(queries)]
+        ys = [rng.uniform(-SPACING, math.sqrt(size) * SPACING) for _ in range(queries)]
+        started = time.perf_counter()
+        for x, y in zip(xs, ys):
+            network.get_closest_node(x, y)
+        closest_time = time.perf_counter() - started
+
+        pairs = [rng.sample(node_ids, 2) for _ in range(routes)]
+        search_time = collapse_time = navigate_time = 0.0
+        found = lengths = 0
+        for source_id, target_id in pairs:
+            if network_class is CompactNetwork:
+                source, target = network.index_of[source_id], network.index_of[target_id]
+                path, elapsed = _timed(network.find_path, source, target)
+                search_time += elapsed
+                if path is not None:
+                    _, elapsed = _timed(network.collapse_path, source, path[1:])
+                    collapse_time += elapsed
+                _, elapsed = _timed(network.find_route, source_id, target_id)
+            else:
+                source, target = network.get_node(source_id), network.get_node(target_id)
+                path, elapsed = _timed(node_network.find_path, source, target)
+                search_time += elapsed
+                if path is not None:
+                    _, elapsed = _timed(node_network.collapse_path, source, path[1:])
+                    collapse_time += elapsed
+                _, elapsed = _timed(node_network.navigate_between, source, target)
+            navigate_time += elapsed
+            if path is not None:
+                found += 1
+                lengths += len(path)
+
+    result = {
+        "kind": kind,
+        "size": size,
+        "nodes": len(node_ids),
+        "obstacles": obstacles,
+        "network": network_class.__name__,
+        "build_seconds": build_time,
+        "closest_node_us": closest_time / queries * 1e6,
+        "find_path_ms": search_time / routes * 1e3,
+        "collapse_path_ms": collapse_time / max(found, 1) * 1e3,
+        "navigate_ms": navigate_time / routes * 1e3,
+        "routes_found": found,
+        "mean_path_nodes": lengths / max(found, 1),
+    }
+    del network
+    if memory:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result["build_peak_bytes"], result["network_bytes"] = _build_peak(
+                network_class, network_map, rectangles)
+    return result
+
+
+def environment() -> dict:
+    """
+    Describes where the benchmark ran, so results from different versions can be told apart
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def compare(baseline: dict, current: dict, tolerance: float = 0.25) -> list:
+    """
+    Finds measurements that got worse between two benchmark runs
+    :param baseline: The results of the earlier run
+    :param current: The results of the later run
+    :param tolerance: How much slower or larger a measurement may get before it
+        counts as a regression, as a share of the baseline (Default: 0.25)
+    :return: `(case, metric, baseline, current)` tuples, one per regression
+    """
+    def case_key(case):
+        return case["kind"], case["size"], case["obstacles"], case["network"]
+
+    metrics = ("build_seconds", "closest_node_us", "find_path_ms", "collapse_path_ms",
+               "navigate_ms", "build_peak_bytes", "network_bytes")
+    earlier = {case_key(case): case for case in baseline["cases"]}
+    regressions = []
+    for case in current["cases"]:
+        before = earlier.get(case_key(case))
+        if before is None:
+            continue
+        for metric in metrics:
+            if metric in case and metric in before and case[metric] > before[metric] * (1 + tolerance):
+                regressions.append((case_key(case), metric, before[metric], case[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="approximate node counts (default: 1k to 1M)")
+    parser.add_argument("--kinds", nargs="+", choices=GENERATORS, default=DEFAULT_KINDS)
+    parser.add_argument("--compact", action="store_true", help="also benchmark CompactNetwork")
+    parser.add_argument("--queries", type=int, default=1000, help="closest-node queries per map")
+    parser.add_argument("--routes", type=int, default=20, help="route searches per map")
+    parser.add_argument("--no-memory", action="store_true", help="skip the memory measurement")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="report regressions against an earlier results file")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    network_classes = [node_network.Network] + ([CompactNetwork] if args.compact else [])
+    cases = []
+    for kind in args.kinds:
+        for size in args.sizes:
+            for obstacles in (False, True):
+                for network_class in network_classes:
+                    case = run_case(kind, size, obstacles, network_class, args.queries,
+                                    args.routes, not args.no_memory, args.seed)
+                    cases.append(case)
+                    print(f"{kind:>7} {case['nodes']:>8} {'obstacles' if obstacles else '':>9} "
+                          f"{case['network']:>14}  build {case['build_seconds']:8.3f}s  "
+                          f"closest {case['closest_node_us']:8.1f}us  "
+                          f"route {case['navigate_ms']:9.2f}ms  "
+                          f"peak {case.get('build_peak_bytes', 0) / 1e6:8.1f}MB")
+
+    results = {"environment": environment(), "cases": cases}
+    with open(args.output, "w") as fp:
+        json.dump(results, fp, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        regressions = compare(baseline, results, args.tolerance)
+        for case, metric, before, after in regressions:
+            print(f"Regression in {case}: {metric} {before:.4g} -> {after:.4g}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+Receives the telemetry the Safelog AGV broadcasts over UDP, as an alternative
+to polling `/api/variables`
+
+Author: D. William Campman
+Date: 2022-10-11
+"""
+
+import asyncio
+from datetime import datetime
+import json
+import threading
+import time
+
+import telemetry
+
+BROADCAST_PORT = 8900
+
+
+def decode_packet(payload: bytes) -> dict:
+    """
+    Decodes one broadcast packet. The AGV broadcasts the same JSON object
+    that `/api/variables` returns
+    :param payload: The datagram's body
+    :return: The decoded object
+    :raise ValueError: If the packet is not a JSON object
+    """
+    data = json.loads(payload)
+    if not isinstance(data, dict):
+        raise ValueError("Broadcast packet is not a JSON object")
+    return data
+
+
+def _parse_time(value):
+    """
+    Parses a packet's ISO 8601 timestamp, e.g. "2022-10-11T09:30:00.123Z"
+    :return: The time as a `datetime`, or `None` if there is none or it can't be parsed
+    """
+    if not isinstance(value, str):
+        return None
+    if value.endswith(("Z", "z")):
+        value = value[:-1] + "+00:00"
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+class BroadcastReceiver(asyncio.DatagramProtocol):
+
+    SEQUENCE_KEY = "headerId"   # Incremented by the AGV for every message it sends
+    TIMESTAMP_KEY = "timestamp"     # When the AGV sent the message, as an ISO 8601 time
+    RESET_WINDOW = 1000         # A sequence this far behind means the AGV restarted
+
+    def __init__(self, on_snapshot, serial: str = None, timeout: float = 1.0):
+        """
+        A non-blocking receiver for the AGV's telemetry broadcasts. Each packet is
+        decoded into a `Telemetry` snapshot and passed to `on_snapshot`. Packets
+        are ordered by their `headerId` sequence number: gaps are counted as lost,
+        and packets older than the latest one are dropped, so a late packet can
+        never replace newer data. Packets without one are ordered by their
+        `timestamp` instead, without loss accounting, and if they have neither,
+        every packet is accepted as it comes and a warning is printed once
+        :param on_snapshot: Called as `on_snapshot(snapshot)` on the event loop for every accepted packet
+        :param serial: Only accept packets with this `serialNumber`, for when several
+            vehicles broadcast on the same port (Default: every packet)
+        :param timeout: The number of seconds without a packet after which the
+            broadcast counts as stopped (Default: 1)
+        """
+        self.on_snapshot = on_snapshot
+        self.serial = serial
+        self.timeout = timeout
+
+        self.transport = None
+        self.sequence = None        # The sequence number of the latest accepted packet
+        self.sent_time = None       # The `timestamp` of the latest accepted packet, as a `datetime`
+        self.last_time = None       # The `time.monotonic()` time of the latest accepted packet
+        self.received = 0           # Accepted packets
+        self.lost = 0               # Sequence numbers skipped between accepted packets
+        self.late = 0               # Duplicate or out-of-order packets that were dropped
+        self.malformed = 0          # Packets that could not be decoded
+        self.ignored = 0            # Packets from other vehicles
+
+        self._loop = None
+        self._thread = None
+        self._warned = False
+
+    @property
+    def alive(self) -> bool:
+        """
+        `True` if a packet was accepted within the last `timeout` seconds
+        """
+        last_time = self.last_time
+        return last_time is not None and time.monotonic() - last_time < self.timeout
+
+    @property
+    def loss_ratio(self) -> float:
+        """
+        The fraction of the sequence numbers seen so far that never arrived
+        """
+        expected = self.received + self.lost
+        return self.lost / expected if expected else 0.0
+
+    def stats(self) -> dict:
+        """
+        Returns the receiver's counters
+        """
+        return {"received": self.received, "lost": self.lost, "late": self.late,
+                "malformed": self.malformed, "ignored": self.ignored,
+                "loss_ratio": self.loss_ratio, "alive": self.alive}
+
+    # ==================================================================
+    # =================            PROTOCOL            =================
+    # ==================================================================
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def connection_lost(self, exc) -> None:
+        self.transport = None
+
+    def error_received(self, exc) -> None:
+        print(f"Telemetry broadcast error: {exc!r}")
+
+    def datagram_received(self, payload: bytes, addr) -> None:
+        received = time.monotonic()
+        try:
+            data = decode_packet(payload)
+        except ValueError:      # Includes `json.JSONDecodeError` and `UnicodeDecodeError`
+            self.malformed += 1
+            return
+        if self.serial is not None and data.get("serialNumber") != self.serial:
+            self.ignored += 1
+            return
+        if not self._in_order(data):
+            self.late += 1
+            return
+
+        self.received += 1
+        self.last_time = received
+        self.on_snapshot(telemetry.Telemetry(data, received))
+
+    def _in_order(self, data: dict) -> bool:
+        """
+        Checks a packet against the latest one, by its sequence number or else its timestamp
+        :return: `False` if the packet is a duplicate or older than the latest one
+        """
+        sequence = data.get(BroadcastReceiver.SEQUENCE_KEY)
+        if isinstance(sequence, int) and not isinstance(sequence, bool):
+            return self._in_sequence(sequence)
+        sent_time = _parse_time(data.get(BroadcastReceiver.TIMESTAMP_KEY))
+        if sent_time is not None:
+            return self._in_time(sent_time)
+        if not self._warned:
+            self._warned = True
+            print(f"Telemetry broadcast has no '{BroadcastReceiver.SEQUENCE_KEY}' or "
+                  f"'{BroadcastReceiver.TIMESTAMP_KEY}': packets are not ordered and losses are not counted")
+        return True     # Every packet is taken as it comes
+
+    def _in_sequence(self, sequence: int) -> bool:
+        """
+        Checks a packet's sequence number against the latest one, counting any gap as lost
+        :return: `False` if the packet is a duplicate or older than the latest one
+        """
+        previous = self.sequence
+        if previous is not None and sequence <= previous:
+            if previous - sequence < BroadcastReceiver.RESET_WINDOW:
+                return False
+            previous = None     # The AGV restarted and began counting again
+        if previous is not None:
+            self.lost += sequence - previous - 1
+        self.sequence = sequence
+        return True
+
+    def _in_time(self, sent_time: datetime) -> bool:
+        """
+        Checks a packet's timestamp against the latest one's. Gaps can't be told
+        from a slower broadcast, so nothing is counted as lost
+        :return: `False` if the packet was sent no later than the latest one
+        """
+        previous = self.sent_time
+        if previous is not None:
+            try:
+                if sent_time <= previous:
+                    return False
+            except TypeError:       # One had a time zone and the other didn't
+                pass
+        self.sent_time = sent_time
+        return True
+
+    # ==================================================================
+    # =================            LISTENING           =================
+    # ==================================================================
+
+    async def listen(self, host: str = "0.0.0.0", port: int = BROADCAST_PORT) -> None:
+        """
+        Binds the receiver to a UDP port on the running event loop
+        :param host: The address to bind to (Default: every interface)
+        :param port: The port the AGV broadcasts to (Default: `BROADCAST_PORT`)
+        """
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(host, port),
+                                            allow_broadcast=True)
+
+    def close(self) -> None:
+        """
+        Stops receiving. Safe to call from any thread
+        """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = self._thread = None
+        elif self.transport is not None:
+            self.transport.close()
+
+    def listen_in_thread(self, host: str = "0.0.0.0", port: int = BROADCAST_PORT) -> None:
+        """
+        Binds the receiver on an event loop of its own, running on a background
+        thread, for use from synchronous code. `on_snapshot` is called on that thread
+        :param host: The address to bind to (Default: every interface)
+        :param port: The port the AGV broadcasts to (Default: `BROADCAST_PORT`)
+        :raise OSError: If the port cannot be bound
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.listen(host, port))
+        except Exception:
+            loop.close()
+            raise
+        self._loop = loop
+        self._thread = threading.Thread(target=self._run, name="BroadcastReceiver", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        loop = self._loop
+        loop.run_forever()
+        if self.transport is not None:
+            self.transport.close()
+        loop.run_until_complete(asyncio.sleep(0))     # Let the transport finish closing
+        loop.close()
@@ -0,0 +1,598 @@
+"""
+A compact, array-backed alternative to `node_network.Network` for very large maps
+
+Author: D. William Campman
+Date: 2022-10-07
+"""
+
+from array import array
+import heapq
+import itertools
+import math
+from typing import Optional
+
+from node_network import Rectangle, RouteCache, map_elements, repair_route
+from routing_table import RoutingTable
+from spatial_index import SpatialGrid
+from travel_time import TravelModel, find_fastest_path
+
+# Ports are stored as small integer codes
+PORT_NAMES = "nwse"
+PORT_CODES = {name: code for code, name in enumerate(PORT_NAMES)}
+NO_PORT = -1
+
+
+class NodeView:
+    __slots__ = ("network", "index")
+
+    def __init__(self, network, index: int):
+        """
+        A lightweight stand-in for `node_network.Node`, reading its data from
+        the arrays of a `CompactNetwork`. Views are created on demand, so two
+        views of the same node compare equal but are not the same object
+        :param network: The network the node belongs to
+        :param index: The node's integer index in the network
+        """
+        self.network = network
+        self.index = index
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return "{" + self.id + "}"
+
+    def __eq__(self, other):
+        return (isinstance(other, NodeView)
+                and other.network is self.network and other.index == self.index)
+
+    def __hash__(self):
+        return hash((id(self.network), self.index))
+
+    @property
+    def id(self) -> str:
+        return self.network.ids[self.index]
+
+    @property
+    def x(self) -> float:
+        return self.network.xs[self.index]
+
+    @property
+    def y(self) -> float:
+        return self.network.ys[self.index]
+
+    @property
+    def neighbors(self) -> list:
+        return [NodeView(self.network, target) for target in self.network.neighbor_indices(self.index)]
+
+    def _port_neighbor(self, port: str):
+        target = self.network.port_target(self.index, PORT_CODES[port])
+        return None if target is None else NodeView(self.network, target)
+
+    @property
+    def north(self):
+        return self._port_neighbor("n")
+
+    @property
+    def west(self):
+        return self._port_neighbor("w")
+
+    @property
+    def south(self):
+        return self._port_neighbor("s")
+
+    @property
+    def east(self):
+        return self._port_neighbor("e")
+
+    def distance_to(self, node) -> float:
+        """
+        Returns the euclidean distance to another node
+        """
+        return math.hypot(node.x - self.x, node.y - self.y)
+
+    def get_neighbor_port(self, node) -> Optional[str]:
+        """
+        Returns the port where an adjacent node is attached to this node
+        :param node: The adjacent node
+        :return: The name of the port. `None` if node is not adjacent
+        """
+        code = self.network.edge_port(self.index, node.index)
+        return None if code == NO_PORT else PORT_NAMES[code]
+
+
+class CompactNetwork:
+    def __init__(self, network_map: dict, obstacles: [Rectangle] = None):
+        """
+        Represents a network of nodes using flat arrays instead of one Python
+        object per node. Nodes are numbered `0..n-1`; coordinates are stored in
+        `xs` and `ys`, and edges in compressed sparse row (CSR) form: the edges
+        leaving node `i` are `targets[offsets[i]:offsets[i + 1]]`, with their
+        ports in `ports` and their lengths in `lengths`
+        :param network_map: The json dictionary defining all nodes in the network
+        :param obstacles: A list of rectangles defining obstacles the AGV should avoid
+        """
+        nodes, edges = map_elements(network_map)
+        self._build(nodes, edges, obstacles)
+
+    @classmethod
+    def from_elements(cls, nodes, edges, obstacles: [Rectangle] = None):
+        """
+        Builds a network from pre-extracted nodes and edges (see `node_network.map_elements`)
+        :param nodes: An iterable of `(id, x, y)` tuples
+        :param edges: An iterable of `(source_id, target_id, source_port)` tuples
+        :param obstacles: A list of rectangles defining obstacles the AGV should avoid
+        :return: The network
+        """
+        network = cls.__new__(cls)
+        network._build(nodes, edges, obstacles)
+        return network
+
+    def _build(self, nodes, edges, obstacles) -> None:
+        """
+        Fills the arrays from lists of nodes and edges
+        """
+        if obstacles is None:
+            obstacles = []
+
+        self.ids = []
+        self.index_of = {}
+        self.xs = array("d")
+        self.ys = array("d")
+        for node_id, x, y in nodes:
+            # Ignore nodes within obstacles
+            if any(obstacle.contains(x, y) for obstacle in obstacles):
+                continue
+            self.index_of[node_id] = len(self.ids)
+            self.ids.append(node_id)
+            self.xs.append(x)
+            self.ys.append(y)
+        node_count = len(self.ids)
+
+        # Resolve edges, ignoring those to out of bounds nodes
+        resolved = []
+        for source_id, target_id, port in edges:
+            source = self.index_of.get(source_id)
+            target = self.index_of.get(target_id)
+            if source is None or target is None:
+                continue
+            if port not in PORT_CODES:
+                raise ValueError(f"No port with character `{port}`")
+            resolved.append((source, target, PORT_CODES[port]))
+
+        # Count the edges leaving each node, then lay them out by source
+        self.offsets = array("l", bytes(array("l").itemsize * (node_count + 1)))
+        for source, _, _ in resolved:
+            self.offsets[source + 1] += 1
+        for index in range(node_count):
+            self.offsets[index + 1] += self.offsets[index]
+
+        edge_count = len(resolved)
+        self.targets = array("l", bytes(array("l").itemsize * edge_count))
+        self.ports = array("b", bytes(edge_count))
+        self.lengths = array("d", bytes(array("d").itemsize * edge_count))
+        fill = array("l", self.offsets[:-1])
+        xs, ys = self.xs, self.ys
+        for source, target, port in resolved:
+            slot = fill[source]
+            fill[source] += 1
+            self.targets[slot] = target
+            self.ports[slot] = port
+            self.lengths[slot] = math.hypot(xs[target] - xs[source], ys[target] - ys[source])
+
+        # Index node positions for nearest-node queries
+        self.index = SpatialGrid((index, xs[index], ys[index]) for index in range(node_count))
+        self.routing_table = None   # Precomputed routes, see `precompute_routes()`
+
+        # Cached routes are keyed on these versions, so bumping one invalidates them
+        self.map_version = 0
+        self.obstacle_version = 0
+        self.route_cache = RouteCache()
+
+        # Obstacles added at runtime mask nodes and edges (by index) instead of
+        # removing them. Each mask counts the obstacles covering it
+        self.obstacles = []
+        self.blocked_nodes = {}
+        self.blocked_edges = {}
+        self.max_edge_length = max(self.lengths, default=0.0)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def invalidate_routes(self) -> None:
+        """
+        Marks every cached route as stale. Call this after editing the network in place
+        """
+        self.map_version += 1
+        self.route_cache.clear()
+
+    # ==================================================================
+    # =================           NODE ACCESS          =================
+    # ==================================================================
+
+    def get_node(self, node_id) -> NodeView:
+        """
+        Returns the node with the given ID
+        """
+        return NodeView(self, self.index_of[node_id])
+
+    def neighbor_indices(self, index: int):
+        """
+        Returns the indices of the nodes adjacent to a node
+        """
+        return self.targets[self.offsets[index]:self.offsets[index + 1]]
+
+    def port_target(self, index: int, port: int) -> Optional[int]:
+        """
+        Returns the node attached to one of a node's ports
+        :param index: The node's index
+        :param port: The port code (see `PORT_CODES`)
+        :return: The index of the adjacent node, or `None` if the port is unused
+        """
+        for slot in range(self.offsets[index], self.offsets[index + 1]):
+            if self.ports[slot] == port:
+                return self.targets[slot]
+        return None
+
+    def edge_port(self, source: int, target: int) -> int:
+        """
+        Returns the code of the port an edge leaves its source through
+        :return: The port code, or `NO_PORT` if the nodes are not adjacent
+        """
+        for slot in range(self.offsets[source], self.offsets[source + 1]):
+            if self.targets[slot] == target:
+                return self.ports[slot]
+        return NO_PORT
+
+    # ==================================================================
+    # =================       DYNAMIC OBSTACLES        =================
+    # ==================================================================
+
+    def _obstacle_mask(self, obstacle: Rectangle):
+        """
+        Finds the nodes and edges an obstacle covers (see `node_network.Network._obstacle_mask`)
+        :return: A tuple of the covered node indices and `(source, target)` index pairs
+        """
+        margin = self.max_edge_length
+        candidates = self.index.in_rectangle(obstacle.min_x - margin, obstacle.min_y - margin,
+                                             obstacle.max_x + margin, obstacle.max_y + margin)
+        xs, ys = self.xs, self.ys
+        nodes = [index for index, x, y in candidates if obstacle.contains(x, y)]
+        edges = [(index, target)
+                 for index, _, _ in candidates
+                 for target in self.neighbor_indices(index)
+                 if obstacle.intersects_segment(xs[index], ys[index], xs[target], ys[target])]
+        return nodes, edges
+
+    def add_obstacle(self, obstacle: Rectangle) -> [str]:
+        """
+        Blocks a region of the network without rebuilding it
+        :param obstacle: The region the AGV should avoid
+        :return: The IDs of the nodes that became blocked
+        """
+        nodes, edges = self._obstacle_mask(obstacle)
+        newly_blocked = []
+        for index in nodes:
+            count = self.blocked_nodes.get(index, 0)
+            if count == 0:
+                newly_blocked.append(self.ids[index])
+            self.blocked_nodes[index] = count + 1
+        for edge in edges:
+            self.blocked_edges[edge] = self.blocked_edges.get(edge, 0) + 1
+        self.obstacles.append(obstacle)
+        self.obstacle_version += 1
+        self.route_cache.clear()
+        return newly_blocked
+
+    def remove_obstacle(self, obstacle: Rectangle) -> [str]:
+        """
+        Unblocks a region previously passed to `add_obstacle()`
+        :param obstacle: The same rectangle object that was added
+        :return: The IDs of the nodes that are no longer blocked
+        """
+        self.obstacles.remove(obstacle)     # Raises ValueError if it was never added
+        nodes, edges = self._obstacle_mask(obstacle)
+        unblocked = []
+        for index in nodes:
+            self.blocked_nodes[index] -= 1
+            if not self.blocked_nodes[index]:
+                del self.blocked_nodes[index]
+                unblocked.append(self.ids[index])
+        for edge in edges:
+            self.blocked_edges[edge] -= 1
+            if not self.blocked_edges[edge]:
+                del self.blocked_edges[edge]
+        self.obstacle_version += 1
+        self.route_cache.clear()
+        return unblocked
+
+    def is_node_blocked(self, node_id) -> bool:
+        """
+        Returns `True` if a runtime obstacle covers the node
+        """
+        return self.index_of[node_id] in self.blocked_nodes
+
+    def is_edge_blocked(self, source_id, target_id) -> bool:
+        """
+        Returns `True` if a runtime obstacle lies across the edge
+        """
+        return (self.index_of[source_id], self.index_of[target_id]) in self.blocked_edges
+
+    def _route_blocked(self, path: [int]) -> bool:
+        """
+        Checks whether a list of node indices enters a blocked node or uses a blocked edge
+        """
+        if not self.blocked_nodes and not self.blocked_edges:
+            return False
+        return (any(index in self.blocked_nodes for index in path)
+                or any(edge in self.blocked_edges for edge in zip(path, path[1:])))
+
+    def repair_route(self, route: [NodeView], start: int = 0) -> Optional[list]:
+        """
+        Repairs a route around obstacles added since it was planned (see `node_network.repair_route`)
+        """
+        return repair_route(self, route, start)
+
+    # ==================================================================
+    # =================            ROUTING             =================
+    # ==================================================================
+
+    def find_path(self, source: int, target: int) -> Optional[list]:
+        """
+        Finds the shortest path between two nodes using A* (see `node_network.find_path`)
+        :param source: The index of the node to start at
+        :param target: The index of the node to reach
+        :return: The indices of every node along the path, including the source
+            and target. `None` if the target cannot be reached
+        """
+        xs, ys = self.xs, self.ys
+        offsets, targets, lengths = self.offsets, self.targets, self.lengths
+        target_x, target_y = xs[target], ys[target]
+
+        tie_breaker = itertools.count()
+        open_heap = [(math.hypot(xs[source] - target_x, ys[source] - target_y), next(tie_breaker), source)]
+        cost_to = {source: 0.0}
+        parents = {source: -1}
+        closed = set()
+        blocked_nodes, blocked_edges = self.blocked_nodes, self.blocked_edges
+
+        while open_heap:
+            _, _, node = heapq.heappop(open_heap)
+            if node == target:
+                path = []
+                while node != -1:
+                    path.append(node)
+                    node = parents[node]
+                path.reverse()
+                return path
+            if node in closed:
+                continue
+            closed.add(node)
+
+            node_cost = cost_to[node]
+            for slot in range(offsets[node], offsets[node + 1]):
+                neighbor = targets[slot]
+                if neighbor in closed:
+                    continue
+                if blocked_nodes and neighbor in blocked_nodes:
+                    continue
+                if blocked_edges and (node, neighbor) in blocked_edges:
+                    continue
+                cost = node_cost + lengths[slot]
+                if cost < cost_to.get(neighbor, math.inf):
+                    cost_to[neighbor] = cost
+                    parents[neighbor] = node
+                    estimate = cost + math.hypot(xs[neighbor] - target_x, ys[neighbor] - target_y)
+                    heapq.heappush(open_heap, (estimate, next(tie_breaker), neighbor))
+        return None
+
+    def collapse_path(self, source: int, path: [int]) -> [int]:
+        """
+        Removes redundant, collinear nodes from a path (see `node_network.collapse_path`)
+        :param source: The index of the node the path starts from
+        :param path: The indices of the nodes to visit after the source node
+        :return: The indices of the waypoints the AGV needs to be sent to
+        """
+        prev_node = source
+        prev_port = NO_PORT
+        collapsed = []
+        for node in path[:-1]:
+            port = self.edge_port(prev_node, node)
+            if port != prev_port:
+                collapsed.append(node)
+                prev_port = port
+            prev_node = node
+        collapsed.append(path[-1])
+        return collapsed
+
+    def nearest_target(self, source_id, target_ids) -> Optional[tuple]:
+        """
+        Finds the closest of several candidate nodes by route length, in a
+        single Dijkstra pass (see `node_network.Network.nearest_target`)
+        :param source_id: The ID of the node the AGV is currently at
+        :param target_ids: The IDs of the candidate nodes
+        :return: A tuple of the closest target, every node along the route to it
+            (including the source) and the route's length. `None` if no candidate
+            can be reached
+        """
+        # Like `Network.nearest_target`, IDs that are not in the network are skipped
+        index_of = self.index_of
+        targets = {index_of[target_id] for target_id in target_ids
+                   if target_id in index_of} - self.blocked_nodes.keys()
+        table = self.routing_table
+        if (table is not None and not self.blocked_nodes and not self.blocked_edges
+                and targets and all(self.ids[target] in table for target in targets)):
+            best = min((self.ids[target] for target in targets),
+                       key=lambda target_id: table.distance(source_id, target_id))
+            route = self.find_route(source_id, best)
+            if route is None:
+                return None
+            return route[-1], route, table.distance(source_id, best)
+
+        offsets, edge_targets, lengths = self.offsets, self.targets, self.lengths
+        blocked_nodes, blocked_edges = self.blocked_nodes, self.blocked_edges
+        source = self.index_of[source_id]
+        open_heap = [(0.0, source)]
+        cost_to = {source: 0.0}
+        parents = {source: -1}
+        closed = set()
+        while open_heap:
+            cost, node = heapq.heappop(open_heap)
+            if node in closed:
+                continue
+            if node in targets:
+                path = []
+                while node != -1:
+                    path.append(NodeView(self, node))
+                    node = parents[node]
+                path.reverse()
+                return path[-1], path, cost
+            closed.add(node)
+            for slot in range(offsets[node], offsets[node + 1]):
+                neighbor = edge_targets[slot]
+                if neighbor in closed or neighbor in blocked_nodes or (node, neighbor) in blocked_edges:
+                    continue
+                neighbor_cost = cost + lengths[slot]
+                if neighbor_cost < cost_to.get(neighbor, math.inf):
+                    cost_to[neighbor] = neighbor_cost
+                    parents[neighbor] = node
+                    heapq.heappush(open_heap, (neighbor_cost, neighbor))
+        return None
+
+    def edges_from(self, node_id):
+        """
+        Yields the edges leaving a node
+        :return: `(neighbor_id, port, length)` tuples
+        """
+        index = self.index_of[node_id]
+        ids, targets, ports, lengths = self.ids, self.targets, self.ports, self.lengths
+        for slot in range(self.offsets[index], self.offsets[index + 1]):
+            yield ids[targets[slot]], PORT_NAMES[ports[slot]], lengths[slot]
+
+    def navigate(self, source_id, target_id) -> [NodeView]:
+        """
+        Returns the waypoints to move from a source node to a target node
+        :param source_id: The ID of the node the AGV is currently at
+        :param target_id: The ID of the node the AGV is trying to get to
+        :return: An ordered list of nodes to navigate to. Empty if there is no path
+        """
+        return self.plan(source_id, target_id)[1]
+
+    def plan(self, source_id, target_id):
+        """
+        Plans a route between two nodes, using the route cache
+        :param source_id: The ID of the node the AGV is currently at
+        :param target_id: The ID of the node the AGV is trying to get to
+        :return: A tuple of every node along the route (including the source)
+            and the collapsed waypoints. Both are empty if there is no path
+        """
+        key = (source_id, target_id, self.map_version, self.obstacle_version)
+        path = self.route_cache.get(key)
+        if path is None:
+            path = self._find_path_indices(source_id, target_id) or ()
+            self.route_cache.put(key, path)
+        route = [NodeView(self, index) for index in path]
+        return route, self.waypoints(route)
+
+    def waypoints(self, route: [NodeView]) -> [NodeView]:
+        """
+        Collapses a full route into the waypoints the AGV needs to be sent to
+        :param route: Every node along the route, including the source
+        """
+        if len(route) < 2:
+            return list(route)
+        collapsed = self.collapse_path(route[0].index, [node.index for node in route[1:]])
+        return [NodeView(self, index) for index in collapsed]
+
+    def find_route(self, source_id, target_id) -> Optional[list]:
+        """
+        Computes the route between two nodes, bypassing the route cache
+        :return: Every node along the route, including the source and target.
+            `None` if the target cannot be reached
+        """
+        path = self._find_path_indices(source_id, target_id)
+        return None if path is None else [NodeView(self, index) for index in path]
+
+    def _find_path_indices(self, source_id, target_id) -> Optional[list]:
+        """
+        Computes the indices of every node between two nodes
+        """
+        source = self.index_of[source_id]
+        target = self.index_of[target_id]
+        if source == target:
+            return [source]
+        if self.routing_table is not None and target_id in self.routing_table:
+            route = self.routing_table.route(source_id, target_id)
+            if route is None:
+                return None
+            # The table does not know about obstacles, so only trust routes that avoid them
+            path = [self.index_of[node_id] for node_id in route]
+            if not self._route_blocked(path):
+                return path
+        return self.find_path(source, target)
+
+    def plan_fastest(self, source_id, target_id, model: TravelModel, heading: Optional[str] = None):
+        """
+        Plans the quickest route between two nodes, counting the time spent
+        turning as well as driving (see `travel_time.find_fastest_path`)
+        :param source_id: The ID of the node the AGV is currently at
+        :param target_id: The ID of the node the AGV is trying to get to
+        :param model: The speeds and turn penalties to plan with
+        :param heading: The direction the AGV faces, as a port character.
+            `None` if unknown (Default: None)
+        :return: A tuple of every node along the route (including the source),
+            the collapsed waypoints and the estimated duration in seconds. The
+            lists are empty and the duration is `inf` if there is no path
+        """
+        key = (source_id, target_id, self.map_version, self.obstacle_version, model.key(), heading)
+        route = self.route_cache.get(key)
+        if route is None:
+            found = find_fastest_path(self, source_id, target_id, model, heading)
+            route = () if found is None else found[0]
+            self.route_cache.put(key, route)
+        if not route:
+            return [], [], math.inf
+        route = [self.get_node(node_id) for node_id in route]
+        return route, self.waypoints(route), model.duration(self, route, heading)
+
+    def precompute_routes(self, targets=None) -> RoutingTable:
+        """
+        Builds a next-hop table so routes to the given targets are answered by
+        lookup instead of a search (see `routing_table.RoutingTable`)
+        :param targets: The IDs of the nodes to precompute routes to. `None`
+            uses every node (Default: None)
+        :return: The routing table, which `navigate()` now uses
+        """
+        self.routing_table = RoutingTable(self, targets)
+        self.route_cache.clear()
+        return self.routing_table
+
+    # ==================================================================
+    # =================        NEAREST NODES           =================
+    # ==================================================================
+
+    def get_closest_node(self, x: float, y: float) -> Optional[NodeView]:
+        """
+        Returns the closest node to a target position
+        """
+        found = self.index.nearest(x, y)
+        return None if found is None else NodeView(self, found[0])
+
+    def get_closest_nodes(self, x: float, y: float, k: int) -> [NodeView]:
+        """
+        Returns up to `k` nodes closest to a target position, closest first
+        """
+        return [NodeView(self, index) for index, _ in self.index.k_nearest(x, y, k)]
+
+    def get_nodes_within(self, x: float, y: float, radius: float) -> [NodeView]:
+        """
+        Returns every node within a distance of a target position, closest first
+        """
+        return [NodeView(self, index) for index, _ in self.index.within(x, y, radius)]
+
+    def get_closest_node_batch(self, xs, ys) -> [NodeView]:
+        """
+        Returns the closest node to each of several positions
+        """
+        return [None if found is None else NodeView(self, found[0])
+                for found in self.index.nearest_many(xs, ys)]
@@ -0,0 +1,252 @@
+"""
+Controls several Safelog AGVs driving on the same map at once
+
+Author: D. William Campman
+Date: 2022-10-08
+"""
+
+import asyncio
+import time
+from typing import Optional
+
+import aiohttp
+
+from agv import AGV, AsyncAGV
+import node_network
+import PathQueue
+import travel_time
+
+
+class Fleet:
+    def __init__(self,
+                 base_urls: dict,
+                 tick: float = 0.1,
+                 timeout: float = 2.0,
+                 connect_timeout: float = 1.0,
+                 pool_size: int = AGV.DEFAULT_POOL_SIZE,
+                 keepalive: float = 30.0,
+                 network=None,
+                 travel_model: travel_time.TravelModel = None,
+                 **queue_options):
+        """
+        Manages a group of AGVs from a single event loop. Every vehicle shares one
+        HTTP session and one node network, and has its own `PathQueue`. Each
+        control tick polls all vehicles concurrently and then dispatches their
+        next waypoints concurrently, so a tick takes about one round trip no
+        matter how many vehicles there are.
+        Use as an async context manager, or call `connect()` and `close()` manually.
+        :param base_urls: A dictionary mapping each vehicle's name to the base URL
+            of its API, e.g. `{"agv1": "http://10.0.0.11:8080/api/"}`
+        :param tick: The number of seconds between control ticks (Default: 0.1)
+        :param timeout: The total timeout of a request in seconds (Default: 2.0)
+        :param connect_timeout: The timeout for opening a connection in seconds (Default: 1.0)
+        :param pool_size: The maximum number of connections held open to each
+            vehicle (Default: `AGV.DEFAULT_POOL_SIZE`)
+        :param keepalive: The number of seconds an idle connection is kept open (Default: 30)
+        :param network: The node network of the shared map. `None` downloads it
+            from the first vehicle in `connect()` (Default: None)
+        :param travel_model: If given, routes minimize the expected travel time
+            instead of the distance (see `travel_time`) (Default: None)
+        :param queue_options: Keyword arguments passed to each `PathQueue`, e.g. `lookahead`
+        """
+        if not base_urls:
+            raise ValueError("A fleet needs at least one vehicle")
+        self.base_urls = dict(base_urls)
+        self.tick_interval = tick
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.network = network
+        self.travel_model = travel_model
+        self.queue_options = queue_options
+
+        self.session = None     # Created in `connect()`, as it needs a running loop
+        self.vehicles = {}      # Name -> AsyncAGV
+        self.queues = {}        # Name -> PathQueue
+        self.telemetry = {}     # Name -> the latest Telemetry snapshot
+        self.last_tick = None   # The wall time the last tick took, in seconds
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def __len__(self):
+        return len(self.base_urls)
+
+    async def connect(self) -> None:
+        """
+        Opens the shared session, builds the shared network and connects every vehicle
+        """
+        connector = aiohttp.TCPConnector(limit=self.pool_size * len(self.base_urls),
+                                         limit_per_host=self.pool_size,
+                                         keepalive_timeout=self.keepalive)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+        if self.network is None:
+            # All vehicles drive on the same map, so it is only downloaded once
+            first = AsyncAGV(base_url=next(iter(self.base_urls.values())), session=self.session)
+            await first.connect()
+            self.network = first.network
+
+        for name, base_url in self.base_urls.items():
+            vehicle = AsyncAGV(base_url=base_url, ttl=self.tick_interval,
+                               session=self.session, network=self.network)
+            await vehicle.connect()
+            self.vehicles[name] = vehicle
+            self.queues[name] = PathQueue.PathQueue(vehicle, **self.queue_options)
+        print(f"Fleet of {len(self.vehicles)} ready.")
+
+    async def close(self) -> None:
+        """
+        Closes the shared session and all pooled connections
+        """
+        for vehicle in self.vehicles.values():
+            await vehicle.close()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    # ==================================================================
+    # =================          CONTROL LOOP          =================
+    # ==================================================================
+
+    async def _each(self, calls: dict) -> dict:
+        """
+        Awaits one coroutine per vehicle concurrently. A failing vehicle is
+        reported and left out, so it cannot hold up the rest of the fleet
+        :param calls: A dictionary mapping vehicle names to coroutines
+        :return: A dictionary mapping vehicle names to results, for the calls that succeeded
+        """
+        names = list(calls)
+        results = await asyncio.gather(*calls.values(), return_exceptions=True)
+        succeeded = {}
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                print(f"{name}: {result}")
+            else:
+                succeeded[name] = result
+        return succeeded
+
+    async def poll(self) -> dict:
+        """
+        Reads every vehicle's telemetry concurrently
+        :return: A dictionary mapping vehicle names to `Telemetry` snapshots
+        """
+        snapshots = await self._each({name: vehicle.get_telemetry()
+                                      for name, vehicle in self.vehicles.items()})
+        self.telemetry.update(snapshots)
+        return snapshots
+
+    async def tick(self) -> dict:
+        """
+        Runs one control step: polls every vehicle, then sends each vehicle whose
+        waypoint was reached on to its next one
+        :return: A dictionary mapping vehicle names to the waypoint they were sent to
+        """
+        started = time.monotonic()
+        snapshots = await self.poll()
+        dispatch = {}
+        for name, snapshot in snapshots.items():
+            next_node = self.queues[name].advance(snapshot)
+            if next_node is not None:
+                dispatch[name] = next_node
+        await self._each({name: self.vehicles[name].go_to_node(node.id, navigate=False)
+                          for name, node in dispatch.items()})
+        self.last_tick = time.monotonic() - started
+        return dispatch
+
+    def busy(self) -> bool:
+        """
+        Returns `True` while any vehicle still has waypoints to drive
+        """
+        return any(queue.current is not None or queue.node_queue for queue in self.queues.values())
+
+    async def run(self, until_idle: bool = True) -> None:
+        """
+        Runs control ticks at the fleet's tick interval
+        :param until_idle: If `True`, return once no vehicle has waypoints left.
+            Otherwise run until cancelled (Default: True)
+        """
+        while not until_idle or self.busy():
+            started = time.monotonic()
+            await self.tick()
+            await asyncio.sleep(max(0.0, self.tick_interval - (time.monotonic() - started)))
+
+    # ==================================================================
+    # ===============          SENDING COMMANDS          ===============
+    # ==================================================================
+
+    async def send_to(self, name: str, node_id: str) -> Optional[float]:
+        """
+        Plans a route for one vehicle and queues it. The vehicle starts driving
+        on the next tick
+        :param name: The vehicle's name
+        :param node_id: The node for the vehicle to travel to
+        :return: The estimated duration in seconds with a travel model, otherwise
+            `None`. `inf` if the target cannot be reached
+        """
+        vehicle, queue = self.vehicles[name], self.queues[name]
+        snapshot = await vehicle.get_telemetry()
+        if self.travel_model is None:
+            route, waypoints = self.network.plan(snapshot.last_node_id, node_id)
+            duration = None
+        else:
+            route, waypoints, duration = self.network.plan_fastest(
+                snapshot.last_node_id, node_id, self.travel_model,
+                travel_time.heading_from_theta(snapshot.theta))
+        if not route:
+            print(f"{name}: No path found to {node_id}")
+            return duration
+        queue.node_queue = []
+        queue.current = None
+        queue.aborted.clear()
+        queue.completed.clear()
+        queue.rerouted.clear()      # Left over from the previous route
+        queue.queue_route(route, waypoints)
+        await vehicle.set_driving(True)
+        return duration
+
+    async def stop(self, name: str = None) -> None:
+        """
+        Clears the queue of one vehicle, or of every vehicle, and pauses it
+        :param name: The vehicle's name. `None` stops the whole fleet (Default: None)
+        """
+        names = list(self.vehicles) if name is None else [name]
+        for stopped in names:
+            queue = self.queues[stopped]
+            queue.node_queue = []
+            queue.route = None
+            queue.current = None
+            queue.aborted.set()
+        # Any Stop a queue sent itself, e.g. when its target became unreachable, finishes first
+        await self._each({stopped: self.queues[stopped].wait_stopped() for stopped in names})
+        await self._each({stopped: self.vehicles[stopped].set_driving(False) for stopped in names})
+
+    def add_obstacle(self, obstacle: node_network.Rectangle) -> None:
+        """
+        Blocks a region of the shared map and repairs every route passing through it
+        :param obstacle: The region the vehicles should avoid
+        """
+        self.network.add_obstacle(obstacle)
+        self._replan(reroute=False)
+
+    def remove_obstacle(self, obstacle: node_network.Rectangle) -> None:
+        """
+        Unblocks a region passed to `add_obstacle()`, searching every route again
+        :param obstacle: The same rectangle object that was added
+        """
+        self.network.remove_obstacle(obstacle)
+        self._replan(reroute=True)
+
+    def _replan(self, reroute: bool) -> None:
+        """
+        Replans each vehicle's route from the node it last reported
+        """
+        for name, queue in self.queues.items():
+            snapshot = self.telemetry.get(name)
+            if queue.route and snapshot is not None:
+                # A vehicle whose target became unreachable is aborted and paused
+                queue.replan(reroute, snapshot.last_node_id)
@@ -0,0 +1,92 @@
+"""
+Persists the AGV's network map to disk, so the node network can be built
+at startup without waiting for (or even reaching) the AGV
+
+Author: D. William Campman
+Date: 2022-10-06
+"""
+
+import hashlib
+import os
+import pickle
+from typing import Optional
+
+import node_network
+
+
+class MapCache:
+
+    MAGIC = b"AGVMAP"
+    FORMAT_VERSION = 1
+
+    def __init__(self, path: str):
+        """
+        A versioned, content-hashed cache of the network map. Only the node
+        positions and edges are stored, in a compact binary format.
+        :param path: The file the cache is stored in
+        """
+        self.path = path
+
+    @staticmethod
+    def digest(content: bytes) -> str:
+        """
+        Hashes the raw body of a `/api/networkmap` response
+        :param content: The response body
+        :return: The hex digest identifying this version of the map
+        """
+        return hashlib.sha256(content).hexdigest()
+
+    def load(self) -> Optional[tuple]:
+        """
+        Reads the cached map
+        :return: A tuple of the map's digest, node list and edge list (see
+            `node_network.map_elements`), or `None` if there is no usable cache
+        """
+        try:
+            with open(self.path, "rb") as fp:
+                if fp.read(len(MapCache.MAGIC)) != MapCache.MAGIC:
+                    return None
+                version, digest, nodes, edges = pickle.load(fp)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        if version != MapCache.FORMAT_VERSION:
+            return None
+        return digest, nodes, edges
+
+    def load_network(self, obstacles: [node_network.Rectangle] = None, network_class=node_network.Network):
+        """
+        Builds the node network from the cached map
+        :param obstacles: A list of rectangles defining obstacles the AGV should avoid
+        :param network_class: The network implementation to build, e.g.
+            `compact_network.CompactNetwork` (Default: `node_network.Network`)
+        :return: A tuple of the map's digest and the network, or `None` if there
+            is no usable cache
+        """
+        cached = self.load()
+        if cached is None:
+            return None
+        digest, nodes, edges = cached
+        return digest, network_class.from_elements(nodes, edges, obstacles)
+
+    def save(self, digest: str, network_map: dict) -> None:
+        """
+        Replaces the cached map. The file is written under a temporary name and
+        then moved into place, so a crash can never leave a half-written cache
+        :param digest: The digest of the response the map was decoded from
+        :param network_map: The decoded `/api/networkmap` response
+        """
+        self.save_elements(digest, *node_network.map_elements(network_map))
+
+    def save_elements(self, digest: str, nodes, edges) -> None:
+        """
+        Replaces the cached map with pre-extracted nodes and edges (see `save()`)
+        :param digest: The digest of the response the map was decoded from
+        :param nodes: A list of `(id, x, y)` tuples
+        :param edges: A list of `(source_id, target_id, source_port)` tuples
+        """
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as fp:
+            fp.write(MapCache.MAGIC)
+            pickle.dump((MapCache.FORMAT_VERSION, digest, nodes, edges), fp,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.path)
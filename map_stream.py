@@ -0,0 +1,198 @@
+"""
+Decodes the `/api/networkmap` response while it downloads, keeping only the
+parts the node network is built from
+
+Author: D. William Campman
+Date: 2022-10-09
+"""
+
+import codecs
+import hashlib
+import json
+
+# Parser states
+_START, _KEY, _COLON, _VALUE, _ITEM, _ITEM_END, _MEMBER_END, _DONE = range(8)
+_WHITESPACE = " \t\n\r"
+_NUMBER = "0123456789+-.eE"
+
+
+class MapStreamParser:
+    def __init__(self):
+        """
+        An incremental parser for the network map. Feed it the response body in
+        chunks of any size; each node and edge is decoded and reduced to the
+        tuples of `node_network.map_elements` as soon as it is complete, so the
+        full JSON tree never exists in memory. The SHA-256 digest of the body
+        (see `map_cache.MapCache.digest`) is computed along the way
+        """
+        self.nodes = []
+        self.edges = []
+        self._hash = hashlib.sha256()
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._position = 0
+        self._retry_at = 0          # Buffer length at which an incomplete value is retried
+        self._state = _START
+        self._key = None
+        self._closed = False
+
+    def feed(self, chunk: bytes) -> None:
+        """
+        Parses the next part of the response body
+        """
+        self._hash.update(chunk)
+        self._buffer += self._text.decode(chunk)
+        if len(self._buffer) >= self._retry_at:
+            self._advance()
+            # Drop what has been parsed, so the buffer only holds the current element
+            self._buffer = self._buffer[self._position:]
+            self._retry_at -= self._position
+            self._position = 0
+
+    def close(self):
+        """
+        Finishes parsing after the last chunk
+        :return: A tuple of the body's digest, the node list and the edge list
+        :raise ValueError: If the body is not a complete network map
+        """
+        self._buffer += self._text.decode(b"", final=True)
+        self._closed = True
+        self._retry_at = 0
+        self._advance()
+        if self._state != _DONE:
+            raise ValueError("Incomplete network map")
+        return self._hash.hexdigest(), self.nodes, self.edges
+
+    # ==================================================================
+    # =================            PARSING             =================
+    # ==================================================================
+
+    def _peek(self):
+        """
+        Skips whitespace and returns the next character, or `None` if more input is needed
+        """
+        buffer, position = self._buffer, self._position
+        while position < len(buffer) and buffer[position] in _WHITESPACE:
+            position += 1
+        self._position = position
+        return buffer[position] if position < len(buffer) else None
+
+    def _punctuation(self, expected: str):
+        """
+        Consumes one of the expected structural characters
+        :return: The character, or `None` if more input is needed
+        """
+        char = self._peek()
+        if char is None:
+            return None
+        if char not in expected:
+            raise ValueError(f"Unexpected `{char}` in network map, expected one of `{expected}`")
+        self._position += 1
+        return char
+
+    def _value(self):
+        """
+        Decodes one complete JSON value
+        :return: A `(value,)` tuple, or `None` if more input is needed
+        """
+        if self._peek() is None:
+            return None
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._position)
+        except json.JSONDecodeError:
+            if self._closed:
+                raise ValueError("Malformed network map") from None
+            end = None
+        # A number ending at the buffer's end, or at a partial exponent or
+        # fraction, may continue in the next chunk
+        if (end is not None and not self._closed and isinstance(value, (int, float))
+                and (end == len(self._buffer) or self._buffer[end] in _NUMBER)):
+            end = None
+        if end is None:
+            # Wait for the unparsed input to double, so a large value is not re-parsed per chunk
+            self._retry_at = 2 * len(self._buffer) - self._position
+            return None
+        self._position = end
+        return (value,)
+
+    def _advance(self) -> None:
+        """
+        Runs the state machine as far as the buffered input allows
+        """
+        while self._state != _DONE:
+            state = self._state
+            if state == _START:
+                if self._punctuation("{") is None:
+                    return
+                self._state = _KEY
+            elif state == _KEY:
+                if self._peek() == "}":     # Empty map
+                    self._position += 1
+                    self._state = _DONE
+                    continue
+                decoded = self._value()
+                if decoded is None:
+                    return
+                self._key = decoded[0]
+                self._state = _COLON
+            elif state == _COLON:
+                if self._punctuation(":") is None:
+                    return
+                self._state = _VALUE
+            elif state == _VALUE:
+                if self._key in ("nodes", "edges"):
+                    if self._punctuation("[") is None:
+                        return
+                    self._state = _ITEM
+                else:
+                    # Other members are decoded and dropped
+                    if self._value() is None:
+                        return
+                    self._state = _MEMBER_END
+            elif state == _ITEM:
+                if self._peek() == "]":     # Empty list
+                    self._position += 1
+                    self._state = _MEMBER_END
+                    continue
+                decoded = self._value()
+                if decoded is None:
+                    return
+                self._add(decoded[0])
+                self._state = _ITEM_END
+            elif state == _ITEM_END:
+                char = self._punctuation(",]")
+                if char is None:
+                    return
+                self._state = _ITEM if char == "," else _MEMBER_END
+            elif state == _MEMBER_END:
+                char = self._punctuation(",}")
+                if char is None:
+                    return
+                self._state = _KEY if char == "," else _DONE
+
+    def _add(self, element: dict) -> None:
+        """
+        Reduces a decoded node or edge to the tuple the network is built from
+        :raise ValueError: If the element lacks a field the network needs
+        """
+        try:
+            if self._key == "nodes":
+                position = element["nodeProperties"]["intelliAgentCore"]["position"]
+                self.nodes.append((element["id"], position["x"], position["y"]))
+            else:
+                self.edges.append((element["source"]["node"], element["target"]["node"],
+                                   element["source"]["port"]))
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"malformed map element in `{self._key}`: {element!r}") from e
+
+
+def parse_chunks(chunks):
+    """
+    Parses a network map from an iterable of byte chunks, e.g. `Response.iter_content()`
+    :return: A tuple of the body's digest, the node list and the edge list
+    """
+    parser = MapStreamParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
@@ -0,0 +1,226 @@
+"""
+Latency histograms and counters for the AGV's I/O, exportable as Prometheus
+text or JSON
+
+Author: D. William Campman
+Date: 2022-10-12
+"""
+
+import bisect
+import json
+import threading
+
+# Upper bounds of the latency buckets in seconds: 100us to 10s, 8 per decade
+BUCKETS = tuple(round(1e-4 * 10 ** (i / 8), 7) for i in range(41))
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total", "minimum", "maximum")
+
+    def __init__(self):
+        """
+        A fixed-bucket latency histogram. Recording a value is a binary search
+        and an increment, and quantiles are estimated from the buckets the same
+        way Prometheus' `histogram_quantile` does
+        """
+        self.counts = [0] * (len(BUCKETS) + 1)     # The last bucket is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.minimum is None or seconds < self.minimum:
+            self.minimum = seconds
+        if self.maximum is None or seconds > self.maximum:
+            self.maximum = seconds
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates a quantile by interpolating within its bucket
+        :param q: The quantile, between 0 and 1
+        :return: The estimated value in seconds, or `0.0` if nothing was recorded
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = BUCKETS[index - 1] if index else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else self.maximum
+                value = lower + (upper - lower) * (rank - cumulative) / count
+                # The observed extremes are tighter bounds than the bucket's
+                return min(max(value, self.minimum), self.maximum)
+            cumulative += count
+        return self.maximum
+
+    def summary(self) -> dict:
+        summary = {"count": self.count, "sum": self.total,
+                   "min": self.minimum or 0.0, "max": self.maximum or 0.0}
+        for q in QUANTILES:
+            summary[f"p{round(q * 100)}"] = self.quantile(q)
+        return summary
+
+
+def _labels(**labels) -> str:
+    """
+    Formats Prometheus labels, e.g. `{endpoint="variables"}`
+    """
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class Metrics:
+    def __init__(self, prefix: str = "agv"):
+        """
+        Collects request latencies, counts, errors, transferred bytes and cache
+        hits. Safe to share between threads and between vehicles.
+        Instrumented code holds `None` instead of a `Metrics` when collection is
+        off, so the only cost then is one attribute check per call
+        :param prefix: The prefix of the exported metric names (Default: "agv")
+        """
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Clears every metric
+        """
+        with self._lock:
+            self.latencies = {}     # Operation: `Histogram`
+            self.requests = {}      # Endpoint: number of requests
+            self.errors = {}        # (endpoint, status): number of failed requests
+            self.bytes_sent = {}    # Endpoint: request body bytes
+            self.bytes_received = {}    # Endpoint: response body bytes
+            self.cache_hits = 0
+            self.cache_misses = 0
+
+    def observe(self, operation: str, seconds: float) -> None:
+        """
+        Records the duration of an operation that is not a request, e.g. a cache read
+        """
+        with self._lock:
+            self._histogram(operation).observe(seconds)
+
+    def _histogram(self, operation: str) -> Histogram:
+        """
+        Returns an operation's histogram, creating it if needed. Must be called with the lock held
+        """
+        histogram = self.latencies.get(operation)
+        if histogram is None:
+            histogram = self.latencies[operation] = Histogram()
+        return histogram
+
+    def request(self, endpoint: str, seconds: float, status=200, sent: int = 0, received: int = 0) -> None:
+        """
+        Records one request
+        :param endpoint: The endpoint's name, e.g. "variables"
+        :param seconds: How long the request took
+        :param status: The HTTP status, or the name of the exception that ended
+            the request. Anything but 200 counts as an error (Default: 200)
+        :param sent: The size of the request body in bytes (Default: 0)
+        :param received: The size of the response body in bytes (Default: 0)
+        """
+        with self._lock:
+            self._histogram(endpoint).observe(seconds)
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            if status != 200:
+                key = (endpoint, str(status))
+                self.errors[key] = self.errors.get(key, 0) + 1
+            if sent:
+                self.bytes_sent[endpoint] = self.bytes_sent.get(endpoint, 0) + sent
+            if received:
+                self.bytes_received[endpoint] = self.bytes_received.get(endpoint, 0) + received
+
+    def cache(self, hit: bool) -> None:
+        """
+        Records a telemetry read that was served from the cache, or had to wait for a request
+        """
+        with self._lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        reads = self.cache_hits + self.cache_misses
+        return self.cache_hits / reads if reads else 0.0
+
+    # ==================================================================
+    # =================             EXPORT             =================
+    # ==================================================================
+
+    def snapshot(self) -> dict:
+        """
+        Returns every metric as plain values, with p50/p95/p99 latencies
+        """
+        with self._lock:
+            return {
+                "latency": {operation: histogram.summary() for operation, histogram in self.latencies.items()},
+                "requests": dict(self.requests),
+                "errors": {f"{endpoint} {status}": count for (endpoint, status), count in self.errors.items()},
+                "bytes_sent": dict(self.bytes_sent),
+                "bytes_received": dict(self.bytes_received),
+                "cache": {"hits": self.cache_hits, "misses": self.cache_misses,
+                          "hit_ratio": self.cache_hit_ratio},
+            }
+
+    def to_json(self, **kwargs) -> str:
+        """
+        Exports the snapshot as JSON
+        :param kwargs: Keyword arguments passed to `json.dumps`, e.g. `indent`
+        """
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def to_prometheus(self) -> str:
+        """
+        Exports the metrics in the Prometheus text exposition format
+        """
+        prefix = self.prefix
+        lines = []
+
+        def family(name, kind, description):
+            lines.append(f"# HELP {prefix}_{name} {description}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+        with self._lock:
+            family("latency_seconds", "histogram", "Duration of each request or operation")
+            for operation, histogram in sorted(self.latencies.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{prefix}_latency_seconds_bucket"
+                                 f"{_labels(operation=operation, le=f'{bound:g}')} {cumulative}")
+                lines.append(f"{prefix}_latency_seconds_bucket"
+                             f"{_labels(operation=operation, le='+Inf')} {histogram.count}")
+                lines.append(f"{prefix}_latency_seconds_sum{_labels(operation=operation)} {histogram.total!r}")
+                lines.append(f"{prefix}_latency_seconds_count{_labels(operation=operation)} {histogram.count}")
+
+            family("requests_total", "counter", "Requests made to the AGV")
+            for endpoint, count in sorted(self.requests.items()):
+                lines.append(f"{prefix}_requests_total{_labels(endpoint=endpoint)} {count}")
+            family("errors_total", "counter", "Failed requests by status or exception")
+            for (endpoint, status), count in sorted(self.errors.items()):
+                lines.append(f"{prefix}_errors_total{_labels(endpoint=endpoint, status=status)} {count}")
+            family("sent_bytes_total", "counter", "Request body bytes sent")
+            for endpoint, count in sorted(self.bytes_sent.items()):
+                lines.append(f"{prefix}_sent_bytes_total{_labels(endpoint=endpoint)} {count}")
+            family("received_bytes_total", "counter", "Response body bytes received")
+            for endpoint, count in sorted(self.bytes_received.items()):
+                lines.append(f"{prefix}_received_bytes_total{_labels(endpoint=endpoint)} {count}")
+
+            family("cache_hits_total", "counter", "Telemetry reads served from the cache")
+            lines.append(f"{prefix}_cache_hits_total {self.cache_hits}")
+            family("cache_misses_total", "counter", "Telemetry reads that waited for a request")
+            lines.append(f"{prefix}_cache_misses_total {self.cache_misses}")
+            family("cache_hit_ratio", "gauge", "Fraction of telemetry reads served from the cache")
+            lines.append(f"{prefix}_cache_hit_ratio {self.cache_hit_ratio!r}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,380 @@
+"""
+Plans conflict-free, timed routes for several AGVs sharing the node network
+
+Author: D. William Campman
+Date: 2022-10-09
+"""
+
+import heapq
+import itertools
+import math
+import random
+import time
+from typing import Optional
+
+import travel_time
+
+
+class ReservationTable:
+    def __init__(self):
+        """
+        Records which nodes and edges are taken at which time step. Edges are
+        reserved in both directions at once, so two vehicles can never swap
+        places head-on. A parked vehicle holds its node from its arrival onwards
+        """
+        self.nodes = {}         # (node_id, step) -> agent
+        self.edges = {}         # (node_id, node_id, step), IDs sorted -> agent
+        self.parked = {}        # node_id -> (agent, first step)
+        self.last_step = {}     # node_id -> the latest step the node is reserved at
+        self.owned = {}         # agent -> the keys it reserved, for `release()`
+
+    @staticmethod
+    def _edge_key(source_id, target_id, step: int) -> tuple:
+        if target_id < source_id:
+            source_id, target_id = target_id, source_id
+        return source_id, target_id, step
+
+    def node_free(self, node_id, step: int, agent=None) -> bool:
+        """
+        Checks whether a node may be occupied at a time step
+        """
+        parked = self.parked.get(node_id)
+        if parked is not None and parked[0] != agent and parked[1] <= step:
+            return False
+        return self.nodes.get((node_id, step), agent) == agent
+
+    def edge_free(self, source_id, target_id, step: int, agent=None) -> bool:
+        """
+        Checks whether an edge may be driven along during a time step
+        """
+        return self.edges.get(self._edge_key(source_id, target_id, step), agent) == agent
+
+    def can_park(self, node_id, step: int, agent=None) -> bool:
+        """
+        Checks whether a vehicle may stop at a node for good from a time step,
+        which needs every later reservation of the node to belong to it
+        """
+        return self.node_free(node_id, step, agent) and self.last_step.get(node_id, -1) < step
+
+    def reserve(self, agent, steps: list, clearance: int = 0) -> None:
+        """
+        Reserves a timed route
+        :param agent: The vehicle the route belongs to
+        :param steps: The vehicle's `(step, node_id)` positions, one per time step
+        :param clearance: The number of extra steps each node stays reserved
+            after the vehicle leaves it (Default: 0)
+        """
+        owned = self.owned.setdefault(agent, [])
+        for (step, node_id), (next_step, next_id) in zip(steps, steps[1:]):
+            for held in range(step, step + clearance + 1):
+                self._reserve_node(agent, node_id, held, owned)
+            if next_id != node_id:
+                for moving in range(step, next_step):
+                    key = self._edge_key(node_id, next_id, moving)
+                    self.edges[key] = agent
+                    owned.append(("edge", key))
+        last_step, last_id = steps[-1]
+        self._reserve_node(agent, last_id, last_step, owned)
+        self.parked[last_id] = (agent, last_step)
+        owned.append(("parked", last_id))
+
+    def _reserve_node(self, agent, node_id, step: int, owned: list) -> None:
+        self.nodes[(node_id, step)] = agent
+        self.last_step[node_id] = max(self.last_step.get(node_id, -1), step)
+        owned.append(("node", (node_id, step)))
+
+    def release(self, agent) -> None:
+        """
+        Drops every reservation held by a vehicle
+        """
+        for kind, key in self.owned.pop(agent, ()):
+            if kind == "node":
+                if self.nodes.get(key) == agent:
+                    del self.nodes[key]
+            elif kind == "edge":
+                if self.edges.get(key) == agent:
+                    del self.edges[key]
+            elif self.parked.get(key, (None,))[0] == agent:
+                del self.parked[key]
+        # The latest reservations may have gone, so recount them
+        self.last_step = {}
+        for node_id, step in self.nodes:
+            self.last_step[node_id] = max(self.last_step.get(node_id, -1), step)
+
+
+class TimedRoute:
+    def __init__(self, agent, steps: list, step_time: float):
+        """
+        A route with a position for every time step
+        :param agent: The vehicle the route belongs to
+        :param steps: `(step, node_id)` tuples, starting at the vehicle's source.
+            Consecutive entries at the same node are waits
+        :param step_time: The number of seconds in one time step
+        """
+        self.agent = agent
+        self.steps = steps
+        self.step_time = step_time
+
+    def __repr__(self):
+        return f"TimedRoute({self.agent}: {self.nodes})"
+
+    @property
+    def nodes(self) -> list:
+        """
+        The IDs of the nodes along the route, without waits
+        """
+        return [node_id for index, (_, node_id) in enumerate(self.steps)
+                if index == 0 or self.steps[index - 1][1] != node_id]
+
+    @property
+    def start(self) -> float:
+        return self.steps[0][0] * self.step_time
+
+    @property
+    def arrival(self) -> float:
+        """
+        The time the vehicle reaches its target, in seconds
+        """
+        return self.steps[-1][0] * self.step_time
+
+    @property
+    def duration(self) -> float:
+        return self.arrival - self.start
+
+    def dispatches(self) -> list:
+        """
+        Lists when to send the vehicle to each node. A vehicle must not be sent
+        on before the listed time, or it may run into a vehicle it yields to
+        :return: `(seconds, node_id)` tuples, one per move
+        """
+        moves = []
+        for (step, node_id), (_, next_id) in zip(self.steps, self.steps[1:]):
+            if next_id != node_id:
+                moves.append((step * self.step_time, next_id))
+        return moves
+
+
+class MultiAgentPlanner:
+    def __init__(self,
+                 network,
+                 step_time: float = 1.0,
+                 model: travel_time.TravelModel = None,
+                 clearance: int = 0,
+                 horizon: int = 1000):
+        """
+        Plans routes for several vehicles one at a time (prioritized planning).
+        Each route is found with a space-time A* that treats the routes planned
+        before it as moving obstacles (cooperative A*), then reserved, so no two
+        vehicles are ever at the same node or on the same edge at the same time.
+        Vehicles may wait at nodes to let others pass.
+        :param network: A `node_network.Network` or `compact_network.CompactNetwork`.
+            Blocked nodes and edges (see `Network.add_obstacle`) are avoided
+        :param step_time: The number of seconds in one time step (Default: 1)
+        :param model: Provides the driving speed. Edges take a whole number of
+            steps, at least one (Default: `travel_time.TravelModel()`)
+        :param clearance: The number of extra steps a node stays reserved after a
+            vehicle leaves it, as a safety margin (Default: 0)
+        :param horizon: The number of steps past its start a vehicle may take to
+            reach its target before the search gives up (Default: 1000)
+        """
+        self.network = network
+        self.step_time = step_time
+        self.model = travel_time.TravelModel() if model is None else model
+        self.clearance = clearance
+        self.horizon = horizon
+        self.reservations = ReservationTable()
+        self.routes = {}    # agent -> TimedRoute
+
+    def edge_steps(self, length: float) -> int:
+        """
+        Returns the number of time steps an edge of a given length takes
+        """
+        return max(1, math.ceil(self.model.drive_time(length) / self.step_time - 1e-9))
+
+    def plan(self, agent, source_id, target_id, start: float = 0.0) -> Optional[TimedRoute]:
+        """
+        Plans and reserves a route for one vehicle, around every route already
+        planned. Replaces the vehicle's previous route, if it had one
+        :param agent: Any hashable name for the vehicle
+        :param source_id: The ID of the node the vehicle is at
+        :param target_id: The ID of the node the vehicle should reach
+        :param start: The time the vehicle sets off, in seconds (Default: 0)
+        :return: The timed route, or `None` if no conflict-free route was found
+            within the horizon
+        """
+        self.cancel(agent)
+        first_step = math.ceil(start / self.step_time - 1e-9)
+        steps = self._search(agent, source_id, target_id, first_step)
+        if steps is None:
+            return None
+        self.reservations.reserve(agent, steps, self.clearance)
+        route = TimedRoute(agent, steps, self.step_time)
+        self.routes[agent] = route
+        return route
+
+    def plan_all(self, requests, start: float = 0.0) -> dict:
+        """
+        Plans routes for several vehicles in priority order
+        :param requests: `(agent, source_id, target_id)` tuples, highest priority first
+        :param start: The time the vehicles set off, in seconds (Default: 0)
+        :return: A dictionary mapping each agent to its timed route, or `None`
+            where no route was found
+        """
+        return {agent: self.plan(agent, source_id, target_id, start)
+                for agent, source_id, target_id in requests}
+
+    def cancel(self, agent) -> None:
+        """
+        Drops a vehicle's route and frees its reservations
+        """
+        if self.routes.pop(agent, None) is not None:
+            self.reservations.release(agent)
+
+    def _search(self, agent, source_id, target_id, first_step: int) -> Optional[list]:
+        """
+        Runs A* over (node, time step) states
+        :return: The `(step, node_id)` positions, or `None` if there is no route
+        """
+        network, reservations = self.network, self.reservations
+        if not reservations.node_free(source_id, first_step, agent):
+            return None
+        target = network.get_node(target_id)
+        target_x, target_y = target.x, target.y
+        last_step = first_step + self.horizon
+        step_speed = self.model.speed * self.step_time
+
+        def estimate(node_id):
+            node = network.get_node(node_id)
+            return math.hypot(node.x - target_x, node.y - target_y) / step_speed
+
+        tie_breaker = itertools.count()
+        start = (source_id, first_step)
+        open_heap = [(estimate(source_id) + first_step, next(tie_breaker), start)]
+        parents = {start: None}
+
+        while open_heap:
+            _, _, state = heapq.heappop(open_heap)
+            node_id, step = state
+            if node_id == target_id and reservations.can_park(node_id, step, agent):
+                path = []
+                while state is not None:
+                    path.append((state[1], state[0]))
+                    state = parents[state]
+                path.reverse()
+                return path
+            if step >= last_step:
+                continue
+
+            # Waiting in place
+            successors = [(node_id, step + 1, 0)]
+            for neighbor_id, _, length in network.edges_from(node_id):
+                if network.is_node_blocked(neighbor_id) or network.is_edge_blocked(node_id, neighbor_id):
+                    continue
+                successors.append((neighbor_id, step + self.edge_steps(length), length))
+
+            for next_id, next_step, _ in successors:
+                next_state = (next_id, next_step)
+                if next_state in parents or next_step > last_step:
+                    continue
+                if not self._move_free(agent, node_id, next_id, step, next_step):
+                    continue
+                parents[next_state] = state
+                heapq.heappush(open_heap, (next_step + estimate(next_id), next(tie_breaker), next_state))
+        return None
+
+    def _move_free(self, agent, node_id, next_id, step: int, next_step: int) -> bool:
+        """
+        Checks a wait or a move against the reservation table, including the
+        clearance the vehicle leaves behind at the node it departs from
+        """
+        reservations = self.reservations
+        if not reservations.node_free(next_id, next_step, agent):
+            return False
+        for held in range(step + 1, step + self.clearance + 1):
+            if not reservations.node_free(node_id, held, agent):
+                return False
+        if next_id == node_id:
+            return True
+        return all(reservations.edge_free(node_id, next_id, moving, agent)
+                   for moving in range(step, next_step))
+
+
+def find_conflicts(routes) -> list:
+    """
+    Checks timed routes against each other
+    :param routes: An iterable of `TimedRoute`s
+    :return: `(step, description)` tuples for every node or edge two vehicles share
+    """
+    routes = list(routes)
+    nodes = {}
+    edges = {}
+    conflicts = []
+    # Vehicles stay at their targets once they arrive
+    parked = {route.steps[-1][1]: (route.agent, route.steps[-1][0]) for route in routes}
+    for route in routes:
+        for index, (step, node_id) in enumerate(route.steps):
+            other = nodes.setdefault((node_id, step), route.agent)
+            if other != route.agent:
+                conflicts.append((step, f"{other} and {route.agent} at {node_id}"))
+            parked_agent, parked_step = parked.get(node_id, (route.agent, 0))
+            if parked_agent != route.agent and step >= parked_step:
+                conflicts.append((step, f"{route.agent} runs into {parked_agent} parked at {node_id}"))
+            if index + 1 < len(route.steps):
+                next_step, next_id = route.steps[index + 1]
+                if next_id == node_id:
+                    continue
+                for moving in range(step, next_step):
+                    key = ReservationTable._edge_key(node_id, next_id, moving)
+                    other = edges.setdefault(key, route.agent)
+                    if other != route.agent:
+                        conflicts.append((moving, f"{other} and {route.agent} on {key[:2]}"))
+    return conflicts
+
+
+def benchmark(network, agent_counts=(1, 2, 4, 8, 16, 32), seed: int = 0, **planner_options) -> list:
+    """
+    Measures how planning time grows with the number of vehicles. Each round
+    plans every vehicle between random, distinct nodes
+    :param network: The network to plan on
+    :param agent_counts: The fleet sizes to try (Default: 1 to 32)
+    :param seed: The random seed for picking sources and targets (Default: 0)
+    :param planner_options: Keyword arguments passed to `MultiAgentPlanner`
+    :return: One dictionary per fleet size, with the time taken, the planning
+        throughput, the number of vehicles without a route, and the conflicts found
+    """
+    rng = random.Random(seed)
+    node_ids = list(network.node_dict) if hasattr(network, "node_dict") else list(network.ids)
+    results = []
+    for count in agent_counts:
+        if 2 * count > len(node_ids):
+            break
+        chosen = rng.sample(node_ids, 2 * count)
+        requests = [(agent, chosen[agent], chosen[count + agent]) for agent in range(count)]
+        planner = MultiAgentPlanner(network, **planner_options)
+        started = time.perf_counter()
+        routes = planner.plan_all(requests)
+        elapsed = time.perf_counter() - started
+        planned = [route for route in routes.values() if route is not None]
+        results.append({
+            "agents": count,
+            "seconds": elapsed,
+            "plans_per_second": count / elapsed if elapsed else math.inf,
+            "failed": count - len(planned),
+            "conflicts": len(find_conflicts(planned)),
+            "makespan": max((route.arrival for route in planned), default=0.0),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+
+    from map_cache import MapCache
+
+    cached = MapCache(sys.argv[1] if len(sys.argv) > 1 else "networkmap.cache").load_network()
+    if cached is None:
+        sys.exit("No cached network map. Run the AGV controller once to create it.")
+    print(f"{'Agents':>6} {'Seconds':>9} {'Plans/s':>9} {'Failed':>6} {'Conflicts':>9} {'Makespan':>9}")
+    for row in benchmark(cached[1]):
+        print(f"{row['agents']:>6} {row['seconds']:>9.4f} {row['plans_per_second']:>9.1f} "
+              f"{row['failed']:>6} {row['conflicts']:>9} {row['makespan']:>9.1f}")
@@ -4,9 +4,17 @@ This class represents the network of nodes the Safeloc AGV can drive along
 Author: D. William Campman
 Date: 2022-10-05
 """
+from collections import OrderedDict
+import heapq
+import itertools
 import math
+import threading
 from typing import Optional
 
+from routing_table import RoutingTable
+from spatial_index import SpatialGrid
+from travel_time import TravelModel, find_fastest_path
+
 
 class Node:
     def __init__(self,
@@ -75,7 +83,7 @@ class Node:
         if port == "w":
             self.west = node
         elif port == "e":
-            self.west = node
+            self.east = node
         elif port == "n":
             self.north = node
         elif port == "s":
@@ -108,6 +116,156 @@ class Rectangle:
         """
         return (self.min_x < x < self.max_x) and (self.min_y < y < self.max_y)
 
+    def intersects_segment(self, x1, y1, x2, y2):
+        """
+        Checks if a line segment passes through this region
+        :param x1: The x position of the segment's start
+        :param y1: The y position of the segment's start
+        :param x2: The x position of the segment's end
+        :param y2: The y position of the segment's end
+        :return: Returns `True` if any part of the segment is within the defined region
+        """
+        # Clip the segment's parameter range against each slab (Liang-Barsky)
+        low, high = 0.0, 1.0
+        for start, delta, minimum, maximum in ((x1, x2 - x1, self.min_x, self.max_x),
+                                               (y1, y2 - y1, self.min_y, self.max_y)):
+            if delta == 0:
+                if not minimum < start < maximum:
+                    return False
+                continue
+            t1 = (minimum - start) / delta
+            t2 = (maximum - start) / delta
+            low = max(low, min(t1, t2))
+            high = min(high, max(t1, t2))
+            if low >= high:
+                return False
+        return True
+
+
+def find_path(source_node: Node,
+              target_node: Node,
+              blocked_nodes=None,
+              blocked_edges=None) -> Optional[list]:
+    """
+    Finds the shortest path between two nodes using A*, weighting each edge
+    by its euclidean length. Parent pointers are stored instead of copying
+    partial paths, so memory stays proportional to the number of nodes visited
+    :param source_node: The node to start at
+    :param target_node: The node to reach
+    :param blocked_nodes: A collection of node IDs the path may not enter (Default: None)
+    :param blocked_edges: A collection of `(source_id, target_id)` edges the
+        path may not use (Default: None)
+    :return: Every node along the path, including the source and target.
+        `None` if the target cannot be reached
+    """
+    tie_breaker = itertools.count()     # Keeps the heap from ever comparing nodes
+    open_heap = [(source_node.distance_to(target_node), next(tie_breaker), source_node)]
+    cost_to = {source_node: 0.0}
+    parents = {source_node: None}
+    closed = set()
+
+    while open_heap:
+        _, _, node = heapq.heappop(open_heap)
+        if node is target_node:
+            # Walk the parent pointers back to the source
+            path = []
+            while node is not None:
+                path.append(node)
+                node = parents[node]
+            path.reverse()
+            return path
+        if node in closed:
+            continue
+        closed.add(node)
+
+        node_cost = cost_to[node]
+        for neighbor in node.neighbors:
+            if neighbor in closed:
+                continue
+            if blocked_nodes and neighbor.id in blocked_nodes:
+                continue
+            if blocked_edges and (node.id, neighbor.id) in blocked_edges:
+                continue
+            cost = node_cost + node.distance_to(neighbor)
+            if cost < cost_to.get(neighbor, math.inf):
+                cost_to[neighbor] = cost
+                parents[neighbor] = node
+                heapq.heappush(open_heap,
+                               (cost + neighbor.distance_to(target_node), next(tie_breaker), neighbor))
+    return None
+
+
+def find_nearest_target(source_node: Node,
+                        target_ids,
+                        blocked_nodes=None,
+                        blocked_edges=None) -> Optional[tuple]:
+    """
+    Finds the closest of several targets by route length, in a single Dijkstra
+    pass that stops at the first target it settles
+    :param source_node: The node to start at
+    :param target_ids: A collection of candidate node IDs
+    :param blocked_nodes: A collection of node IDs the path may not enter (Default: None)
+    :param blocked_edges: A collection of `(source_id, target_id)` edges the
+        path may not use (Default: None)
+    :return: A tuple of the closest target, every node along the path to it
+        (including the source and target) and the path's length. `None` if no
+        target can be reached
+    """
+    target_ids = set(target_ids)
+    tie_breaker = itertools.count()
+    open_heap = [(0.0, next(tie_breaker), source_node)]
+    cost_to = {source_node: 0.0}
+    parents = {source_node: None}
+    closed = set()
+
+    while open_heap:
+        cost, _, node = heapq.heappop(open_heap)
+        if node in closed:
+            continue
+        if node.id in target_ids:
+            path = []
+            while node is not None:
+                path.append(node)
+                node = parents[node]
+            path.reverse()
+            return path[-1], path, cost
+        closed.add(node)
+
+        for neighbor in node.neighbors:
+            if neighbor in closed:
+                continue
+            if blocked_nodes and neighbor.id in blocked_nodes:
+                continue
+            if blocked_edges and (node.id, neighbor.id) in blocked_edges:
+                continue
+            neighbor_cost = cost + node.distance_to(neighbor)
+            if neighbor_cost < cost_to.get(neighbor, math.inf):
+                cost_to[neighbor] = neighbor_cost
+                parents[neighbor] = node
+                heapq.heappush(open_heap, (neighbor_cost, next(tie_breaker), neighbor))
+    return None
+
+
+def collapse_path(source_node: Node, path: [Node]) -> [Node]:
+    """
+    Removes redundant, collinear nodes from a path
+    :param source_node: The node the path starts from
+    :param path: The nodes to visit after the source node
+    :return: The waypoints the AGV needs to be sent to
+    """
+    prev_node = source_node
+    prev_port = prev_node.get_neighbor_port(source_node)
+    collapsed = []
+    for node in path[:-1]:
+        port = prev_node.get_neighbor_port(node)
+        if port != prev_port:
+            collapsed.append(node)
+            prev_port = port
+        prev_node = node
+    # Make sure ending node is in collapsed path
+    collapsed.append(path[-1])
+    return collapsed
+
 
 def navigate_between(source_node: Node, target_node: Node):
     """
@@ -117,49 +275,141 @@ def navigate_between(source_node: Node, target_node: Node):
     :return: And ordered list of nodes to navigate to
     """
     print("pathing...")
-    path_list = [[source_node]]
-    path_index = 0
-    # To keep track of previously visited nodes
-    previous_nodes = {source_node}
     if source_node.id == target_node.id:
-        return path_list[0]
-
-    while path_index < len(path_list):
-        current_path = path_list[path_index]
-        last_node = current_path[-1]
-        next_nodes = last_node.neighbors
-        # Search goal node
-        if target_node in next_nodes:
-            current_path.append(target_node)
-            current_path = current_path[1:]     # Remove source node
-            # Collapse path (remove redundant, collinear nodes from the path)
-            prev_node = source_node
-            prev_port = prev_node.get_neighbor_port(source_node)
-            print(f"Pre-collapse: {current_path}")
-            collapsed = []
-            for node in current_path[:-1]:
-                port = prev_node.get_neighbor_port(node)
-                if port != prev_port:
-                    collapsed.append(node)
-                    prev_port = port
-                prev_node = node
-            # Make sure ending node is in collapsed path
-            collapsed.append(current_path[-1])
-            print(f"Collapsed path: {collapsed}")
-            return collapsed
-        # Add new paths
-        for next_node in next_nodes:
-            if next_node not in previous_nodes:
-                new_path = list(current_path)
-                new_path.append(next_node)
-                path_list.append(new_path)
-                # To avoid backtracking
-                previous_nodes.add(next_node)
-        # Continue to next path in list
-        path_index += 1
-    # No path is found
-    print("No path found")
-    return []
+        return [source_node]
+
+    path = find_path(source_node, target_node)
+    if path is None:
+        # No path is found
+        print("No path found")
+        return []
+
+    path = path[1:]     # Remove source node
+    print(f"Pre-collapse: {path}")
+    collapsed = collapse_path(source_node, path)
+    print(f"Collapsed path: {collapsed}")
+    return collapsed
+
+
+def repair_route(network, route: list, start: int = 0) -> Optional[list]:
+    """
+    Repairs a route after obstacles were added, changing only the blocked
+    stretches. Each blocked stretch is replaced by a short detour to the first
+    usable node after it, so the search stays local instead of re-routing to
+    the final target. Works with any network providing `is_node_blocked`,
+    `is_edge_blocked` and `find_route`
+    :param network: The network the route runs through
+    :param route: Every node along the route
+    :param start: The index of the node the AGV is at; earlier nodes are kept as is
+    :return: The repaired route (the same list if nothing was blocked), or
+        `None` if the target can no longer be reached
+    """
+    index = start
+    while True:
+        # Find the first hop that enters a blocked node or uses a blocked edge
+        broken = None
+        for position in range(index, len(route) - 1):
+            if (network.is_edge_blocked(route[position].id, route[position + 1].id)
+                    or network.is_node_blocked(route[position + 1].id)):
+                broken = position
+                break
+        if broken is None:
+            return route
+
+        # Rejoin the route at the first usable node past the blockage
+        rejoin = broken + 1
+        while rejoin < len(route) and network.is_node_blocked(route[rejoin].id):
+            rejoin += 1
+        if rejoin == len(route):    # The target itself is blocked
+            return None
+        detour = network.find_route(route[broken].id, route[rejoin].id)
+        if detour is None:
+            # No local detour, so fall back to re-routing to the target
+            detour = network.find_route(route[broken].id, route[-1].id)
+            return None if detour is None else route[:broken] + detour
+        route = route[:broken] + detour + route[rejoin + 1:]
+        index = broken + len(detour) - 1
+
+
+class RouteCache:
+    def __init__(self, max_size: int = 256):
+        """
+        A bounded, least-recently-used cache of computed routes. Keys should
+        include everything a route depends on (see `Network.navigate`), so
+        changing the map or obstacles can never return a stale route
+        :param max_size: The maximum number of routes kept (Default: 256)
+        """
+        self.max_size = max_size
+        self.routes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.routes)
+
+    def get(self, key) -> Optional[tuple]:
+        """
+        Looks up a route, marking it as recently used
+        :return: The cached route, or `None` on a miss
+        """
+        with self._lock:
+            route = self.routes.get(key)
+            if route is None:
+                self.misses += 1
+                return None
+            self.routes.move_to_end(key)
+            self.hits += 1
+            return route
+
+    def put(self, key, route) -> None:
+        """
+        Stores a route, evicting the least recently used one if the cache is full
+        """
+        with self._lock:
+            self.routes[key] = tuple(route)
+            self.routes.move_to_end(key)
+            while len(self.routes) > self.max_size:
+                self.routes.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        Drops every cached route. The counters are kept
+        """
+        with self._lock:
+            self.routes.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the cache's counters
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.routes),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+def map_elements(network_map: dict):
+    """
+    Extracts the parts of a network map that the network is built from
+    :param network_map: The json dictionary defining all nodes in the network
+    :return: A tuple of the node list, as `(id, x, y)` tuples, and the edge
+        list, as `(source_id, target_id, source_port)` tuples
+    """
+    nodes = []
+    for node in network_map["nodes"]:
+        position = node["nodeProperties"]["intelliAgentCore"]["position"]
+        nodes.append((node["id"], position["x"], position["y"]))
+    edges = [(edge["source"]["node"], edge["target"]["node"], edge["source"]["port"])
+             for edge in network_map["edges"]]
+    return nodes, edges
 
 
 class Network:
@@ -170,45 +420,299 @@ class Network:
         :param obstacles: A list of rectangles defining obstacles the AGV should avoid
         """
         print("building network...")
+        nodes, edges = map_elements(network_map)
+        self._build(nodes, edges, obstacles)
+
+    @classmethod
+    def from_elements(cls, nodes, edges, obstacles: [Rectangle] = None):
+        """
+        Builds a network from pre-extracted nodes and edges (see `map_elements`)
+        :param nodes: An iterable of `(id, x, y)` tuples
+        :param edges: An iterable of `(source_id, target_id, source_port)` tuples
+        :param obstacles: A list of rectangles defining obstacles the AGV should avoid
+        :return: The network
+        """
+        network = cls.__new__(cls)
+        network._build(nodes, edges, obstacles)
+        return network
+
+    def _build(self, nodes, edges, obstacles) -> None:
+        """
+        Adds every node and edge to an empty network
+        """
         self.node_dict = {}
         if obstacles is None:
             obstacles = []
 
         # Generate all empty nodes
         print("Adding nodes...")
-        for node in network_map["nodes"]:
-            position = node["nodeProperties"]["intelliAgentCore"]["position"]
-
+        for node_id, x, y in nodes:
             # Ignore nodes within obstacles
             out_of_bounds = False
             for obstacle in obstacles:
-                if obstacle.contains(position["x"], position["y"]):
+                if obstacle.contains(x, y):
                     out_of_bounds = True
                     break
             if out_of_bounds:
                 continue
 
-            self.node_dict[node["id"]] = Node(node["id"], position["x"], position["y"])
+            self.node_dict[node_id] = Node(node_id, x, y)
 
         print("Setting neighbors...")
         # Create node edges
-        for edge in network_map["edges"]:
-            source_id = edge["source"]["node"]
-            target_id = edge["target"]["node"]
+        for source_id, target_id, port in edges:
             # Ignore edges to out of bounds nodes
             if source_id not in self.node_dict or target_id not in self.node_dict:
                 continue
             source_node = self.node_dict[source_id]
             target_node = self.node_dict[target_id]
-            port = edge["source"]["port"]
             source_node.set_neighbor(target_node, port)
 
+        # Index node positions for nearest-node queries
+        self.index = SpatialGrid((node, node.x, node.y) for node in self.node_dict.values())
+        self.routing_table = None   # Precomputed routes, see `precompute_routes()`
+
+        # Cached routes are keyed on these versions, so bumping one invalidates them
+        self.map_version = 0
+        self.obstacle_version = 0
+        self.route_cache = RouteCache()
+
+        # Obstacles added at runtime mask nodes and edges instead of removing them.
+        # Each mask counts the obstacles covering it, so obstacles may overlap
+        self.obstacles = []
+        self.blocked_nodes = {}
+        self.blocked_edges = {}
+        self.max_edge_length = max((node.distance_to(neighbor)
+                                    for node in self.node_dict.values()
+                                    for neighbor in node.neighbors), default=0.0)
+
+    def invalidate_routes(self) -> None:
+        """
+        Marks every cached route as stale. Call this after editing the network in place
+        """
+        self.map_version += 1
+        self.route_cache.clear()
+
+    # ==================================================================
+    # =================       DYNAMIC OBSTACLES        =================
+    # ==================================================================
+
+    def _obstacle_mask(self, obstacle: Rectangle):
+        """
+        Finds the nodes and edges an obstacle covers. Only nodes within one edge
+        length of the obstacle can have an edge through it, so the spatial index
+        narrows the search to those
+        :return: A tuple of the covered node IDs and `(source_id, target_id)` edges
+        """
+        margin = self.max_edge_length
+        candidates = self.index.in_rectangle(obstacle.min_x - margin, obstacle.min_y - margin,
+                                             obstacle.max_x + margin, obstacle.max_y + margin)
+        nodes = [node.id for node, x, y in candidates if obstacle.contains(x, y)]
+        edges = [(node.id, neighbor.id)
+                 for node, _, _ in candidates
+                 for neighbor in node.neighbors
+                 if obstacle.intersects_segment(node.x, node.y, neighbor.x, neighbor.y)]
+        return nodes, edges
+
+    def add_obstacle(self, obstacle: Rectangle) -> [str]:
+        """
+        Blocks a region of the network without rebuilding it
+        :param obstacle: The region the AGV should avoid
+        :return: The IDs of the nodes that became blocked
+        """
+        nodes, edges = self._obstacle_mask(obstacle)
+        newly_blocked = []
+        for node_id in nodes:
+            count = self.blocked_nodes.get(node_id, 0)
+            if count == 0:
+                newly_blocked.append(node_id)
+            self.blocked_nodes[node_id] = count + 1
+        for edge in edges:
+            self.blocked_edges[edge] = self.blocked_edges.get(edge, 0) + 1
+        self.obstacles.append(obstacle)
+        self.obstacle_version += 1
+        self.route_cache.clear()
+        return newly_blocked
+
+    def remove_obstacle(self, obstacle: Rectangle) -> [str]:
+        """
+        Unblocks a region previously passed to `add_obstacle()`
+        :param obstacle: The same rectangle object that was added
+        :return: The IDs of the nodes that are no longer blocked
+        """
+        self.obstacles.remove(obstacle)     # Raises ValueError if it was never added
+        nodes, edges = self._obstacle_mask(obstacle)
+        unblocked = []
+        for node_id in nodes:
+            self.blocked_nodes[node_id] -= 1
+            if not self.blocked_nodes[node_id]:
+                del self.blocked_nodes[node_id]
+                unblocked.append(node_id)
+        for edge in edges:
+            self.blocked_edges[edge] -= 1
+            if not self.blocked_edges[edge]:
+                del self.blocked_edges[edge]
+        self.obstacle_version += 1
+        self.route_cache.clear()
+        return unblocked
+
+    def is_node_blocked(self, node_id) -> bool:
+        """
+        Returns `True` if a runtime obstacle covers the node
+        """
+        return node_id in self.blocked_nodes
+
+    def is_edge_blocked(self, source_id, target_id) -> bool:
+        """
+        Returns `True` if a runtime obstacle lies across the edge
+        """
+        return (source_id, target_id) in self.blocked_edges
+
+    def _route_blocked(self, route_ids) -> bool:
+        """
+        Checks whether a list of node IDs enters a blocked node or uses a blocked edge
+        """
+        if not self.blocked_nodes and not self.blocked_edges:
+            return False
+        return (any(node_id in self.blocked_nodes for node_id in route_ids)
+                or any(edge in self.blocked_edges for edge in zip(route_ids, route_ids[1:])))
+
+    def repair_route(self, route: [Node], start: int = 0) -> Optional[list]:
+        """
+        Repairs a route around obstacles added since it was planned (see `repair_route`)
+        """
+        return repair_route(self, route, start)
+
+    # ==================================================================
+    # =================            ROUTING             =================
+    # ==================================================================
+
     def get_node(self, node_id):
         """
         Returns the node with the given ID
         """
         return self.node_dict[node_id]
 
+    def nearest_target(self, source_id, target_ids) -> Optional[tuple]:
+        """
+        Finds the closest of several candidate nodes (e.g. free chargers) by route
+        length, without searching for a route to each one
+        :param source_id: The ID of the node the AGV is currently at
+        :param target_ids: The IDs of the candidate nodes
+        :return: A tuple of the closest target, every node along the route to it
+            (including the source) and the route's length. `None` if no candidate
+            can be reached
+        """
+        target_ids = [target_id for target_id in target_ids if not self.is_node_blocked(target_id)]
+        table = self.routing_table
+        if (table is not None and not self.blocked_nodes and not self.blocked_edges
+                and target_ids and all(target_id in table for target_id in target_ids)):
+            # Every candidate has a precomputed row, so their distances are lookups
+            best = min(target_ids, key=lambda target_id: table.distance(source_id, target_id))
+            route = self.find_route(source_id, best)
+            if route is None:
+                return None
+            return route[-1], route, table.distance(source_id, best)
+        return find_nearest_target(self.get_node(source_id), target_ids,
+                                   self.blocked_nodes, self.blocked_edges)
+
+    def edges_from(self, node_id):
+        """
+        Yields the edges leaving a node
+        :return: `(neighbor_id, port, length)` tuples
+        """
+        node = self.node_dict[node_id]
+        for neighbor in node.neighbors:
+            yield neighbor.id, node.get_neighbor_port(neighbor), node.distance_to(neighbor)
+
+    def navigate(self, source_id, target_id) -> [Node]:
+        """
+        Returns the waypoints to move from a source node to a target node
+        :param source_id: The ID of the node the AGV is currently at
+        :param target_id: The ID of the node the AGV is trying to get to
+        :return: An ordered list of nodes to navigate to. Empty if there is no path
+        """
+        return self.plan(source_id, target_id)[1]
+
+    def plan(self, source_id, target_id):
+        """
+        Plans a route between two nodes, using the route cache
+        :param source_id: The ID of the node the AGV is currently at
+        :param target_id: The ID of the node the AGV is trying to get to
+        :return: A tuple of every node along the route (including the source)
+            and the collapsed waypoints. Both are empty if there is no path
+        """
+        key = (source_id, target_id, self.map_version, self.obstacle_version)
+        route = self.route_cache.get(key)
+        if route is None:
+            route = self.find_route(source_id, target_id) or ()
+            self.route_cache.put(key, route)
+        route = list(route)
+        return route, self.waypoints(route)
+
+    def waypoints(self, route: [Node]) -> [Node]:
+        """
+        Collapses a full route into the waypoints the AGV needs to be sent to
+        :param route: Every node along the route, including the source
+        """
+        if len(route) < 2:
+            return list(route)
+        return collapse_path(route[0], route[1:])
+
+    def find_route(self, source_id, target_id) -> Optional[list]:
+        """
+        Computes the route between two nodes, bypassing the route cache
+        :return: Every node along the route, including the source and target.
+            `None` if the target cannot be reached
+        """
+        source = self.get_node(source_id)
+        if source_id == target_id:
+            return [source]
+        if self.routing_table is not None and target_id in self.routing_table:
+            route = self.routing_table.route(source_id, target_id)
+            if route is None:
+                return None
+            # The table does not know about obstacles, so only trust routes that avoid them
+            if not self._route_blocked(route):
+                return [self.get_node(node_id) for node_id in route]
+        return find_path(source, self.get_node(target_id), self.blocked_nodes, self.blocked_edges)
+
+    def plan_fastest(self, source_id, target_id, model: TravelModel, heading: Optional[str] = None):
+        """
+        Plans the quickest route between two nodes, counting the time spent
+        turning as well as driving (see `travel_time.find_fastest_path`)
+        :param source_id: The ID of the node the AGV is currently at
+        :param target_id: The ID of the node the AGV is trying to get to
+        :param model: The speeds and turn penalties to plan with
+        :param heading: The direction the AGV faces, as a port character.
+            `None` if unknown (Default: None)
+        :return: A tuple of every node along the route (including the source),
+            the collapsed waypoints and the estimated duration in seconds. The
+            lists are empty and the duration is `inf` if there is no path
+        """
+        key = (source_id, target_id, self.map_version, self.obstacle_version, model.key(), heading)
+        route = self.route_cache.get(key)
+        if route is None:
+            found = find_fastest_path(self, source_id, target_id, model, heading)
+            route = () if found is None else found[0]
+            self.route_cache.put(key, route)
+        if not route:
+            return [], [], math.inf
+        route = [self.get_node(node_id) for node_id in route]
+        return route, self.waypoints(route), model.duration(self, route, heading)
+
+    def precompute_routes(self, targets=None) -> RoutingTable:
+        """
+        Builds a next-hop table so routes to the given targets are answered by
+        lookup instead of a search (see `routing_table.RoutingTable`)
+        :param targets: The IDs of the nodes to precompute routes to, e.g.
+            stations. `None` uses every node (Default: None)
+        :return: The routing table, which `navigate()` now uses
+        """
+        self.routing_table = RoutingTable(self, targets)
+        self.route_cache.clear()
+        return self.routing_table
+
     def get_closest_node(self, x: float, y: float) -> Node:
         """
         Returns the closest node to a target position
@@ -216,16 +720,34 @@ class Network:
         :param y: The target y-coordinate
         :return: The closest node to this position
         """
-        closest_dist = None
-        closest_node = None
+        found = self.index.nearest(x, y)
+        return None if found is None else found[0]
 
-        # Scan dictionary of nodes for closest nodes
-        # This is O(n), but should be fast enough for n < 10,000
-        for node_id, node in self.node_dict.items():
-            distance = math.sqrt((x - node.x) ** 2 + (y - node.y) ** 2)
-            if closest_dist is None or distance < closest_dist:
-                closest_dist = distance
-                closest_node = node
-        return closest_node
+    def get_closest_nodes(self, x: float, y: float, k: int) -> [Node]:
+        """
+        Returns the nodes closest to a target position
+        :param x: The target x-coordinate
+        :param y: The target y-coordinate
+        :param k: The number of nodes to return
+        :return: Up to `k` nodes, closest first
+        """
+        return [node for node, _ in self.index.k_nearest(x, y, k)]
 
+    def get_nodes_within(self, x: float, y: float, radius: float) -> [Node]:
+        """
+        Returns every node within a distance of a target position
+        :param x: The target x-coordinate
+        :param y: The target y-coordinate
+        :param radius: The maximum distance from the position
+        :return: The nodes in range, closest first
+        """
+        return [node for node, _ in self.index.within(x, y, radius)]
 
+    def get_closest_node_batch(self, xs, ys) -> [Node]:
+        """
+        Returns the closest node to each of several positions
+        :param xs: A sequence (list, array, ...) of x coordinates
+        :param ys: A sequence of y coordinates, the same length as `xs`
+        :return: One node per position, or `None` where the network is empty
+        """
+        return [None if found is None else found[0] for found in self.index.nearest_many(xs, ys)]
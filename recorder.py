@@ -0,0 +1,348 @@
+"""
+Records the AGV's telemetry and the actions sent to it, and replays recordings
+through the controller offline
+
+Author: D. William Campman
+Date: 2022-10-10
+"""
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from types import MappingProxyType
+
+from agv import AGV
+
+# Record kinds
+TELEMETRY = 1
+ACTIONS = 2
+
+
+def _encode(value) -> bytes:
+    """
+    Encodes a record payload as compact JSON. Frozen telemetry (see
+    `telemetry.freeze`) is written as plain objects and lists
+    """
+    return json.dumps(value, separators=(",", ":"),
+                      default=lambda frozen: dict(frozen) if isinstance(frozen, MappingProxyType) else frozen
+                      ).encode()
+
+
+class TelemetryRecorder:
+
+    MAGIC = b"AGVLOG"
+    FORMAT_VERSION = 2
+    HEADER = struct.Struct("<6sH")          # Magic, format version
+    RECORD = struct.Struct("<BddI")         # Kind, recording time, wall-clock time, payload length
+    INDEX_ENTRY = struct.Struct("<dQ")      # Recording time, offset of the record
+
+    def __init__(self, path: str):
+        """
+        Appends records to a binary log. Each record is a small fixed header
+        followed by a compact JSON payload. A separate index file (`path + ".idx"`)
+        holds one fixed-size `(time, offset)` entry per record, so a reader can
+        memory-map both files and seek to any time with a binary search.
+        Records are indexed by their recording time: seconds since the log was
+        started, on the monotonic clock, so the index stays sorted even if the
+        system clock is adjusted. The wall-clock time is kept in each record for display.
+        Safe to share between threads
+        :param path: The log file. An existing log is appended to, continuing its recording time
+        :raise ValueError: If an existing file is not a telemetry log of this version
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._last_time = 0.0 if new else self._read_last_time(path)     # Of the latest record
+        # The recording time of `time.monotonic()`'s zero
+        self._clock_offset = self._last_time - time.monotonic()
+        self._data = open(path, "ab")
+        self._index = open(path + ".idx", "ab")
+        if new:
+            self._data.write(TelemetryRecorder.HEADER.pack(TelemetryRecorder.MAGIC,
+                                                           TelemetryRecorder.FORMAT_VERSION))
+        self.records = 0
+
+    @staticmethod
+    def _read_last_time(path: str) -> float:
+        """
+        Returns the recording time of the last record in an existing log
+        """
+        header = TelemetryRecorder.HEADER
+        with open(path, "rb") as fp:
+            data = fp.read(header.size)
+        if len(data) < header.size or header.unpack(data) != (TelemetryRecorder.MAGIC,
+                                                               TelemetryRecorder.FORMAT_VERSION):
+            raise ValueError(f"`{path}` is not a version {TelemetryRecorder.FORMAT_VERSION} telemetry log")
+        entry = TelemetryRecorder.INDEX_ENTRY
+        if not os.path.exists(path + ".idx"):
+            return 0.0
+        with open(path + ".idx", "rb") as fp:
+            size = fp.seek(0, os.SEEK_END)
+            if size < entry.size:
+                return 0.0
+            fp.seek(size - size % entry.size - entry.size)
+            return entry.unpack(fp.read(entry.size))[0]
+
+    def now(self) -> float:
+        """
+        Returns the current recording time
+        """
+        return time.monotonic() + self._clock_offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def record(self, kind: int, payload, timestamp: float = None) -> None:
+        """
+        Appends one record
+        :param kind: `TELEMETRY` or `ACTIONS`
+        :param payload: A JSON-serializable value
+        :param timestamp: The recording time of the record, see `now()`. Never
+            earlier than the previous record's, so the index stays sorted (Default: now)
+        """
+        body = _encode(payload)
+        with self._lock:
+            # Read the clocks under the lock, so concurrent writers append in time order
+            wall_time = time.time()
+            if timestamp is None:
+                timestamp = self.now()
+            timestamp = self._last_time = max(timestamp, self._last_time)
+            offset = self._data.tell()
+            self._data.write(TelemetryRecorder.RECORD.pack(kind, timestamp, wall_time, len(body)))
+            self._data.write(body)
+            # Flush the record before indexing it, so the index never points past the data
+            self._data.flush()
+            self._index.write(TelemetryRecorder.INDEX_ENTRY.pack(timestamp, offset))
+            self._index.flush()
+            self.records += 1
+
+    def record_telemetry(self, data) -> None:
+        """
+        Appends a `/api/variables` response
+        """
+        self.record(TELEMETRY, data)
+
+    def record_actions(self, actions: list) -> None:
+        """
+        Appends a list of instant actions sent to the AGV
+        """
+        self.record(ACTIONS, actions)
+
+    def close(self) -> None:
+        with self._lock:
+            self._data.close()
+            self._index.close()
+
+
+class TelemetryLog:
+    def __init__(self, path: str):
+        """
+        Reads a log written by `TelemetryRecorder`. Both files are memory-mapped,
+        so opening a long recording is cheap and only the records read are paged in
+        :param path: The log file
+        :raise ValueError: If the file is not a telemetry log
+        """
+        self.path = path
+        self._files = []
+        self._data = self._map(path)
+        header = TelemetryRecorder.HEADER
+        if len(self._data) < header.size:
+            raise ValueError(f"`{path}` is not a telemetry log")
+        magic, version = header.unpack_from(self._data, 0)
+        if magic != TelemetryRecorder.MAGIC or version != TelemetryRecorder.FORMAT_VERSION:
+            raise ValueError(f"`{path}` is not a version {TelemetryRecorder.FORMAT_VERSION} telemetry log")
+
+        self._index = self._map(path + ".idx")
+        entry = TelemetryRecorder.INDEX_ENTRY
+        count = len(self._index) // entry.size
+        # A crash can leave an entry whose record was never completed
+        while count and not self._complete(entry.unpack_from(self._index, (count - 1) * entry.size)[1]):
+            count -= 1
+        self._count = count
+
+    def _map(self, path: str):
+        """
+        Memory-maps a file read-only. Empty files cannot be mapped, so they read as empty bytes
+        """
+        fp = open(path, "rb")
+        self._files.append(fp)
+        if os.fstat(fp.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _complete(self, offset: int) -> bool:
+        header = TelemetryRecorder.RECORD
+        if offset + header.size > len(self._data):
+            return False
+        length = header.unpack_from(self._data, offset)[3]
+        return offset + header.size + length <= len(self._data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def close(self) -> None:
+        for mapped in (self._data, self._index):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        for fp in self._files:
+            fp.close()
+
+    def time_at(self, position: int) -> float:
+        """
+        Returns the recording time of the record at a position in the log
+        """
+        return TelemetryRecorder.INDEX_ENTRY.unpack_from(
+            self._index, position * TelemetryRecorder.INDEX_ENTRY.size)[0]
+
+    def wall_time_at(self, position: int) -> float:
+        """
+        Returns the wall-clock time the record at a position in the log was written, for display
+        """
+        offset = TelemetryRecorder.INDEX_ENTRY.unpack_from(
+            self._index, position * TelemetryRecorder.INDEX_ENTRY.size)[1]
+        return TelemetryRecorder.RECORD.unpack_from(self._data, offset)[2]
+
+    @property
+    def start_time(self) -> float:
+        return self.time_at(0) if self._count else 0.0
+
+    @property
+    def end_time(self) -> float:
+        return self.time_at(self._count - 1) if self._count else 0.0
+
+    def bisect(self, timestamp: float) -> int:
+        """
+        Finds the position of the first record at or after a recording time
+        """
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self.time_at(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def kind_at(self, position: int) -> int:
+        """
+        Returns the kind of the record at a position in the log, without decoding it
+        """
+        offset = TelemetryRecorder.INDEX_ENTRY.unpack_from(
+            self._index, position * TelemetryRecorder.INDEX_ENTRY.size)[1]
+        return self._data[offset]
+
+    def read(self, position: int):
+        """
+        Decodes the record at a position in the log
+        :return: A tuple of the kind, the recording time and the payload
+        """
+        offset = TelemetryRecorder.INDEX_ENTRY.unpack_from(
+            self._index, position * TelemetryRecorder.INDEX_ENTRY.size)[1]
+        header = TelemetryRecorder.RECORD
+        kind, timestamp, _, length = header.unpack_from(self._data, offset)
+        start = offset + header.size
+        return kind, timestamp, json.loads(self._data[start:start + length])
+
+    def records(self, start: float = None, end: float = None, kind: int = None):
+        """
+        Yields the records within a window of recording time, oldest first
+        :param start: The earliest time to include (Default: the start of the log)
+        :param end: The latest time to include (Default: the end of the log)
+        :param kind: Only yield records of this kind (Default: every kind)
+        :return: An iterator of `(kind, timestamp, payload)` tuples
+        """
+        first = 0 if start is None else self.bisect(start)
+        for position in range(first, self._count):
+            record = self.read(position)
+            if end is not None and record[1] > end:
+                return
+            if kind is None or record[0] == kind:
+                yield record
+
+    def __iter__(self):
+        return self.records()
+
+
+class ReplayAGV(AGV):
+    def __init__(self, log: TelemetryLog, speed: float = 1.0, start: float = None, **kwargs):
+        """
+        An `AGV` whose telemetry comes from a recording instead of the vehicle,
+        for profiling the controller, `PathQueue` and routing offline. The network
+        is built from the map cache, and actions are collected in `sent` instead
+        of being sent
+        :param log: The recording to replay
+        :param speed: How much faster than real time to replay, e.g. `10`. `None`
+            replays deterministically: each fetch returns the next recorded
+            snapshot, however much time has passed (Default: 1)
+        :param start: The recorded time to start at (Default: the start of the log)
+        :param kwargs: Keyword arguments passed to `AGV`, e.g. `map_cache_path`
+        """
+        self.log = log
+        self.speed = speed
+        self.sent = []      # (recorded time, actions) for every batch the controller sent
+        self._telemetry = [position for position in range(len(log)) if log.kind_at(position) == TELEMETRY]
+        if not self._telemetry:
+            raise ValueError("The recording holds no telemetry")
+        self._times = [log.time_at(position) for position in self._telemetry]
+        self._replay_start = self._times[0] if start is None else start
+        self._started = None    # When the first snapshot was requested
+        self._step = 0          # The next snapshot, when replaying deterministically
+        kwargs["offline"] = True
+        super().__init__(**kwargs)
+
+    def recorded_time(self) -> float:
+        """
+        Returns the point in the recording the replay has reached
+        """
+        if self.speed is None:
+            return self._times[min(self._step, len(self._times) - 1)]
+        if self._started is None:
+            self._started = time.monotonic()
+        return self._replay_start + (time.monotonic() - self._started) * self.speed
+
+    def finished(self) -> bool:
+        """
+        Returns `True` once the replay has passed the last recorded snapshot
+        """
+        if self.speed is None:
+            return self._step >= len(self._times)
+        return self.recorded_time() > self._times[-1]
+
+    def _fetch_variables(self) -> dict:
+        """
+        Returns the latest recorded snapshot at the replay's current time
+        """
+        if self.speed is None:
+            step = min(self._step, len(self._times) - 1)
+            self._step += 1
+        else:
+            step = max(0, bisect.bisect_right(self._times, self.recorded_time()) - 1)
+        return self.log.read(self._telemetry[step])[2]
+
+    def _send_actions(self, actions: list):
+        """
+        Collects the actions instead of sending them
+        """
+        self.sent.append((self.recorded_time(), actions))
+        self.cache.invalidate()
+        return None
+
+    def recorded_actions(self) -> list:
+        """
+        Returns the actions sent during the recording, for comparing against `sent`
+        :return: `(recorded time, actions)` tuples
+        """
+        return [(timestamp, actions) for _, timestamp, actions in self.log.records(kind=ACTIONS)]
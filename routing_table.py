@@ -0,0 +1,268 @@
+"""
+Precomputed shortest-path routing between fixed stations of the node network
+
+Author: D. William Campman
+Date: 2022-10-08
+"""
+
+from array import array
+import heapq
+import math
+import os
+import pickle
+from typing import Optional
+
+
+def graph_edges(network):
+    """
+    Lists every node and edge of a network, independent of its backend
+    :param network: A `node_network.Network` or `compact_network.CompactNetwork`
+    :return: A tuple of the node ID list and a dictionary mapping
+        `(source_id, target_id)` to the edge's length
+    """
+    if hasattr(network, "node_dict"):
+        ids = list(network.node_dict)
+        edges = {}
+        for node in network.node_dict.values():
+            for neighbor in node.neighbors:
+                edges[(node.id, neighbor.id)] = node.distance_to(neighbor)
+        return ids, edges
+
+    ids = list(network.ids)
+    edges = {}
+    for source in range(len(ids)):
+        for slot in range(network.offsets[source], network.offsets[source + 1]):
+            edges[(ids[source], ids[network.targets[slot]])] = network.lengths[slot]
+    return ids, edges
+
+
+class RoutingTable:
+
+    MAGIC = b"AGVROUTES"
+    FORMAT_VERSION = 1
+
+    def __init__(self, network, targets=None):
+        """
+        A next-hop and distance table towards a set of target nodes. Routes to a
+        target are read off the table in O(path length) instead of searching.
+        Each target costs one row of `len(network)` entries, so precomputing
+        every node (`targets=None`) is only practical for small maps
+        :param network: The network to route over
+        :param targets: The IDs of the nodes routes can lead to, e.g. stations.
+            IDs that are not in the network are skipped. `None` uses every node (Default: None)
+        """
+        self.rows = {}
+        self.all_targets = targets is None
+        self._load_graph(*graph_edges(network))
+        for target in (self.ids if targets is None else targets):
+            if target not in self.index_of:
+                print(f"Routing target {target} is not in the network map; skipping it")
+                continue
+            self.rows[target] = self._build_row(self.index_of[target])
+
+    def _load_graph(self, ids, edges) -> None:
+        """
+        Stores the graph as integer-indexed reverse adjacency lists
+        """
+        self.ids = ids
+        self.index_of = {node_id: index for index, node_id in enumerate(ids)}
+        self.edges = edges
+        self.reverse = [[] for _ in ids]
+        for (source_id, target_id), length in edges.items():
+            self.reverse[self.index_of[target_id]].append((self.index_of[source_id], length))
+
+    def _build_row(self, target: int):
+        """
+        Runs Dijkstra backwards from a target, finding every node's distance to
+        it and the first hop of that shortest route
+        :param target: The index of the target node
+        :return: A tuple of the next-hop array (`-1` where there is no route)
+            and the distance array (`inf` where there is no route)
+        """
+        next_hops = array("l", [-1]) * len(self.ids)
+        distances = array("d", [math.inf]) * len(self.ids)
+        distances[target] = 0.0
+        heap = [(0.0, target)]
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if distance > distances[node]:
+                continue
+            for previous, length in self.reverse[node]:
+                cost = distance + length
+                if cost < distances[previous]:
+                    distances[previous] = cost
+                    next_hops[previous] = node
+                    heapq.heappush(heap, (cost, previous))
+        return next_hops, distances
+
+    # ==================================================================
+    # =================            LOOKUPS             =================
+    # ==================================================================
+
+    def __contains__(self, target_id):
+        return target_id in self.rows
+
+    def targets_match(self, targets) -> bool:
+        """
+        Checks whether this table was built for a set of targets
+        :param targets: The target IDs, or `None` for every node. IDs that are
+            not in the network are ignored, as the table skips them
+        """
+        if targets is None:
+            return self.all_targets
+        return not self.all_targets and set(self.rows) == {target for target in targets
+                                                            if target in self.index_of}
+
+    def distance(self, source_id, target_id) -> float:
+        """
+        Returns the length of the shortest route between two nodes
+        :return: The distance, or `inf` if there is no route
+        """
+        _, distances = self.rows[target_id]
+        return distances[self.index_of[source_id]]
+
+    def route(self, source_id, target_id) -> Optional[list]:
+        """
+        Follows the next-hop table from a source to a target
+        :param source_id: The ID of the node to start at
+        :param target_id: The ID of a node in the table's targets
+        :return: The IDs of every node along the route, including the source and
+            target. `None` if the target cannot be reached
+        """
+        next_hops, distances = self.rows[target_id]
+        node = self.index_of[source_id]
+        if distances[node] == math.inf:
+            return None
+        path = [source_id]
+        target = self.index_of[target_id]
+        while node != target:
+            node = next_hops[node]
+            path.append(self.ids[node])
+        return path
+
+    # ==================================================================
+    # =================            UPDATING            =================
+    # ==================================================================
+
+    def update(self, network) -> int:
+        """
+        Brings the table in line with a changed network. Only the rows whose
+        shortest-path tree is affected by the change are recomputed; the others
+        are carried over
+        :param network: The new network
+        :return: The number of rows that were recomputed
+        """
+        old_ids, old_index_of, old_edges = self.ids, self.index_of, self.edges
+        old_rows = self.rows
+        self._load_graph(*graph_edges(network))
+
+        removed = [edge for edge, length in old_edges.items()
+                   if self.edges.get(edge, math.inf) > length]
+        added = [(edge, length) for edge, length in self.edges.items()
+                 if old_edges.get(edge, math.inf) > length]
+
+        self.rows = {}
+        rebuilt = 0
+        for target_id, (next_hops, distances) in old_rows.items():
+            if target_id not in self.index_of:     # Target left the map
+                continue
+
+            def old_distance(node_id):
+                index = old_index_of.get(node_id)
+                return math.inf if index is None else distances[index]
+
+            # A row is stale if its tree used a removed or lengthened edge, or if
+            # a new or shortened edge gives some node a shorter route
+            affected = any(
+                source_id in old_index_of and target_id != source_id
+                and next_hops[old_index_of[source_id]] == old_index_of.get(hop_id)
+                for source_id, hop_id in removed
+            ) or any(
+                old_distance(hop_id) + length < old_distance(source_id)
+                for (source_id, hop_id), length in added
+            )
+
+            if affected:
+                self.rows[target_id] = self._build_row(self.index_of[target_id])
+                rebuilt += 1
+            else:
+                self.rows[target_id] = self._remap_row(next_hops, distances, old_ids)
+
+        # Nodes added to the map need rows of their own
+        if self.all_targets:
+            for target_id in self.ids:
+                if target_id not in self.rows:
+                    self.rows[target_id] = self._build_row(self.index_of[target_id])
+                    rebuilt += 1
+        return rebuilt
+
+    def updated(self, network):
+        """
+        Like `update()`, but builds the result as a new table and leaves this one
+        untouched, so it can keep answering lookups for the old network meanwhile
+        :param network: The new network
+        :return: A tuple of the new table and the number of rows that were recomputed
+        """
+        table = RoutingTable.__new__(RoutingTable)
+        table.all_targets = self.all_targets
+        # `update()` only rebinds these, never modifies them, so they can be shared
+        table.ids, table.index_of, table.edges, table.reverse = self.ids, self.index_of, self.edges, self.reverse
+        table.rows = self.rows
+        rebuilt = table.update(network)
+        return table, rebuilt
+
+    def _remap_row(self, next_hops, distances, old_ids):
+        """
+        Converts an unaffected row from the old node numbering to the new one
+        """
+        new_hops = array("l", [-1]) * len(self.ids)
+        new_distances = array("d", [math.inf]) * len(self.ids)
+        for old_index, node_id in enumerate(old_ids):
+            index = self.index_of.get(node_id)
+            if index is None:
+                continue
+            new_distances[index] = distances[old_index]
+            if next_hops[old_index] != -1:
+                new_hops[index] = self.index_of[old_ids[next_hops[old_index]]]
+        return new_hops, new_distances
+
+    # ==================================================================
+    # =================          PERSISTENCE           =================
+    # ==================================================================
+
+    def save(self, path: str, digest: str) -> None:
+        """
+        Writes the table to disk, tagged with the map it was built from
+        :param path: The file to write, conventionally next to the map cache
+        :param digest: The digest of the network map (see `map_cache.MapCache.digest`)
+        """
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as fp:
+            fp.write(RoutingTable.MAGIC)
+            pickle.dump((RoutingTable.FORMAT_VERSION, digest, self.all_targets,
+                         self.ids, self.edges, self.rows),
+                        fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Reads a table written by `save()`
+        :param path: The file to read
+        :return: A tuple of the map digest and the table, or `None` if there is
+            no usable table at that path
+        """
+        try:
+            with open(path, "rb") as fp:
+                if fp.read(len(cls.MAGIC)) != cls.MAGIC:
+                    return None
+                version, digest, all_targets, ids, edges, rows = pickle.load(fp)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        if version != cls.FORMAT_VERSION:
+            return None
+        table = cls.__new__(cls)
+        table._load_graph(ids, edges)
+        table.all_targets = all_targets
+        table.rows = rows
+        return digest, table
@@ -0,0 +1,377 @@
+"""
+A local stand-in for the SafeLog AGV's REST API, for testing the controller
+without the physical vehicle
+
+Usage:
+    python simulator.py --grid 20 --agvs 10 --latency 0.02 --jitter 0.01
+    python simulator.py --map networkmap.json --port 8900
+
+AGV `n` is served at `http://host:port/n/api/`; AGV 0 is also served at
+`http://host:port/api/`, so `AGV(base_url=...)` works with either.
+
+Author: D. William Campman
+Date: 2022-10-10
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+
+from aiohttp import web
+
+import node_network
+
+
+class SimulatedAGV:
+    def __init__(self,
+                 network: node_network.Network,
+                 node_id: str,
+                 serial: str,
+                 speed: float = 1000.0,
+                 turn_time: float = 0.0,
+                 drain: float = 1e-5,
+                 clock=time.monotonic):
+        """
+        A simulated vehicle driving along the node network. Its motion is worked
+        out from the elapsed time whenever it is read or commanded, so an idle
+        vehicle costs nothing and thousands can be served at once
+        :param network: The network the vehicle drives on
+        :param node_id: The ID of the node the vehicle starts at
+        :param serial: The vehicle's serial number
+        :param speed: The driving speed, in map units per second (Default: 1000)
+        :param turn_time: The seconds spent at a node for each change of direction (Default: 0)
+        :param drain: The battery percentage used per map unit driven (Default: 1e-5)
+        :param clock: Returns the current time in seconds (Default: `time.monotonic`)
+        """
+        self.network = network
+        self.serial = serial
+        self.speed = speed
+        self.turn_time = turn_time
+        self.drain = drain
+        self.clock = clock
+
+        node = network.get_node(node_id)
+        self.x, self.y, self.theta = node.x, node.y, 0.0
+        self.last_node_id = node_id
+        self.route = []             # The nodes still to be driven to
+        self.wait = 0.0             # Seconds left turning at the current node
+        self.paused = False
+        self.pin_up = False
+        self.battery = 100.0
+        self.action_states = []     # Dictionaries in the README's `actionStates` shape
+        self.goto_state = None      # The state of the goto being driven
+        self.andon_states = []
+        self.errors = []
+        self.field_violation = False
+        self.updated = clock()
+
+    @property
+    def driving(self) -> bool:
+        return bool(self.route) and not self.paused
+
+    # ==================================================================
+    # =================             MOTION             =================
+    # ==================================================================
+
+    def advance(self) -> None:
+        """
+        Moves the vehicle along its route to where it is now
+        """
+        now = self.clock()
+        elapsed, self.updated = now - self.updated, now
+        if self.paused:
+            return
+        while elapsed > 0 and self.route:
+            if self.wait > 0:
+                used = min(self.wait, elapsed)
+                self.wait -= used
+                elapsed -= used
+                continue
+            node = self.route[0]
+            distance = math.hypot(node.x - self.x, node.y - self.y)
+            reach = self.speed * elapsed
+            if reach < distance:
+                self.x += (node.x - self.x) * reach / distance
+                self.y += (node.y - self.y) * reach / distance
+                self.battery = max(0.0, self.battery - reach * self.drain)
+                return
+            # Reached the next node
+            elapsed -= distance / self.speed
+            self.battery = max(0.0, self.battery - distance * self.drain)
+            self.x, self.y = node.x, node.y
+            self.last_node_id = node.id
+            self.route.pop(0)
+            if self.route:
+                self._face(self.route[0])
+        if not self.route and self.goto_state is not None:
+            self.goto_state["actionStatus"] = "FINISHED"
+            self.goto_state = None
+
+    def _face(self, node) -> None:
+        """
+        Turns towards the next node, spending `turn_time` if the heading changes
+        """
+        theta = math.atan2(node.y - self.y, node.x - self.x)
+        if abs(math.remainder(theta - self.theta, 2 * math.pi)) > 1e-6:
+            self.wait = self.turn_time
+        self.theta = theta
+
+    # ==================================================================
+    # =================            ACTIONS             =================
+    # ==================================================================
+
+    def handle(self, action: dict) -> None:
+        """
+        Carries out one instant action
+        :param action: The action dictionary, as built by `agv._build_action`
+        """
+        self.advance()
+        name = action.get("actionName")
+        parameters = {parameter.get("key"): parameter.get("value")
+                      for parameter in action.get("actionParameters") or ()}
+        state = {"actionId": action.get("actionId"),
+                 "actionDescription": name,
+                 "actionStatus": "FINISHED"}
+
+        if name == "goto":
+            self._goto(parameters.get("end"), state)
+        elif name == "Stop":
+            self.paused = True
+        elif name == "Resume":
+            self.paused = False
+        elif name in ("MovePinUp", "MovePinDown"):
+            self.pin_up = name == "MovePinUp"
+        elif name in ("RotateLeft1", "RotateRight1"):
+            self.theta += math.pi / 2 if name == "RotateLeft1" else -math.pi / 2
+        elif name == "initposition":
+            self.x, self.y = float(parameters.get("x", self.x)), float(parameters.get("y", self.y))
+            self.theta = float(parameters.get("theta", self.theta))
+            self.last_node_id = parameters.get("lastNodeId", self.last_node_id)
+            self.route = []
+        else:
+            state["actionStatus"] = "FAILED"
+        self.action_states.append(state)
+        del self.action_states[:-50]    # Keep the report short, like the real vehicle
+
+    def _goto(self, node_id, state: dict) -> None:
+        """
+        Starts driving to a node along the shortest route, replacing any goto in progress
+        """
+        if self.goto_state is not None:
+            self.goto_state["actionStatus"] = "FAILED"
+            self.goto_state = None
+        try:
+            # Between nodes, keep driving to the node being approached rather than turning back
+            last = self.network.get_node(self.last_node_id)
+            between = (self.x, self.y) != (last.x, last.y)
+            start_id = self.route[0].id if between and self.route else self.last_node_id
+            route = self.network.find_route(start_id, node_id)
+        except KeyError:
+            route = None
+        if route is None:
+            state["actionStatus"] = "FAILED"
+            return
+        # Otherwise drive to the route's start first if the vehicle is not on it
+        start = route[0]
+        self.route = route if (self.x, self.y) != (start.x, start.y) else route[1:]
+        if self.route:
+            state["actionStatus"] = "RUNNING"
+            self.goto_state = state
+            self._face(self.route[0])
+
+    def variables(self) -> dict:
+        """
+        Returns the vehicle's state in the `/api/variables` format
+        """
+        self.advance()
+        driving = self.driving
+        return {
+            "variables": [],
+            "currentAndonStates": list(self.andon_states),
+            "isPinUp": self.pin_up,
+            "isPinDown": not self.pin_up,
+            "serialNumber": self.serial,
+            "orderId": "",
+            "orderUpdateId": 0,
+            "lastNodeId": self.last_node_id,
+            "driving": driving,
+            "paused": self.paused,
+            "newBaseRequest": False,
+            "operatingMode": "AUTOMATIC",
+            "nodeStates": [{"nodeId": node.id, "sequenceId": index, "released": True}
+                           for index, node in enumerate(self.route)],
+            "edgeStates": [],
+            "agvPosition": {"x": self.x, "y": self.y, "theta": self.theta,
+                            "mapId": "", "positionInitialized": True},
+            "velocity": {"vx": self.speed if driving and self.wait <= 0 else 0.0,
+                         "vy": 0.0, "omega": 0.0},
+            "loads": [],
+            "actionStates": list(self.action_states),
+            "batteryState": {"batteryCharge": self.battery, "batteryVoltage": 24.35,
+                             "charging": False},
+            "errors": list(self.errors),
+            "information": [],
+            "safetyState": {"eStop": "autoAck", "fieldViolation": self.field_violation},
+        }
+
+
+class Simulator:
+    def __init__(self,
+                 network_map: dict,
+                 agv_count: int = 1,
+                 speed: float = 1000.0,
+                 turn_time: float = 0.0,
+                 latency: float = 0.0,
+                 jitter: float = 0.0,
+                 error_rate: float = 0.0,
+                 error_status: int = 500,
+                 seed: int = None):
+        """
+        Serves simulated AGVs over HTTP with the SafeLog API
+        :param network_map: The map to serve and drive on, in the `/api/networkmap` format
+        :param agv_count: The number of vehicles, placed on distinct nodes (Default: 1)
+        :param speed: The vehicles' driving speed, in map units per second (Default: 1000)
+        :param turn_time: The seconds a vehicle spends at each change of direction (Default: 0)
+        :param latency: The seconds every response is delayed by (Default: 0)
+        :param jitter: The most the delay varies by, either way, in seconds (Default: 0)
+        :param error_rate: The share of requests answered with an error (Default: 0)
+        :param error_status: The HTTP status of injected errors (Default: 500)
+        :param seed: The random seed for placement and fault injection (Default: None)
+        """
+        self.map_body = json.dumps(network_map).encode()
+        self.network = node_network.Network.from_elements(*node_network.map_elements(network_map))
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+
+        node_ids = list(self.network.node_dict)
+        if agv_count > len(node_ids):
+            raise ValueError(f"Cannot place {agv_count} vehicles on {len(node_ids)} nodes")
+        starts = self.random.sample(node_ids, agv_count)
+        self.agvs = [SimulatedAGV(self.network, node_id, f"AGVS201:Sim{index}", speed, turn_time)
+                     for index, node_id in enumerate(starts)]
+        self.requests = 0
+        self.injected_errors = 0
+
+    def base_url(self, host: str, port: int, index: int = 0) -> str:
+        """
+        Returns the API base URL of one simulated vehicle
+        """
+        return f"http://{host}:{port}/{index}/api/"
+
+    # ==================================================================
+    # =================           HTTP SERVER          =================
+    # ==================================================================
+
+    def app(self) -> web.Application:
+        """
+        Builds the web application serving every vehicle
+        """
+        app = web.Application(middlewares=[self._faults])
+        for prefix in ("/api", "/{agv}/api"):
+            app.router.add_get(prefix + "/networkmap", self._network_map)
+            app.router.add_get(prefix + "/variables", self._variables)
+            app.router.add_post(prefix + "/instantActions", self._instant_actions)
+        return app
+
+    @web.middleware
+    async def _faults(self, request, handler):
+        """
+        Delays every response and fails a share of them, as configured
+        """
+        self.requests += 1
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.injected_errors += 1
+            return web.Response(status=self.error_status, text="Simulated error")
+        return await handler(request)
+
+    def _agv(self, request) -> SimulatedAGV:
+        index = request.match_info.get("agv", "0")
+        try:
+            return self.agvs[int(index)]
+        except (ValueError, IndexError):
+            raise web.HTTPNotFound(text=f"No AGV `{index}`")
+
+    async def _network_map(self, request):
+        self._agv(request)
+        return web.Response(body=self.map_body, content_type="application/json")
+
+    async def _variables(self, request):
+        return web.json_response(self._agv(request).variables())
+
+    async def _instant_actions(self, request):
+        agv = self._agv(request)
+        try:
+            body = await request.json()
+            actions = body["instantActions"]
+        except (ValueError, KeyError, TypeError):
+            raise web.HTTPBadRequest(text="Expected {\"instantActions\": [...]}")
+        for action in actions:
+            agv.handle(action)
+        return web.json_response({"accepted": len(actions)})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8900) -> web.AppRunner:
+        """
+        Starts serving in the running event loop
+        :return: The runner; call `await runner.cleanup()` to stop
+        """
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulates SafeLog AGVs over HTTP")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--map", help="a saved /api/networkmap response to serve")
+    source.add_argument("--grid", type=int, default=10, help="serve a square grid with this many nodes a side")
+    parser.add_argument("--agvs", type=int, default=1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--speed", type=float, default=1000.0)
+    parser.add_argument("--turn-time", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    if args.map:
+        with open(args.map) as fp:
+            network_map = json.load(fp)
+    else:
+        from benchmark import grid_map
+        network_map = grid_map(args.grid ** 2)
+
+    simulator = Simulator(network_map, args.agvs, args.speed, args.turn_time, args.latency,
+                          args.jitter, args.error_rate, args.error_status, args.seed)
+    for index in range(min(args.agvs, 5)):
+        print(f"AGV {index}: {simulator.base_url(args.host, args.port, index)}")
+    if args.agvs > 5:
+        print(f"... up to AGV {args.agvs - 1}")
+
+    async def serve():
+        runner = await simulator.start(args.host, args.port)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+A uniform grid for answering nearest-point queries over the node network
+
+Author: D. William Campman
+Date: 2022-10-07
+"""
+
+import heapq
+import math
+
+
+class SpatialGrid:
+    def __init__(self, points=(), cell_size: float = None):
+        """
+        Buckets points into square cells, so a query only needs to look at the
+        cells around it rather than at every point
+        :param points: An iterable of `(item, x, y)` tuples
+        :param cell_size: The width of a cell. If `None`, it is chosen so that
+            each cell holds about two points on average (Default: None)
+        """
+        points = list(points)
+        if cell_size is None:
+            cell_size = SpatialGrid._pick_cell_size(points)
+        self.cell_size = cell_size
+        self.cells = {}
+        self.size = 0
+
+        # Bounds of the occupied cells, which limit how far a search expands
+        self.min_cx = self.min_cy = math.inf
+        self.max_cx = self.max_cy = -math.inf
+
+        for item, x, y in points:
+            self.insert(item, x, y)
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def _pick_cell_size(points) -> float:
+        """
+        Picks a cell size giving roughly two points per cell
+        """
+        if len(points) < 2:
+            return 1.0
+        xs = [x for _, x, _ in points]
+        ys = [y for _, _, y in points]
+        area = (max(xs) - min(xs)) * (max(ys) - min(ys))
+        if area <= 0:   # All points on a line
+            return max(max(xs) - min(xs), max(ys) - min(ys), 1.0) / len(points) * 2
+        return math.sqrt(2 * area / len(points))
+
+    def _cell(self, x: float, y: float) -> (int, int):
+        """
+        Returns the index of the cell containing a position
+        """
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def insert(self, item, x: float, y: float) -> None:
+        """
+        Adds a point to the grid
+        :param item: The object stored at this point
+        :param x: The x coordinate of the point
+        :param y: The y coordinate of the point
+        """
+        cx, cy = self._cell(x, y)
+        self.cells.setdefault((cx, cy), []).append((item, x, y))
+        self.size += 1
+        self.min_cx = min(self.min_cx, cx)
+        self.min_cy = min(self.min_cy, cy)
+        self.max_cx = max(self.max_cx, cx)
+        self.max_cy = max(self.max_cy, cy)
+
+    def remove(self, item, x: float, y: float) -> bool:
+        """
+        Removes a point from the grid
+        :param item: The object stored at this point
+        :param x: The x coordinate the point was inserted at
+        :param y: The y coordinate the point was inserted at
+        :return: `True` if the point was found and removed
+        """
+        key = self._cell(x, y)
+        bucket = self.cells.get(key)
+        if not bucket:
+            return False
+        for index, entry in enumerate(bucket):
+            if entry[0] is item:
+                del bucket[index]
+                if not bucket:
+                    del self.cells[key]
+                self.size -= 1
+                return True
+        return False
+
+    def _ring(self, cx: int, cy: int, radius: int):
+        """
+        Yields the points in every cell exactly `radius` cells away from a cell,
+        skipping cells outside the occupied area
+        """
+        if radius == 0:
+            yield from self.cells.get((cx, cy), ())
+            return
+        cells = self.cells
+        low_x, high_x = max(cx - radius, self.min_cx), min(cx + radius, self.max_cx)
+        low_y, high_y = max(cy - radius + 1, self.min_cy), min(cy + radius - 1, self.max_cy)
+        for row in (cy - radius, cy + radius):
+            if self.min_cy <= row <= self.max_cy:
+                for x in range(int(low_x), int(high_x) + 1):
+                    yield from cells.get((x, row), ())
+        for column in (cx - radius, cx + radius):
+            if self.min_cx <= column <= self.max_cx:
+                for y in range(int(low_y), int(high_y) + 1):
+                    yield from cells.get((column, y), ())
+
+    def _beyond(self, cx: int, cy: int, radius: int):
+        """
+        Yields the points in every cell at least `radius` cells away from a cell
+        """
+        for (x, y), bucket in self.cells.items():
+            if max(abs(x - cx), abs(y - cy)) >= radius:
+                yield from bucket
+
+    def _min_radius(self, cx: int, cy: int) -> int:
+        """
+        Returns the radius of the first ring that touches the occupied area
+        """
+        return int(max(self.min_cx - cx, cx - self.max_cx, self.min_cy - cy, cy - self.max_cy, 0))
+
+    def _max_radius(self, cx: int, cy: int) -> int:
+        """
+        Returns the ring radius beyond which no occupied cell exists
+        """
+        if not self.size:
+            return -1
+        return int(max(cx - self.min_cx, self.max_cx - cx, cy - self.min_cy, self.max_cy - cy))
+
+    def k_nearest(self, x: float, y: float, k: int) -> list:
+        """
+        Finds the points closest to a position
+        :param x: The x coordinate of the position
+        :param y: The y coordinate of the position
+        :param k: The number of points to find
+        :return: Up to `k` `(item, distance)` tuples, closest first
+        """
+        if not self.size or k <= 0:
+            return []
+        cx, cy = self._cell(x, y)
+        best = []   # Max-heap of the k closest, as (-distance, tie breaker, item)
+        tie_breaker = 0
+        for radius in range(self._min_radius(cx, cy), self._max_radius(cx, cy) + 1):
+            # Anything in this ring or beyond is at least this far away
+            if len(best) == k and -best[0][0] <= (radius - 1) * self.cell_size:
+                break
+            # Once a ring spans more cells than are occupied, scanning them all is cheaper
+            sparse = 8 * radius > len(self.cells)
+            points = self._beyond(cx, cy, radius) if sparse else self._ring(cx, cy, radius)
+            for item, px, py in points:
+                distance = math.hypot(px - x, py - y)
+                tie_breaker += 1
+                if len(best) < k:
+                    heapq.heappush(best, (-distance, tie_breaker, item))
+                elif distance < -best[0][0]:
+                    heapq.heapreplace(best, (-distance, tie_breaker, item))
+            if sparse:
+                break
+        return [(item, -distance) for distance, _, item in sorted(best, reverse=True)]
+
+    def nearest(self, x: float, y: float):
+        """
+        Finds the point closest to a position
+        :param x: The x coordinate of the position
+        :param y: The y coordinate of the position
+        :return: An `(item, distance)` tuple, or `None` if the grid is empty
+        """
+        found = self.k_nearest(x, y, 1)
+        return found[0] if found else None
+
+    def nearest_many(self, xs, ys) -> list:
+        """
+        Finds the closest point to each of several positions
+        :param xs: A sequence (list, array, ...) of x coordinates
+        :param ys: A sequence of y coordinates, the same length as `xs`
+        :return: A list of `(item, distance)` tuples, one per position
+        """
+        nearest = self.nearest
+        return [nearest(float(x), float(y)) for x, y in zip(xs, ys)]
+
+    def within(self, x: float, y: float, radius: float) -> list:
+        """
+        Finds every point within a distance of a position
+        :param x: The x coordinate of the position
+        :param y: The y coordinate of the position
+        :param radius: The maximum distance
+        :return: A list of `(item, distance)` tuples, closest first
+        """
+        min_cx, min_cy = self._cell(x - radius, y - radius)
+        max_cx, max_cy = self._cell(x + radius, y + radius)
+        found = []
+        for item, px, py in self._cells_between(min_cx, min_cy, max_cx, max_cy):
+            distance = math.hypot(px - x, py - y)
+            if distance <= radius:
+                found.append((item, distance))
+        found.sort(key=lambda entry: entry[1])
+        return found
+
+    def in_rectangle(self, min_x: float, min_y: float, max_x: float, max_y: float) -> list:
+        """
+        Finds every point inside an axis-aligned rectangle (bounds inclusive)
+        :return: A list of `(item, x, y)` tuples
+        """
+        min_cx, min_cy = self._cell(min_x, min_y)
+        max_cx, max_cy = self._cell(max_x, max_y)
+        return [(item, px, py)
+                for item, px, py in self._cells_between(min_cx, min_cy, max_cx, max_cy)
+                if min_x <= px <= max_x and min_y <= py <= max_y]
+
+    def _cells_between(self, min_cx: int, min_cy: int, max_cx: int, max_cy: int):
+        """
+        Yields the points in a block of cells, clipped to the occupied area
+        """
+        min_cx, min_cy = max(min_cx, self.min_cx), max(min_cy, self.min_cy)
+        max_cx, max_cy = min(max_cx, self.max_cx), min(max_cy, self.max_cy)
+        if min_cx > max_cx or min_cy > max_cy:
+            return
+        # Sparse grids are cheaper to filter than to walk cell by cell
+        if (max_cx - min_cx + 1) * (max_cy - min_cy + 1) > len(self.cells):
+            for (cx, cy), bucket in self.cells.items():
+                if min_cx <= cx <= max_cx and min_cy <= cy <= max_cy:
+                    yield from bucket
+            return
+        for cx in range(int(min_cx), int(max_cx) + 1):
+            for cy in range(int(min_cy), int(max_cy) + 1):
+                yield from self.cells.get((cx, cy), ())
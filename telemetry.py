@@ -0,0 +1,490 @@
+"""
+Background polling of the Safeloc AGV's telemetry
+
+Author: D. William Campman
+Date: 2022-10-06
+"""
+
+import asyncio
+from collections import deque
+import math
+import threading
+import time
+from types import MappingProxyType
+
+
+def freeze(value):
+    """
+    Recursively converts a decoded JSON value into an immutable equivalent.
+    Dictionaries become read-only mappings and lists become tuples
+    :param value: The JSON value
+    :return: The frozen value
+    """
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class Telemetry:
+    __slots__ = ("timestamp", "x", "y", "theta", "map_id", "position_initialized",
+                 "vx", "vy", "omega", "last_node_id", "driving", "paused",
+                 "pin_up", "pin_down", "operating_mode", "battery_charge",
+                 "battery_voltage", "charging", "andon_states", "errors",
+                 "action_states", "node_states", "edge_states", "e_stop",
+                 "field_violation", "raw")
+
+    def __init__(self, data: dict, timestamp: float = None):
+        """
+        A decoded snapshot of the AGV's telemetry. Every field is parsed once,
+        when the snapshot is created, so reading it is a plain attribute access.
+        :param data: The decoded `/api/variables` response
+        :param timestamp: The `time.monotonic()` time the data was requested
+            (Default: now)
+        """
+        self.timestamp = time.monotonic() if timestamp is None else timestamp
+        data = self.raw = freeze(data)      # The full response, for keys without a field
+
+        position = data.get("agvPosition") or {}
+        self.x = position.get("x")
+        self.y = position.get("y")
+        self.theta = position.get("theta")
+        self.map_id = position.get("mapId")
+        self.position_initialized = position.get("positionInitialized", False)
+
+        velocity = data.get("velocity") or {}
+        self.vx = velocity.get("vx", 0.0)
+        self.vy = velocity.get("vy", 0.0)
+        self.omega = velocity.get("omega", 0.0)
+
+        self.last_node_id = data.get("lastNodeId")
+        self.driving = data.get("driving", False)
+        self.paused = data.get("paused", False)
+        self.pin_up = data.get("isPinUp", False)
+        self.pin_down = data.get("isPinDown", False)
+        self.operating_mode = data.get("operatingMode")
+
+        battery = data.get("batteryState") or {}
+        self.battery_charge = battery.get("batteryCharge")
+        self.battery_voltage = battery.get("batteryVoltage")
+        self.charging = battery.get("charging", False)
+
+        safety = data.get("safetyState") or {}
+        self.e_stop = safety.get("eStop")
+        self.field_violation = safety.get("fieldViolation", False)
+
+        self.andon_states = data.get("currentAndonStates", ())
+        self.errors = data.get("errors", ())
+        self.action_states = data.get("actionStates", ())
+        self.node_states = data.get("nodeStates", ())
+        self.edge_states = data.get("edgeStates", ())
+
+    def __repr__(self):
+        return (f"Telemetry(last_node_id={self.last_node_id!r}, x={self.x}, y={self.y}, "
+                f"theta={self.theta}, driving={self.driving}, paused={self.paused})")
+
+    def __getitem__(self, key: str):
+        """
+        Looks up a key of the raw response, e.g. `snapshot["lastNodeId"]`
+        """
+        if self.raw is None:
+            raise KeyError(f"`{key}` is not available in a compact snapshot")
+        return self.raw[key]
+
+    def get(self, key: str, default=None):
+        """
+        Looks up a key of the raw response, returning `default` if it is missing
+        """
+        if self.raw is None:
+            return default
+        return self.raw.get(key, default)
+
+    @property
+    def speed(self) -> float:
+        """
+        The AGV's linear speed
+        """
+        return math.hypot(self.vx, self.vy)
+
+    def compact(self):
+        """
+        Returns a copy without the raw response, which is much smaller to keep around
+        """
+        copy = Telemetry.__new__(Telemetry)
+        for slot in Telemetry.__slots__:
+            setattr(copy, slot, getattr(self, slot))
+        copy.raw = None
+        return copy
+
+
+class _Flight:
+    __slots__ = ("generation", "done", "result", "error")
+
+    def __init__(self, generation: int):
+        """
+        A refresh request that is currently in flight. Every caller that needs
+        fresh data while it is running waits on it instead of making its own request
+        :param generation: The cache generation when the request was started
+        """
+        self.generation = generation
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class TelemetryCache:
+    def __init__(self,
+                 fetch,
+                 ttl: float = 0.1,
+                 stale_ttl: float = 0.0,
+                 on_update=None,
+                 history: int = 0):
+        """
+        A thread-safe cache of the AGV's telemetry. Concurrent callers that find
+        the cache expired share a single in-flight request, ages are measured on
+        a monotonic clock, and snapshots are immutable `Telemetry` objects, so
+        readers can never observe one being modified or cleared.
+        :param fetch: A callable returning the decoded `/api/variables` response
+        :param ttl: The number of seconds a snapshot is fresh (Default: 0.1)
+        :param stale_ttl: The number of seconds past `ttl` during which the old
+            snapshot is still returned while a refresh runs in the background.
+            `0` makes every expired read wait for the refresh (Default: 0)
+        :param on_update: Called as `on_update(snapshot)` for every snapshot
+            requested after the most recent invalidation (Default: None)
+        :param history: The number of past snapshots to keep, in compact form,
+            in `history` (Default: 0)
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.on_update = on_update
+        self.history = deque(maxlen=history)
+        self.metrics = None             # A `metrics.Metrics` counting cache hits, if set
+
+        self.snapshot = None            # The latest `Telemetry` snapshot
+        self.snapshot_time = None       # The `time.monotonic()` time the snapshot was requested
+
+        self._lock = threading.Lock()
+        self._generation = 0            # Incremented by every invalidation
+        self._snapshot_generation = -1  # The generation the snapshot was requested in
+        self._flight = None
+
+    def age(self):
+        """
+        Returns the age of the current snapshot in seconds, or `None` if there is none
+        """
+        snapshot_time = self.snapshot_time
+        return None if snapshot_time is None else time.monotonic() - snapshot_time
+
+    def latest(self):
+        """
+        Returns the current snapshot regardless of age, or `None` if there is none
+        or it predates the last invalidation
+        """
+        with self._lock:
+            if self._snapshot_generation != self._generation:
+                return None
+            return self.snapshot
+
+    def get(self, force: bool = False):
+        """
+        Returns the current snapshot, refreshing it if it has expired
+        :param force: If `true`, the snapshot is refreshed regardless of age (Default: False)
+        :return: The `Telemetry` snapshot
+        """
+        with self._lock:
+            if not force and self._snapshot_generation == self._generation:
+                age = time.monotonic() - self.snapshot_time
+                if age < self.ttl:
+                    if self.metrics is not None:
+                        self.metrics.cache(True)
+                    return self.snapshot
+                if age < self.ttl + self.stale_ttl:     # Serve stale and revalidate
+                    if self._flight is None:
+                        flight = self._flight = _Flight(self._generation)
+                        threading.Thread(target=self._run_flight, args=(flight,), daemon=True).start()
+                    if self.metrics is not None:
+                        self.metrics.cache(True)
+                    return self.snapshot
+            flight, leader = self._join_flight()
+        if self.metrics is not None:
+            self.metrics.cache(False)
+
+        if leader:
+            self._run_flight(flight)
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def refresh(self):
+        """
+        Requests a new snapshot, sharing any request already started since the
+        last invalidation
+        :return: The new `Telemetry` snapshot
+        """
+        return self.get(force=True)
+
+    def invalidate(self) -> None:
+        """
+        Marks the current snapshot as out of date, e.g. after a command was sent.
+        Readers holding the old snapshot can keep using it, but the next `get()`
+        waits for data requested after this call
+        """
+        with self._lock:
+            self._generation += 1
+
+    def put(self, snapshot: Telemetry) -> None:
+        """
+        Stores a snapshot that arrived without a request, e.g. from a broadcast.
+        It was received after any command already sent, so it counts as current
+        :param snapshot: The new `Telemetry` snapshot
+        """
+        with self._lock:
+            if self.snapshot_time is not None and snapshot.timestamp < self.snapshot_time:
+                return
+            self.snapshot = snapshot
+            self.snapshot_time = snapshot.timestamp
+            self._snapshot_generation = self._generation
+            if self.history.maxlen:
+                self.history.append(snapshot.compact())
+
+        if self.on_update is not None:
+            self.on_update(snapshot)
+
+    def _join_flight(self):
+        """
+        Returns the in-flight request for the current generation, starting one if needed.
+        Must be called with the lock held
+        :return: A tuple of the flight and `True` if the caller must run it
+        """
+        flight = self._flight
+        if flight is not None and flight.generation == self._generation:
+            return flight, False
+        flight = self._flight = _Flight(self._generation)
+        return flight, True
+
+    def _run_flight(self, flight: _Flight) -> None:
+        """
+        Performs the request for a flight and publishes the result
+        """
+        requested = time.monotonic()
+        try:
+            flight.result = Telemetry(self.fetch(), requested)
+        except Exception as e:
+            flight.error = e
+
+        current = False
+        with self._lock:
+            if self._flight is flight:
+                self._flight = None
+            # Never let an older request overwrite a newer one, or a newer broadcast
+            if (flight.error is None and flight.generation >= self._snapshot_generation
+                    and (self.snapshot_time is None or requested >= self.snapshot_time)):
+                self.snapshot = flight.result
+                self.snapshot_time = requested
+                self._snapshot_generation = flight.generation
+                if self.history.maxlen:
+                    self.history.append(flight.result.compact())
+                current = flight.generation == self._generation
+        flight.done.set()
+
+        if current and self.on_update is not None:
+            self.on_update(flight.result)
+
+
+class Subscription:
+    def __init__(self, poller, fields, callback):
+        """
+        A registered interest in changes to one or more telemetry fields
+        :param poller: The poller the subscription belongs to
+        :param fields: The top-level keys to watch. An empty tuple watches every update
+        :param callback: Called as `callback(snapshot)` when a watched field changes
+        """
+        self.poller = poller
+        self.fields = fields
+        self.callback = callback
+
+    def cancel(self) -> None:
+        """
+        Stops delivering updates to this subscription
+        """
+        self.poller.unsubscribe(self)
+
+
+class TelemetryPoller:
+    def __init__(self, fetch, interval: float = 0.1):
+        """
+        Refreshes the AGV's telemetry on a background thread at a fixed rate and
+        publishes each result to subscribers. Only one request is made
+        per tick, regardless of how many consumers read or subscribe.
+        :param fetch: A callable returning a new `Telemetry` snapshot, such as
+            `TelemetryCache.refresh`, or `None` to skip the tick
+        :param interval: The number of seconds between refreshes (Default: 0.1)
+        """
+        self.fetch = fetch
+        self.interval = interval
+
+        self.snapshot = None        # The latest `Telemetry` snapshot
+        self.snapshot_time = None   # The `time.monotonic()` time of the latest snapshot
+        self.errors = 0             # The number of failed refreshes
+        self.last_error = None      # The exception raised by the last failed refresh
+
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._updated = threading.Condition()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        """
+        `True` if the polling thread is alive
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """
+        Starts the polling thread. Does nothing if it is already running
+        """
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="TelemetryPoller", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the polling thread and waits for it to exit
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        """
+        The polling loop. Ticks are scheduled on a monotonic clock, so a slow
+        request delays the next tick instead of shifting every later one
+        """
+        next_tick = time.monotonic()
+        while not self._stop.is_set():
+            self.poll()
+            next_tick += self.interval
+            delay = next_tick - time.monotonic()
+            if delay < 0:   # Fell behind, so skip the missed ticks
+                next_tick = time.monotonic()
+                delay = 0
+            self._stop.wait(delay)
+
+    def poll(self) -> bool:
+        """
+        Fetches and publishes a single snapshot
+        :return: `True` if a new snapshot was published, `False` if the request
+            failed or the tick was skipped
+        """
+        try:
+            data = self.fetch()
+        except Exception as e:
+            self.errors += 1
+            self.last_error = e
+            return False
+        if data is None:
+            return False
+        self.publish(data)
+        return True
+
+    def publish(self, snapshot) -> None:
+        """
+        Replaces the current snapshot and notifies subscribers of any changed fields
+        :param snapshot: The new `Telemetry` snapshot
+        """
+        previous = self.snapshot
+        with self._updated:
+            self.snapshot = snapshot
+            self.snapshot_time = time.monotonic()
+            self._updated.notify_all()
+
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if previous is not None and subscription.fields:
+                if all(previous.get(key) == snapshot.get(key) for key in subscription.fields):
+                    continue
+            try:
+                subscription.callback(snapshot)
+            except Exception as e:
+                print(f"Telemetry subscriber raised: {e!r}")
+
+    def wait_for_update(self, timeout: float = None, cancelled=None):
+        """
+        Blocks until the next snapshot is published
+        :param timeout: The maximum number of seconds to wait (Default: forever)
+        :param cancelled: A callable checked whenever waiters are woken, including
+            by `interrupt()`. The wait ends early once it returns `True` (Default: None)
+        :return: The new snapshot, or `None` if the wait timed out or was cancelled
+        """
+        with self._updated:
+            current = self.snapshot
+            self._updated.wait_for(lambda: self.snapshot is not current
+                                   or (cancelled is not None and cancelled()), timeout)
+            return None if self.snapshot is current else self.snapshot
+
+    def interrupt(self) -> None:
+        """
+        Wakes every `wait_for_update()` caller so they re-check their `cancelled` condition
+        """
+        with self._updated:
+            self._updated.notify_all()
+
+    # ==================================================================
+    # =================          SUBSCRIPTIONS         =================
+    # ==================================================================
+
+    def subscribe(self, callback, *fields) -> Subscription:
+        """
+        Registers a callback for telemetry changes. The callback runs on the
+        polling thread, so it should return quickly
+        :param callback: Called as `callback(snapshot)` when a watched field changes
+        :param fields: The top-level keys to watch, e.g. "lastNodeId" or "paused".
+            If none are given, the callback is called on every update
+        :return: The subscription, which can be cancelled
+        """
+        subscription = Subscription(self, tuple(fields), callback)
+        with self._lock:
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """
+        Removes a subscription. Does nothing if it was already removed
+        :param subscription: The subscription returned by `subscribe()`
+        """
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    async def updates(self, *fields):
+        """
+        Asynchronously iterates over snapshots in which a watched field changed.
+        If the consumer falls behind, intermediate snapshots are dropped and only
+        the latest is delivered
+        :param fields: The top-level keys to watch. If none are given, every update is yielded
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=1)
+
+        def deliver(snapshot):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(snapshot)
+
+        subscription = self.subscribe(lambda snapshot: loop.call_soon_threadsafe(deliver, snapshot),
+                                      *fields)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            subscription.cancel()
@@ -0,0 +1,11 @@
+"""
+Makes the top-level modules importable from the tests
+
+Author: D. William Campman
+Date: 2022-10-14
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
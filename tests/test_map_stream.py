@@ -0,0 +1,34 @@
+"""
+Tests for the streaming network map parser
+
+Author: D. William Campman
+Date: 2022-10-14
+"""
+
+import json
+
+import pytest
+
+import map_stream
+from benchmark import grid_map
+
+
+def body(network_map: dict) -> bytes:
+    return json.dumps(network_map).encode()
+
+
+def test_parses_in_small_chunks():
+    data = body(grid_map(9))
+    _, nodes, edges = map_stream.parse_chunks(data[i:i + 7] for i in range(0, len(data), 7))
+    assert len(nodes) == 9 and len(edges) == 24
+
+
+@pytest.mark.parametrize("network_map", [
+    {"nodes": [{"id": "a", "nodeProperties": {}}], "edges": []},
+    {"nodes": [{"id": "a", "nodeProperties": {"intelliAgentCore": {"position": None}}}], "edges": []},
+    {"nodes": [], "edges": [{"source": {"node": "a"}, "target": {"node": "b", "port": "s"}}]},
+    {"nodes": [], "edges": ["a-b"]},
+])
+def test_malformed_elements_raise_value_error(network_map):
+    with pytest.raises(ValueError, match="malformed map element"):
+        map_stream.parse_chunks([body(network_map)])
@@ -0,0 +1,95 @@
+"""
+Tests for the path queue, driven against the simulated AGV
+
+Author: D. William Campman
+Date: 2022-10-14
+"""
+
+import node_network
+import telemetry
+from benchmark import grid_map
+from PathQueue import PathQueue
+from simulator import SimulatedAGV
+
+TICK = 0.05     # Simulated seconds that pass between telemetry reads
+
+
+class SimulatedClient:
+    def __init__(self, network, node_id: str):
+        """
+        Stands in for `AGV`, driving a `SimulatedAGV` whose clock moves on by
+        `TICK` with every telemetry read, so drive times don't depend on the host
+        """
+        self.network = network
+        self.now = 0.0
+        self.vehicle = SimulatedAGV(network, node_id, "AGVS201:Test", clock=lambda: self.now)
+        self.stopped = False
+        self.poller = None
+        self.positions = []
+
+    def _action(self, name: str, **parameters) -> None:
+        self.vehicle.handle({"actionId": name, "actionName": name,
+                             "actionParameters": [{"key": key, "value": value}
+                                                  for key, value in parameters.items()]})
+
+    def set_driving(self, driving: bool) -> None:
+        self.stopped = not driving
+        self._action("Resume" if driving else "Stop")
+
+    def go_to_node(self, node_id: str, navigate=None) -> None:
+        self._action("goto", end=node_id)
+
+    def get_telemetry(self) -> telemetry.Telemetry:
+        self.now += TICK
+        snapshot = telemetry.Telemetry(self.vehicle.variables(), self.now)
+        self.positions.append((snapshot.x, snapshot.y))
+        return snapshot
+
+
+def drive(source_id: str, target_id: str, **options):
+    network = node_network.Network.from_elements(*node_network.map_elements(grid_map(100)))
+    client = SimulatedClient(network, source_id)
+    queue = PathQueue(client, poll_interval=1e-4, max_poll_interval=1e-4, **options)
+    route, waypoints = network.plan(source_id, target_id)
+    queue.queue_route(route, waypoints)
+    assert queue.start()
+    assert client.vehicle.last_node_id == target_id
+    return client
+
+
+def test_lookahead_is_never_slower():
+    waiting = drive("0_0", "5_5")
+    pipelined = drive("0_0", "5_5", lookahead=300)
+    assert pipelined.now <= waiting.now
+
+
+def test_lookahead_never_reverses():
+    client = drive("0_0", "5_5", lookahead=300)
+    # On the grid, the shortest route only ever moves up and to the right
+    for (x0, y0), (x1, y1) in zip(client.positions, client.positions[1:]):
+        assert x1 >= x0 and y1 >= y0
+
+
+def test_abort_keeps_the_async_stop_command():
+    import asyncio
+
+    class AsyncClient:
+        stopped = False
+        poller = None
+
+        def __init__(self):
+            self.commands = []
+
+        async def set_driving(self, driving: bool) -> None:
+            await asyncio.sleep(0)
+            self.stopped = not driving
+            self.commands.append("Resume" if driving else "Stop")
+
+    async def abort():
+        client = AsyncClient()
+        queue = PathQueue(client)
+        queue.abort()
+        await queue.wait_stopped()
+        return client.commands
+
+    assert asyncio.run(abort()) == ["Stop"]
@@ -0,0 +1,51 @@
+"""
+Tests for the telemetry recorder and log reader
+
+Author: D. William Campman
+Date: 2022-10-14
+"""
+
+import threading
+
+import recorder
+
+
+def test_concurrent_writers_keep_the_index_sorted(tmp_path):
+    path = str(tmp_path / "telemetry.log")
+    writers, per_writer = 4, 2000
+    with recorder.TelemetryRecorder(path) as log:
+        def write(writer):
+            for i in range(per_writer):
+                log.record_telemetry({"writer": writer, "i": i})
+        threads = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    with recorder.TelemetryLog(path) as log:
+        times = [log.time_at(position) for position in range(len(log))]
+        assert len(times) == writers * per_writer
+        assert times == sorted(times)
+        assert len(list(log.records(start=times[len(times) // 2]))) >= len(times) - len(times) // 2
+
+
+def test_earlier_timestamps_are_clamped(tmp_path):
+    path = str(tmp_path / "telemetry.log")
+    with recorder.TelemetryRecorder(path) as log:
+        log.record(recorder.TELEMETRY, {}, timestamp=5.0)
+        log.record(recorder.ACTIONS, [], timestamp=3.0)
+
+    with recorder.TelemetryLog(path) as log:
+        assert [log.time_at(position) for position in range(len(log))] == [5.0, 5.0]
+
+
+def test_appending_continues_the_recording_time(tmp_path):
+    path = str(tmp_path / "telemetry.log")
+    with recorder.TelemetryRecorder(path) as log:
+        log.record(recorder.TELEMETRY, {}, timestamp=100.0)
+    with recorder.TelemetryRecorder(path) as log:
+        log.record_telemetry({})
+
+    with recorder.TelemetryLog(path) as log:
+        assert log.time_at(1) >= log.time_at(0) == 100.0
@@ -0,0 +1,31 @@
+"""
+Tests for the precomputed routing table
+
+Author: D. William Campman
+Date: 2022-10-14
+"""
+
+import node_network
+from benchmark import grid_map
+from routing_table import RoutingTable
+
+
+def make_network(side: int = 4):
+    return node_network.Network.from_elements(*node_network.map_elements(grid_map(side ** 2)))
+
+
+def test_unknown_targets_are_skipped(capsys):
+    table = RoutingTable(make_network(), targets=["3_3", "missing"])
+    assert "3_3" in table and "missing" not in table
+    assert "missing" in capsys.readouterr().out
+    assert table.route("0_0", "3_3")[-1] == "3_3"
+    # A table built without the unknown target still matches the configured targets
+    assert table.targets_match(["3_3", "missing"])
+    assert not table.targets_match(["3_3", "0_0"])
+
+
+def test_saved_table_matches_after_skipping(tmp_path):
+    path = str(tmp_path / "map.routes")
+    RoutingTable(make_network(), targets=["missing", "1_2"]).save(path, "digest")
+    digest, table = RoutingTable.load(path)
+    assert digest == "digest" and table.targets_match(["1_2", "missing"])
@@ -0,0 +1,82 @@
+"""
+Tests for the simulated AGV
+
+Author: D. William Campman
+Date: 2022-10-14
+"""
+
+import math
+
+import node_network
+from benchmark import SPACING, grid_map
+from simulator import SimulatedAGV
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_vehicle(node_id: str = "0_0", side: int = 10):
+    network = node_network.Network.from_elements(*node_network.map_elements(grid_map(side ** 2)))
+    clock = Clock()
+    return SimulatedAGV(network, node_id, "AGVS201:Test", clock=clock), clock
+
+
+def goto(vehicle: SimulatedAGV, node_id: str) -> None:
+    vehicle.handle({"actionId": node_id, "actionName": "goto",
+                    "actionParameters": [{"key": "end", "value": node_id}]})
+
+
+def drive(vehicle: SimulatedAGV, clock: Clock, step: float = 0.05):
+    """
+    Advances the clock until the vehicle stops, yielding its position after each step
+    """
+    while vehicle.route:
+        clock.now += step
+        vehicle.advance()
+        yield vehicle.x, vehicle.y
+
+
+def test_goto_between_nodes_keeps_driving_forwards():
+    vehicle, clock = make_vehicle()
+    goto(vehicle, "0_1")
+    clock.now = 0.5 * SPACING / vehicle.speed
+    vehicle.advance()
+    assert vehicle.last_node_id == "0_0" and 0 < vehicle.y < SPACING
+
+    # The new route passes through the node being approached, so it must not turn back
+    goto(vehicle, "0_3")
+    assert vehicle.route[0].id == "0_1"
+    last_y = vehicle.y
+    for x, y in drive(vehicle, clock):
+        assert x == 0.0 and y >= last_y
+        last_y = y
+    assert vehicle.last_node_id == "0_3"
+
+
+def test_goto_between_nodes_continues_from_the_node_ahead():
+    vehicle, clock = make_vehicle()
+    goto(vehicle, "0_1")
+    clock.now = 0.5 * SPACING / vehicle.speed
+    vehicle.advance()
+
+    # A target off to the side is reached through the node ahead, not the one behind
+    goto(vehicle, "2_1")
+    assert [node.id for node in vehicle.route] == ["0_1", "1_1", "2_1"]
+    previous = (vehicle.x, vehicle.y)
+    for position in drive(vehicle, clock):
+        assert position[1] >= previous[1]
+        previous = position
+    assert vehicle.last_node_id == "2_1"
+    # Half an edge before the new goto, then two and a half after it
+    assert math.isclose(clock.now, 3 * SPACING / vehicle.speed, abs_tol=0.1)
+
+
+def test_goto_at_a_node_starts_from_it():
+    vehicle, clock = make_vehicle("1_1")
+    goto(vehicle, "1_0")
+    assert [node.id for node in vehicle.route] == ["1_0"]
@@ -0,0 +1,289 @@
+"""
+Traces operator commands from recognition to their confirmed effect on the AGV
+
+Author: D. William Campman
+Date: 2022-10-13
+"""
+
+import contextlib
+import contextvars
+from collections import deque
+import os
+import threading
+import time
+
+import metrics as metrics_module
+
+# The stages of a command, in order
+STAGES = ("recognition", "prediction", "dispatch", "confirmation")
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+def current():
+    """
+    Returns the trace of the command being handled in this context, or `None`
+    """
+    return _current.get()
+
+
+def _new_id(size: int) -> str:
+    return os.urandom(size).hex()
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start", "end", "attributes")
+
+    def __init__(self, name: str, parent_id: str, start: float = None, **attributes):
+        """
+        One timed stage of a trace. Times are `time.monotonic()` times
+        """
+        self.name = name
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.start = time.monotonic() if start is None else start
+        self.end = None
+        self.attributes = attributes
+
+    @property
+    def duration(self) -> float:
+        return (time.monotonic() if self.end is None else self.end) - self.start
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "span_id": self.span_id, "parent_id": self.parent_id,
+                "duration": self.duration, "attributes": dict(self.attributes)}
+
+
+class Trace:
+    def __init__(self, tracer, source: str, **attributes):
+        """
+        Follows one command through the stages in `STAGES`. Every span carries
+        the trace's ID, and the dispatch span's ID is sent to the AGV as a W3C
+        `traceparent` header. Create with `Tracer.trace()`
+        :param tracer: The tracer that records the trace
+        :param source: Where the command came from, e.g. "voice" or "gesture"
+        :param attributes: Any details worth keeping, e.g. the transcribed text
+        """
+        self.tracer = tracer
+        self.source = source
+        self.trace_id = _new_id(16)
+        self.span_id = _new_id(8)       # The root span, which every stage belongs to
+        self.start = time.monotonic()
+        self.end = None
+        self.status = None              # Set when the trace finishes
+        self.attributes = attributes
+        self.spans = []
+        self.dispatched = False         # Only the first batch of actions is traced
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"Trace({self.trace_id}, source={self.source!r}, status={self.status!r})"
+
+    @property
+    def duration(self) -> float:
+        """
+        The time from the start of the command to its confirmation, or until now
+        """
+        return (time.monotonic() if self.end is None else self.end) - self.start
+
+    def start_span(self, name: str, start: float = None, **attributes) -> Span:
+        """
+        Starts timing a stage. End it with `end_span()`
+        :param start: The `time.monotonic()` time the stage began (Default: now)
+        """
+        span = Span(name, self.span_id, start, **attributes)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def end_span(self, span: Span, end: float = None) -> None:
+        if span.end is not None:
+            return
+        span.end = time.monotonic() if end is None else end
+        self.tracer.metrics.observe(span.name, span.duration)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """
+        Times the stage run inside the `with` block
+        """
+        span = self.start_span(name, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.attributes["error"] = repr(e)
+            raise
+        finally:
+            self.end_span(span)
+
+    def traceparent(self, span: Span) -> str:
+        """
+        Returns the W3C `traceparent` header identifying a span of this trace
+        """
+        return f"00-{self.trace_id}-{span.span_id}-01"
+
+    def finish(self, status: str = "confirmed", end: float = None) -> None:
+        """
+        Ends the trace. Only the first call has any effect
+        :param status: "confirmed" if the AGV showed the command's effect,
+            otherwise why it did not, e.g. "ignored" or "unconfirmed"
+        :param end: The `time.monotonic()` time the command ended (Default: now)
+        """
+        with self._lock:
+            if self.status is not None:
+                return
+            self.status = status
+            self.end = time.monotonic() if end is None else end
+            spans = list(self.spans)
+        for span in spans:
+            self.end_span(span, self.end)
+        self.tracer._finished(self)
+
+    def to_dict(self) -> dict:
+        return {"trace_id": self.trace_id, "source": self.source, "status": self.status,
+                "duration": self.duration, "attributes": dict(self.attributes),
+                "spans": [span.to_dict() for span in self.spans]}
+
+
+class Tracer:
+    def __init__(self, metrics: metrics_module.Metrics = None, history: int = 100, timeout: float = 10.0):
+        """
+        Records traces of operator commands. Each stage's duration and each
+        confirmed command's end-to-end time go into latency histograms
+        :param metrics: The collector for the histograms, under the stage names
+            and "end_to_end" (Default: a new one with the prefix "command")
+        :param history: The number of finished traces to keep in `traces` (Default: 100)
+        :param timeout: The number of seconds a dispatched command may take to show
+            in the telemetry before its trace is finished as "unconfirmed" (Default: 10)
+        """
+        self.metrics = metrics_module.Metrics(prefix="command") if metrics is None else metrics
+        self.traces = deque(maxlen=history)
+        self.timeout = timeout
+        self.statuses = {}      # Status: number of finished traces
+        self._lock = threading.Lock()
+
+    def trace(self, source: str = "voice", **attributes) -> Trace:
+        """
+        Starts tracing a command. Activate it with `activate()` while handling the command
+        """
+        return Trace(self, source, **attributes)
+
+    def _finished(self, trace: Trace) -> None:
+        if trace.status == "confirmed":
+            self.metrics.observe("end_to_end", trace.duration)
+        with self._lock:
+            self.traces.append(trace)
+            self.statuses[trace.status] = self.statuses.get(trace.status, 0) + 1
+
+    def breakdown(self) -> dict:
+        """
+        Summarises each stage and the end-to-end time, with each stage's share
+        of the total time spent in all stages, to show which one dominates
+        :return: A dictionary of stage name to latency summary
+        """
+        latency = self.metrics.snapshot()["latency"]
+        total = sum(latency[stage]["sum"] for stage in STAGES if stage in latency)
+        breakdown = {}
+        for stage in STAGES + ("end_to_end",):
+            if stage in latency:
+                summary = breakdown[stage] = dict(latency[stage])
+                if stage != "end_to_end":
+                    summary["share"] = summary["sum"] / total if total else 0.0
+        return breakdown
+
+
+@contextlib.contextmanager
+def activate(trace: Trace):
+    """
+    Makes a trace current while handling its command, so the stages run inside
+    the `with` block, including the AGV's dispatch, are recorded on it. A command
+    that raises or never dispatches anything is finished immediately.
+    Does nothing if `trace` is `None`
+    """
+    if trace is None:
+        yield None
+        return
+    token = _current.set(trace)
+    try:
+        yield trace
+    except BaseException:
+        trace.finish("error")
+        raise
+    finally:
+        _current.reset(token)
+        if not trace.dispatched:
+            trace.finish("ignored")
+
+
+def span(name: str, **attributes):
+    """
+    Times a stage of the current trace, or does nothing if there is none
+    """
+    trace = _current.get()
+    if trace is None:
+        return contextlib.nullcontext()
+    return trace.span(name, **attributes)
+
+
+class Confirmations:
+    def __init__(self):
+        """
+        Dispatched commands waiting for their effect to show in the telemetry.
+        Each is checked against every snapshot received after it was sent, and
+        finished as "unconfirmed" by a timer once its tracer's timeout passes,
+        whether or not any snapshot arrives
+        """
+        self._pending = []      # (trace, dispatched time, check, timer)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def expect(self, trace: Trace, check) -> None:
+        """
+        Waits for a dispatched command to take effect
+        :param trace: The command's trace
+        :param check: Called as `check(snapshot)`, returning `True` once the
+            snapshot shows the command's effect
+        """
+        timer = threading.Timer(trace.tracer.timeout, self._expire, (trace,))
+        timer.daemon = True
+        with self._lock:
+            self._pending.append((trace, time.monotonic(), check, timer))
+        timer.start()
+
+    def _expire(self, trace: Trace) -> None:
+        """
+        Finishes a trace whose command never showed its effect in time
+        """
+        with self._lock:
+            pending = [entry for entry in self._pending if entry[0] is not trace]
+            if len(pending) == len(self._pending):
+                return      # Confirmed in the meantime
+            self._pending = pending
+        trace.finish("unconfirmed")
+
+    def update(self, snapshot) -> None:
+        """
+        Finishes the traces whose effect a new snapshot shows, and any that timed out
+        :param snapshot: A `Telemetry` snapshot requested after the commands were sent
+        """
+        if not self._pending:
+            return
+        now = time.monotonic()
+        with self._lock:
+            pending, self._pending = self._pending, []
+        waiting = []
+        for trace, dispatched, check, timer in pending:
+            if check(snapshot):
+                timer.cancel()
+                trace.start_span("confirmation", start=dispatched)
+                trace.finish("confirmed", now)
+            elif now - dispatched > trace.tracer.timeout:
+                # The timer fired while the entry was out of the list, so it missed it
+                trace.finish("unconfirmed", now)
+            else:
+                waiting.append((trace, dispatched, check, timer))
+        if waiting:
+            with self._lock:
+                self._pending.extend(waiting)
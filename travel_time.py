@@ -0,0 +1,168 @@
+"""
+Time-based routing, which weighs how long the AGV takes to rotate at a node
+against how long it takes to drive along an edge
+
+Author: D. William Campman
+Date: 2022-10-08
+"""
+
+import heapq
+import itertools
+import math
+from typing import Optional
+
+# Ports in counter-clockwise order, so adjacent entries are a quarter turn apart
+HEADINGS = "nwse"
+
+
+def quarter_turns(heading: Optional[str], port: str) -> int:
+    """
+    Returns how many quarter turns the AGV makes to leave through a port
+    :param heading: The direction the AGV is facing, as a port character.
+        `None` if unknown, which counts as no turn
+    :param port: The port the AGV leaves through
+    :return: 0 (straight on), 1 (left or right) or 2 (reversing)
+    """
+    if heading is None or heading == port:
+        return 0
+    difference = abs(HEADINGS.index(heading) - HEADINGS.index(port)) % 4
+    return min(difference, 4 - difference)
+
+
+def heading_from_theta(theta: Optional[float]) -> Optional[str]:
+    """
+    Converts the AGV's reported orientation to the nearest port direction
+    :param theta: The orientation in radians, counter-clockwise from the
+        positive x axis (east)
+    :return: The port character the AGV is facing, or `None` if theta is unknown
+    """
+    if theta is None:
+        return None
+    quadrant = round(theta / (math.pi / 2)) % 4
+    return "enws"[quadrant]
+
+
+class TravelModel:
+    def __init__(self,
+                 speed: float = 1000.0,
+                 turn_time: float = 4.0,
+                 reverse_time: float = None,
+                 stop_time: float = 0.0):
+        """
+        Estimates how long the AGV takes to drive a route
+        :param speed: The AGV's straight-line speed, in map units per second (Default: 1000)
+        :param turn_time: The seconds a quarter turn takes, including slowing
+            down and speeding up again (Default: 4)
+        :param reverse_time: The seconds a half turn takes. `None` counts it as
+            two quarter turns (Default: None)
+        :param stop_time: Extra seconds spent at each waypoint the AGV is sent
+            to, e.g. for the command round trip (Default: 0)
+        """
+        if speed <= 0:
+            raise ValueError("Speed must be positive")
+        self.speed = speed
+        self.turn_time = turn_time
+        self.reverse_time = 2 * turn_time if reverse_time is None else reverse_time
+        self.stop_time = stop_time
+
+    def key(self) -> tuple:
+        """
+        Returns a hashable summary of the model, for caching routes planned with it
+        """
+        return self.speed, self.turn_time, self.reverse_time, self.stop_time
+
+    def drive_time(self, length: float) -> float:
+        """
+        Returns the seconds taken to drive a straight distance
+        """
+        return length / self.speed
+
+    def rotation_time(self, heading: Optional[str], port: str) -> float:
+        """
+        Returns the seconds taken to turn from a heading to leave through a port,
+        including the stop at the waypoint the turn creates
+        """
+        turns = quarter_turns(heading, port)
+        if turns == 0:
+            return 0.0
+        return (self.turn_time if turns == 1 else self.reverse_time) + self.stop_time
+
+    def duration(self, network, route: list, heading: Optional[str] = None) -> float:
+        """
+        Estimates how long the AGV takes to drive a route
+        :param network: The network the route runs through
+        :param route: Every node along the route, including the source
+        :param heading: The direction the AGV faces at the source, as a port
+            character. `None` if unknown (Default: None)
+        :return: The estimated duration in seconds
+        """
+        total = self.stop_time if len(route) > 1 else 0.0    # The final waypoint
+        for node, next_node in zip(route, route[1:]):
+            port = node.get_neighbor_port(next_node)
+            total += self.rotation_time(heading, port) + self.drive_time(node.distance_to(next_node))
+            heading = port
+        return total
+
+
+def find_fastest_path(network,
+                      source_id,
+                      target_id,
+                      model: TravelModel,
+                      heading: Optional[str] = None) -> Optional[tuple]:
+    """
+    Finds the quickest route between two nodes using A* over (node, heading)
+    states, so a longer route with fewer turns can beat a shorter one.
+    Blocked nodes and edges (see `Network.add_obstacle`) are avoided
+    :param network: A `node_network.Network` or `compact_network.CompactNetwork`
+    :param source_id: The ID of the node to start at
+    :param target_id: The ID of the node to reach
+    :param model: The speeds and turn penalties to plan with
+    :param heading: The direction the AGV faces at the source, as a port
+        character. `None` if unknown (Default: None)
+    :return: A tuple of the IDs of every node along the route (including the
+        source and target) and the estimated duration in seconds. `None` if the
+        target cannot be reached
+    """
+    target = network.get_node(target_id)
+    target_x, target_y = target.x, target.y
+
+    def estimate(node_id):
+        # Driving in a straight line at full speed is the best case
+        node = network.get_node(node_id)
+        return math.hypot(node.x - target_x, node.y - target_y) / model.speed
+
+    tie_breaker = itertools.count()
+    start = (source_id, heading)
+    open_heap = [(estimate(source_id), next(tie_breaker), start)]
+    cost_to = {start: 0.0}
+    parents = {start: None}
+    closed = set()
+
+    while open_heap:
+        _, _, state = heapq.heappop(open_heap)
+        node_id, node_heading = state
+        if node_id == target_id:
+            duration = cost_to[state] + (model.stop_time if node_id != source_id else 0.0)
+            path = []
+            while state is not None:
+                path.append(state[0])
+                state = parents[state]
+            path.reverse()
+            return path, duration
+        if state in closed:
+            continue
+        closed.add(state)
+
+        state_cost = cost_to[state]
+        for neighbor_id, port, length in network.edges_from(node_id):
+            if network.is_node_blocked(neighbor_id) or network.is_edge_blocked(node_id, neighbor_id):
+                continue
+            next_state = (neighbor_id, port)
+            if next_state in closed:
+                continue
+            cost = state_cost + model.rotation_time(node_heading, port) + model.drive_time(length)
+            if cost < cost_to.get(next_state, math.inf):
+                cost_to[next_state] = cost
+                parents[next_state] = state
+                heapq.heappush(open_heap, (cost + estimate(neighbor_id), next(tie_breaker), next_state))
+    return None
@@ -5,8 +5,25 @@ Author: D. William Campman
 Date: 2022-10-05
 """
 
+import time
+from urllib.parse import urlsplit
+
 import aiohttp
 
+# Set to a `metrics.Metrics` to record every request made through these helpers
+metrics = None
+
+
+def _observe(url, started, status, received=0):
+    """
+    Records a request that began at `started` (a `time.perf_counter()` time),
+    if metrics are enabled. Requests are grouped by host and path, without the query
+    """
+    if metrics is not None:
+        parts = urlsplit(url)
+        metrics.request(parts.netloc + parts.path, time.perf_counter() - started, status,
+                        received=received)
+
 
 async def async_get(url, headers=None, params=None):
     """
@@ -30,8 +47,10 @@ async def async_get(url, headers=None, params=None):
     headers = {} if headers is None else headers
     params = {} if params is None else params
 
+    started = time.perf_counter()
     async with aiohttp.ClientSession(headers=headers) as session:
         async with session.get(url, params=params) as resp:
+            _observe(url, started, resp.status)
             return resp
 
 
@@ -62,11 +81,14 @@ async def async_get_json(url, headers=None, params=None):
     headers = {} if headers is None else headers
     params = {} if params is None else params
 
+    started = time.perf_counter()
     async with aiohttp.ClientSession(headers=headers) as session:
         async with session.get(url, params=params) as resp:
             if resp.status == 200:
                 json = await resp.json()
+                _observe(url, started, 200, len(await resp.read()))
                 return json, 200
+            _observe(url, started, resp.status)
             return None, resp.status
 
 
@@ -103,7 +125,9 @@ async def async_post(url, params=None, headers=None, json=None):
     if json is None:
         json = {}
 
+    started = time.perf_counter()
     async with aiohttp.ClientSession(headers=headers) as session:
         async with session.post(url, params=params, json=json) as resp:
             json = await resp.json() if resp.status == 200 else None
+            _observe(url, started, resp.status, len(await resp.read()) if json is not None else 0)
             return json, resp.status